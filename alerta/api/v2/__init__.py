@@ -13,9 +13,31 @@ Version = '2.1.0'
 LOG = logging.getLogger(__name__)
 CONF = config.CONF
 
+api_opts = {
+    'bulk_max_alerts': 1000,  # max alerts per bulk request
+    'bulk_send_size': 100,    # alerts sent to broker per transaction
+    'counts_cache_ttl': 5,    # seconds alert counts are shared between requests, 0 disables
+    'query_cache_size': 1000, # parsed console queries cached by request arguments
+    'api_threads': 50,        # threads of the WSGI daemon, threads= in contrib/apache/httpd-alerta-api.conf
+    # each pushed console holds a WSGI thread for as long as it is connected, so push clients are
+    # limited to half of api_threads to leave threads for other requests
+    'push_max_clients': 20,   # max consoles connected to the alert stream and long-poll endpoints
+    'push_buffer_size': 1000, # alerts kept for consoles that have fallen behind
+    'push_timeout': 30,       # seconds a long-poll request waits for alerts
+    'push_keepalive': 15,     # seconds between keepalive comments on an idle alert stream
+}
+
+config.register_opts(api_opts)
 config.parse_args(version=Version)
 logging.setup('alerta')
 
+if CONF.push_buffer_size < 1:
+    LOG.error('push_buffer_size must be at least 1, not %s', CONF.push_buffer_size)
+    sys.exit(1)
+if CONF.push_max_clients > CONF.api_threads // 2:
+    LOG.warning('Limiting push clients to %d, half of the %d api_threads', CONF.api_threads // 2, CONF.api_threads)
+    CONF.push_max_clients = CONF.api_threads // 2
+
 app = Flask(__name__)
 app.config.from_object(__name__)
 db = Mongo()
@@ -5,6 +5,8 @@ import datetime
 from flask import request, Response, url_for, jsonify, render_template
 from alerta.api.v2 import app, db, mq
 from alerta.api.v2.switch import Switch, SwitchState
+from alerta.api.v2.views import feed, planner
+from alerta.api.v2.utils import queries
 
 from alerta import get_version
 from alerta.common import log as logging
@@ -123,4 +125,38 @@ def status():
     }
     metrics.append(auto_refresh_allow)
 
+    push = feed.get_stats()
+    for name, title, description, metric_type in [
+        ('clients', 'Push clients', 'Number of consoles connected to the alert stream and long-poll endpoints', 'gauge'),
+        ('received', 'Push alerts received', 'Number of alerts received for push clients', 'counter'),
+        ('delivered', 'Push alerts delivered', 'Number of alerts sent to push clients', 'counter'),
+        ('rejected', 'Push clients rejected', 'Number of push clients rejected because there were too many', 'counter'),
+        ('overruns', 'Push client overruns', 'Number of times a push client fell behind and missed alerts', 'counter'),
+    ]:
+        metrics.append({
+            "group": "push",
+            "name": name,
+            "type": metric_type,
+            "title": title,
+            "description": description,
+            "value": push[name],
+        })
+
+    stats = dict(planner.get_stats(), **queries.get_stats())
+    for name, title, description, metric_type in [
+        ('queries', 'Console queries', 'Number of alert and count queries planned', 'counter'),
+        ('collscans', 'Collection scans', 'Number of queries that no index can be used for', 'counter'),
+        ('hits', 'Query cache hits', 'Number of queries found in the parsed query cache', 'counter'),
+        ('misses', 'Query cache misses', 'Number of queries parsed from request arguments', 'counter'),
+        ('size', 'Query cache size', 'Number of parsed queries in the cache', 'gauge'),
+    ]:
+        metrics.append({
+            "group": "query",
+            "name": name,
+            "type": metric_type,
+            "title": title,
+            "description": description,
+            "value": stats[name],
+        })
+
     return jsonify(application="alerta", time=int(time.time() * 1000), metrics=metrics)
@@ -0,0 +1,138 @@
+
+import json
+import threading
+
+from collections import deque
+from itertools import islice
+
+from alerta.common import config
+from alerta.common import log as logging
+from alerta.common.alert import Alert
+from alerta.common.mq import Messaging, MessageHandler
+from alerta.common.utils import DateEncoder
+
+LOG = logging.getLogger(__name__)
+CONF = config.CONF
+
+
+class AlertFeed(MessageHandler):
+    """
+    Alerts published to the notify topic, for consoles that are pushed alert changes instead of
+    polling. Alerts are kept in a ring buffer of the last size alerts that is shared by every client,
+    and each client waits on the same condition for alerts after the last one it has seen. There is
+    no thread or queue per client, but each client holds the WSGI thread serving its request, so the
+    number of clients is limited by the threads of the WSGI server. A client that falls more than
+    size alerts behind is told it has missed alerts.
+
+    The topic is subscribed to when the first client connects.
+
+    >>> feed = AlertFeed(1000, 100)
+    >>> if feed.join():
+    >>>     events, after, overrun = feed.wait(after, timeout)   # events are (seq, document, data)
+    >>>     feed.leave()
+    """
+
+    def __init__(self, size, max_clients):
+
+        if size < 1:
+            raise ValueError('push buffer size must be at least 1')
+
+        self.size = size
+        self.max_clients = max_clients
+
+        self.mq = None
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        self.condition = threading.Condition()
+
+        self.clients = 0
+        self.received = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.overruns = 0
+
+        MessageHandler.__init__(self)
+
+    def start(self):
+
+        LOG.info('Subscribing to %s for push clients', CONF.outbound_topic)
+        mq = Messaging(publish=False)
+        mq.connect(callback=self)
+        mq.subscribe(destination=CONF.outbound_topic)
+        self.mq = mq
+
+    def join(self):
+        """
+        Register a client. Returns False if there are already max_clients, and raises an exception
+        if the topic could not be subscribed to, in which case the next client tries again.
+        """
+        with self.condition:
+            if self.clients >= self.max_clients:
+                self.rejected += 1
+                return False
+            if not self.mq:
+                self.start()
+            self.clients += 1
+        return True
+
+    def leave(self):
+
+        with self.condition:
+            self.clients -= 1
+
+    def on_message(self, headers, body):
+
+        try:
+            alert = Alert.parse_alert(body)
+        except ValueError:
+            return
+
+        # document is matched against console queries and data is serialized once for every client
+        data = json.dumps(alert.get_body(), cls=DateEncoder)
+        document = alert.get_body()
+        document['_id'] = document['id']
+
+        with self.condition:
+            self.seq += 1
+            self.events.append((self.seq, document, data))
+            self.received += 1
+            self.condition.notify_all()
+
+    def on_disconnected(self):
+        self.mq.reconnect()
+
+    def wait(self, after, timeout):
+        """
+        Returns a tuple of (events, last, overrun) with the events after seq after, waiting up to
+        timeout seconds if there are none, and the seq to wait after next time. Overrun is True if
+        events were dropped from the buffer, or after is from before the API was restarted.
+        """
+        with self.condition:
+            if after > self.seq:
+                self.overruns += 1
+                return list(), self.seq, True
+            if self.seq == after:
+                self.condition.wait(timeout)
+            if self.seq == after:
+                return list(), after, False
+
+            first = self.events[0][0]
+            overrun = after < first - 1
+            if overrun:
+                self.overruns += 1
+            return list(islice(self.events, max(after - first + 1, 0), None)), self.seq, overrun
+
+    def sent(self, count):
+
+        with self.condition:
+            self.delivered += count
+
+    def get_stats(self):
+
+        return {
+            'clients': self.clients,
+            'received': self.received,
+            'delivered': self.delivered,
+            'rejected': self.rejected,
+            'overruns': self.overruns,
+        }
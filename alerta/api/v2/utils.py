@@ -1,30 +1,263 @@
 import json
+import time
+import base64
 import datetime
+import threading
 import pytz
 import re
 
+from collections import OrderedDict
 from datetime import timedelta
 from flask import make_response, request, current_app
+from werkzeug.datastructures import MultiDict
 from functools import update_wrapper
 
 from alerta.common import config
 from alerta.common import log as logging
-from alerta.common.alert import ATTRIBUTES
+from alerta.common.alert import Alert, ATTRIBUTES
+from alerta.common.utils import DateEncoder
 
 LOG = logging.getLogger(__name__)
 CONF = config.CONF
 
 
-def parse_fields(request):
+_WHITESPACE = re.compile(r'\s*')
+_NUMBER_CHARS = '0123456789.eE+-'
+_SCALAR_END = re.compile(r'[\s,\]]')
+_STRUCTURE = re.compile(r'[^"\[\]{}]*')
+_STRING = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+_RE_TYPE = type(re.compile(''))
+
+
+class BulkError(ValueError):
+    """
+    A bulk request that is not a well-formed JSON array, so no more alerts can be read from it. Has
+    the results for the alerts read before the error once raised by create_bulk().
+    """
+
+    def __init__(self, message, results=None):
+
+        ValueError.__init__(self, message)
+        self.results = results or list()
+
+
+def _item_end(buf, start, state):
+    """
+    Find where the JSON array item at start in buf ends without decoding it, by matching brackets
+    outside strings. Scanning resumes from state, the position, depth of brackets and whether in a
+    string where the last scan stopped. Returns the end, or None if the item goes on past the end of
+    buf, and the state to resume from.
+    """
+    scan, depth, in_string = state
+
+    if buf[start] not in '"[{':
+        match = _SCALAR_END.search(buf, scan)
+        return (match.start() if match else None), (len(buf), 0, False)
+
+    while scan < len(buf):
+        if in_string:
+            scan = _STRING.match(buf, scan).end()
+            if scan == len(buf) or buf[scan] != '"':
+                break  # the string, or an escape in it, goes on past the end of buf
+            in_string = False
+        else:
+            scan = _STRUCTURE.match(buf, scan).end()
+            if scan == len(buf):
+                break
+            if buf[scan] == '"':
+                in_string = True
+            elif buf[scan] in '[{':
+                depth += 1
+            else:
+                depth -= 1
+        scan += 1
+        if depth <= 0 and not in_string:
+            return scan, (scan, depth, in_string)
+    return None, (scan, depth, in_string)
+
+
+def parse_bulk(stream, chunk_size=65536, max_item_size=1048576):
+    """
+    Parse a JSON array or newline-delimited JSON from a stream one item at a time. Yields each item,
+    or a ValueError for an item that could not be parsed. A newline-delimited item is skipped on
+    error but an error in an array, an array item longer than max_item_size or data after the array
+    is a BulkError that stops parsing.
+    """
+    decoder = json.JSONDecoder()
+
+    buf = ''
+    while not buf.strip():
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+    buf = buf.lstrip()
+
+    if not buf.startswith('['):
+        while True:
+            lines = buf.split('\n')
+            buf = lines.pop()
+            for line in lines:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError, e:
+                        yield e
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            buf += chunk
+        if buf.strip():
+            try:
+                yield json.loads(buf)
+            except ValueError, e:
+                yield e
+        return
+
+    pos = 1
+    after_item = after_comma = False
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                yield BulkError('Unterminated JSON array')
+                return
+            buf = chunk
+            pos = 0
+            continue
+        if not after_comma and buf[pos] == ']':
+            rest = buf[pos + 1:]
+            while not rest.strip():
+                rest = stream.read(chunk_size)
+                if not rest:
+                    return
+            yield BulkError('Extra data after JSON array')
+            return
+        if after_item:
+            if buf[pos] != ',':
+                yield BulkError('Expecting , delimiter in JSON array')
+                return
+            pos += 1
+            after_item, after_comma = False, True
+            continue
 
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+            if end == len(buf) or (isinstance(item, (int, long, float)) and buf[end] in _NUMBER_CHARS):
+                raise ValueError('Unterminated JSON array')  # a number at the end of a chunk may go on in the next
+        except ValueError:
+            # find where the item ends before decoding it again, so a malformed item stops parsing and
+            # an item split across chunks is only decoded once it has all been read
+            end, state = _item_end(buf, pos, (pos, 0, False))
+            while end is None:
+                if len(buf) - pos > max_item_size:
+                    yield BulkError('JSON array item is longer than %d characters' % max_item_size)
+                    return
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    yield BulkError('Unterminated JSON array')
+                    return
+                buf = buf[pos:] + chunk
+                state = (state[0] - pos,) + state[1:]
+                pos = 0
+                end, state = _item_end(buf, pos, state)
+            try:
+                item, item_end = decoder.raw_decode(buf, pos)
+                if item_end != end:
+                    raise ValueError('Expecting , delimiter in JSON array')
+            except ValueError, e:
+                yield BulkError(str(e))
+                return
+        yield item
+        pos = end
+        after_item, after_comma = True, False
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+
+def create_bulk(stream, send_batch, max_alerts, send_size):
+    """
+    Parse alerts from a bulk request and send them to the broker send_size at a time with send_batch,
+    which returns the number sent. Returns a list of results, one per alert, and an error message if
+    the request had more than max_alerts alerts, in which case the rest are not read. Raises a
+    BulkError with the results so far if the request is not well-formed.
+    """
+    results = list()
+    batch = list()
+
+    def send(batch):
+        if send_batch([newAlert for newAlert, result in batch]) < len(batch):
+            for newAlert, result in batch:
+                result.update({"status": "error", "message": "could not send alert to broker"})
+                del result['id']
+        del batch[:]
+
+    for index, item in enumerate(parse_bulk(stream)):
+        if isinstance(item, BulkError):
+            send(batch)
+            item.results = results
+            raise item
+        if index >= max_alerts:
+            send(batch)
+            return results, "too many alerts, max is %s" % max_alerts
+        try:
+            if isinstance(item, ValueError):
+                raise item
+            newAlert = Alert.parse_alert(item)
+        except (ValueError, TypeError, AttributeError), e:
+            results.append({"index": index, "status": "error", "message": str(e)})
+            continue
+
+        LOG.debug('New alert %s', newAlert)
+        result = {"index": index, "status": "ok", "id": newAlert.get_id()}
+        results.append(result)
+        batch.append((newAlert, result))
+
+        if len(batch) >= send_size:
+            send(batch)
+    send(batch)
+
+    return results, None
+
+
+# request arguments used by parse_fields, other arguments such as callback don't change the query
+_QUERY_ARGS = ['q', 'from-date', 'id', 'repeat', 'sort-by', 'limit']
+
+# characters that match themselves in a regular expression
+_LITERAL = re.compile(r'[^\\^$.|?*+()\[\]{}]*')
+
+
+def parse_fields(request):
+    """
+    Returns the query, sort and limit for the request arguments. Parsed queries are cached by
+    argument so they must not be modified.
+    """
     query_time = datetime.datetime.utcnow()
 
-    if 'q' in request.args:
-        query = json.loads(request.args.get('q'))
+    args = tuple(sorted((k, tuple(v)) for k, v in request.args.lists()
+                        if k in _QUERY_ARGS or k.rstrip('!') in ATTRIBUTES or k.startswith('tags')))
+    query, sort, limit, from_date = queries.get(args)
+
+    if from_date:
+        to_date = query_time.replace(tzinfo=pytz.utc)
+        query = dict(query)
+        query['lastReceiveTime'] = {'$gt': from_date, '$lte': to_date}
+
+    return query, list(sort), limit, query_time
+
+
+def _parse_args(args):
+
+    args = MultiDict([(k, v) for k, values in args for v in values])
+
+    if 'q' in args:
+        query = json.loads(args.get('q'))
     else:
         query = dict()
 
-    from_date = request.args.get('from-date', None)
+    from_date = args.get('from-date', None)
     if from_date:
         try:
             from_date = datetime.datetime.strptime(from_date, '%Y-%m-%dT%H:%M:%S.%fZ')
@@ -32,22 +265,22 @@ def parse_fields(request):
             LOG.warning('Could not parse from_date query parameter: %s', e)
             raise
         from_date = from_date.replace(tzinfo=pytz.utc)
-        to_date = query_time
-        to_date = to_date.replace(tzinfo=pytz.utc)
-        query['lastReceiveTime'] = {'$gt': from_date, '$lte': to_date}
+        query.pop('lastReceiveTime', None)
 
-    if request.args.get('id', None):
-        query['$or'] = [{'_id': {'$regex': '^' + request.args['id']}},
-                        {'lastReceiveId': {'$regex': '^' + request.args['id']}}]
+    if args.get('id', None):
+        # ids are matched literally, as a range of values from the prefix so that the _id index is used
+        alertid = args['id']
+        prefix = {'$gte': alertid, '$lt': alertid[:-1] + unichr(ord(alertid[-1]) + 1)}
+        query['$or'] = [{'_id': prefix}, {'lastReceiveId': prefix}]
 
-    if request.args.get('repeat', None):
-        query['repeat'] = True if request.args.get('repeat', 'true') == 'true' else False
+    if args.get('repeat', None):
+        query['repeat'] = True if args.get('repeat', 'true') == 'true' else False
 
-    for field in [fields for fields in request.args if fields.rstrip('!') in ATTRIBUTES or fields.startswith('tags')]:
+    for field in [fields for fields in args if fields.rstrip('!') in ATTRIBUTES or fields.startswith('tags')]:
         if field in ['id', 'repeat']:
             # Don't process queries on "id" or "repeat" twice
             continue
-        value = request.args.getlist(field)
+        value = args.getlist(field)
         if len(value) == 1:
             value = value[0]
             if field.endswith('!'):
@@ -59,8 +292,7 @@ def parse_fields(request):
                     query[field[:-1]]['$ne'] = value
             else:
                 if value.startswith('~'):
-                    query[field] = dict()
-                    query[field]['$regex'] = re.compile(value[1:], re.IGNORECASE)
+                    query[field] = prefix_query(value[1:], re.IGNORECASE)
                 else:
                     query[field] = value
         else:
@@ -75,15 +307,17 @@ def parse_fields(request):
             else:
                 if '~' in [v[0] for v in value]:
                     value = '|'.join([v.lstrip('~') for v in value])
-                    query[field] = dict()
-                    query[field]['$regex'] = re.compile(value, re.IGNORECASE)
+                    query[field] = prefix_query(value, re.IGNORECASE)
                 else:
                     query[field] = dict()
                     query[field]['$in'] = value
 
+    if 'lastReceiveTime' in query:
+        from_date = None
+
     sort = list()
-    if request.args.get('sort-by', None):
-        for sort_by in request.args.getlist('sort-by'):
+    if args.get('sort-by', None):
+        for sort_by in args.getlist('sort-by'):
             if sort_by in ['createTime', 'receiveTime', 'lastReceiveTime']:
                 sort.append((sort_by, -1))  # sort by newest first
             else:
@@ -91,9 +325,410 @@ def parse_fields(request):
     else:
         sort.append(('lastReceiveTime', -1))
 
-    limit = request.args.get('limit', CONF.console_limit, int)
+    limit = args.get('limit', CONF.console_limit, int)
+
+    return query, sort, limit, from_date
+
+
+def prefix_query(pattern, flags=0):
+    """
+    Regular expression condition, with a range of values the match must be in if the pattern is
+    anchored to a literal prefix so that MongoDB can use an index. MongoDB only uses the prefix of a
+    case-sensitive regex so for case-insensitive patterns the range is from the upper case prefix to
+    the lower case prefix, which includes every case of it.
+    """
+    condition = {'$regex': re.compile(pattern, flags)}
+
+    if not pattern.startswith('^') or '|' in pattern:
+        return condition
+    prefix = _LITERAL.match(pattern, 1).group()
+    if pattern[1 + len(prefix):][:1] in ('?', '*', '{'):
+        prefix = prefix[:-1]  # the last character is optional
+    if not prefix or any(ord(c) >= 127 for c in prefix):
+        return condition
+
+    if flags & re.IGNORECASE:
+        lower, upper = prefix.upper(), prefix.lower()
+    else:
+        lower, upper = prefix, prefix
+    condition['$gte'] = lower
+    condition['$lt'] = upper[:-1] + unichr(ord(upper[-1]) + 1)
+
+    return condition
+
+
+class ParsedQueries(object):
+    """
+    Least recently used cache of parsed queries, keyed by request arguments.
+    """
+
+    def __init__(self, size=1000):
+
+        self.size = size
+        self.parsed = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, args):
+
+        with self.lock:
+            if args in self.parsed:
+                self.hits += 1
+                parsed = self.parsed.pop(args)
+                self.parsed[args] = parsed
+                return parsed
+
+        parsed = _parse_args(args)
+
+        with self.lock:
+            self.misses += 1
+            self.parsed[args] = parsed
+            while len(self.parsed) > self.size:
+                self.parsed.popitem(last=False)
+
+        return parsed
+
+    def get_stats(self):
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.parsed),
+        }
+
+queries = ParsedQueries(CONF.query_cache_size)
+
+
+def _bounded(condition):
+    """
+    True if a condition limits the values an index has to be scanned for.
+    """
+    if isinstance(condition, _RE_TYPE):
+        return False
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        return any(op in condition for op in ('$eq', '$in', '$gt', '$gte', '$lt', '$lte'))
+    return True
+
+
+class QueryPlanner(object):
+    """
+    Finds an index that MongoDB can use for a query, to show which console filters scan the whole
+    alerts collection. Like MongoDB, an index can be used if its first field is bounded by the query
+    and for $or if an index can be used for every clause.
+
+    >>> planner = QueryPlanner(db.get_indexes)
+    >>> planner.plan(query)     # 'status_1_lastReceiveTime_1', 'COLLSCAN' or 'ALL' for no query
+    """
 
-    return query, sort, limit, query_time
+    def __init__(self, get_indexes, ttl=60):
+
+        self.get_indexes = get_indexes
+        self.ttl = ttl
+        self.indexes = list()
+        self.expires = 0
+
+        self.queries = 0
+        self.collscans = 0
+
+    def _plan(self, query):
+
+        fields = set(k for k, v in query.iteritems() if not k.startswith('$') and _bounded(v))
+        for name, keys in self.indexes:
+            if keys[0][0] in fields:
+                return name
+
+        if '$or' in query:
+            plans = [self._plan(q) for q in query['$or']]
+            if all(plans):
+                return '|'.join(sorted(set(plans)))
+        for q in query.get('$and', []):
+            plan = self._plan(q)
+            if plan:
+                return plan
+
+        return None
+
+    def plan(self, query):
+
+        if time.time() > self.expires:
+            self.indexes = sorted(self.get_indexes().iteritems())
+            self.expires = time.time() + self.ttl
+
+        self.queries += 1
+        if not query:
+            return 'ALL'
+
+        plan = self._plan(query)
+        if not plan:
+            self.collscans += 1
+            LOG.debug('Query will scan the alerts collection: %s', normalize_query(query))
+            return 'COLLSCAN'
+
+        return plan
+
+    def get_stats(self):
+
+        return {
+            'queries': self.queries,
+            'collscans': self.collscans,
+        }
+
+
+def normalize_query(query):
+    """
+    Returns a string key that is the same for equivalent queries, including regular expressions.
+    """
+    def default(obj):
+        if isinstance(obj, _RE_TYPE):
+            return {'$regex': obj.pattern, '$flags': obj.flags}
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        return str(obj)
+
+    return json.dumps(query, sort_keys=True, default=default)
+
+
+def without_request_time(query, query_time):
+    """
+    Query without the from-date upper bound that parse_fields sets to the time of the request, eg. for
+    a cache key that would otherwise be different for every request.
+    """
+    condition = query.get('lastReceiveTime')
+    if not isinstance(condition, dict) or condition.get('$lte') != query_time.replace(tzinfo=pytz.utc):
+        return query
+
+    query = dict(query)
+    query['lastReceiveTime'] = dict((k, v) for k, v in condition.iteritems() if k != '$lte')
+    return query
+
+
+class QueryCache(object):
+    """
+    Results of queries shared by requests for the same query for up to ttl seconds. Concurrent
+    requests for a query that is not cached wait for one of them to run it.
+
+    >>> counts = QueryCache(5)
+    >>> found, severity_count, status_count = counts.get(query, db.get_counts)
+
+    Results are cached by key, if given, instead of the query, eg. the query without the request time.
+    """
+
+    def __init__(self, ttl, size=1000):
+
+        self.ttl = ttl
+        self.size = size
+        self.results = dict()   # key -> (expires, result)
+        self.locks = dict()     # key -> lock held while the query runs
+        self.lock = threading.Lock()
+
+    def get(self, query, func, key=None):
+
+        if not self.ttl:
+            return func(query)
+
+        key = normalize_query(key if key is not None else query)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+
+        with lock:
+            cached = self.results.get(key)
+            if cached and cached[0] > time.time():
+                return cached[1]
+
+            result = func(query)
+
+            with self.lock:
+                now = time.time()
+                if len(self.results) >= self.size:
+                    for k in [k for k, (expires, r) in self.results.items() if expires <= now]:
+                        del self.results[k]
+                        self.locks.pop(k, None)
+                if len(self.results) < self.size:
+                    self.results[key] = (now + self.ttl, result)
+                else:
+                    self.locks.pop(key, None)
+
+        return result
+
+
+def encode_cursor(time, id):
+    """
+    Opaque token for a position when sorted by time and id, eg. alerts by lastReceiveTime and _id.
+    """
+    return base64.urlsafe_b64encode(json.dumps([time, str(id)], cls=DateEncoder))
+
+
+def decode_cursor(token):
+
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(token)))
+        if not isinstance(position, list) or len(position) != 2 or not all(isinstance(p, basestring) for p in position):
+            raise ValueError
+        last_receive_time = datetime.datetime.strptime(position[0], '%Y-%m-%dT%H:%M:%S.%fZ')
+        alertid = position[1]
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor %r' % token)
+
+    return last_receive_time.replace(tzinfo=pytz.utc), alertid
+
+
+def after_cursor(query, token):
+    """
+    Restrict a query to alerts after the cursor, ie. older alerts or, for the same lastReceiveTime,
+    alerts with a smaller _id.
+    """
+    last_receive_time, alertid = decode_cursor(token)
+
+    after = {'$or': [{'lastReceiveTime': {'$lt': last_receive_time}},
+                     {'lastReceiveTime': last_receive_time, '_id': {'$lt': alertid}}]}
+    if not query:
+        return after
+    return {'$and': [query, after]}
+
+
+def _resolve(document, path):
+    """
+    Values at a dotted path. Arrays along the path contribute each of their elements.
+    """
+    values = [document]
+    for key in path.split('.'):
+        found = list()
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    found.append(value[key])
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict) and key in item:
+                        found.append(item[key])
+        values = found
+    return values
+
+
+def _naive(value):
+
+    if isinstance(value, datetime.datetime) and value.tzinfo:
+        return value.astimezone(pytz.utc).replace(tzinfo=None)
+    return value
+
+
+def _candidates(values):
+    """
+    Array values match a condition if the array, or any of its elements, matches.
+    """
+    if not values:
+        return [None]
+    candidates = list()
+    for value in values:
+        if isinstance(value, list):
+            candidates.extend(value)
+        candidates.append(value)
+    return [_naive(v) for v in candidates]
+
+
+def _equals(values, expected):
+
+    expected = _naive(expected)
+    if isinstance(expected, _RE_TYPE):
+        return any(isinstance(v, basestring) and expected.search(v) for v in _candidates(values))
+    return any(v == expected for v in _candidates(values))
+
+
+def _compare(values, expected, op):
+
+    expected = _naive(expected)
+    for value in _candidates(values):
+        if value is None or isinstance(value, list):
+            continue
+        if isinstance(expected, basestring) != isinstance(value, basestring) or \
+                isinstance(expected, datetime.datetime) != isinstance(value, datetime.datetime):
+            continue
+        if op(value, expected):
+            return True
+    return False
+
+
+_COMPARISONS = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+}
+
+
+def _match_condition(values, condition):
+
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for op, expected in condition.iteritems():
+            if op == '$eq':
+                matched = _equals(values, expected)
+            elif op == '$ne':
+                matched = not _equals(values, expected)
+            elif op == '$in':
+                matched = any(_equals(values, e) for e in expected)
+            elif op == '$nin':
+                matched = not any(_equals(values, e) for e in expected)
+            elif op in _COMPARISONS:
+                matched = _compare(values, expected, _COMPARISONS[op])
+            elif op == '$regex':
+                if not isinstance(expected, _RE_TYPE):
+                    flags = re.IGNORECASE if 'i' in condition.get('$options', '') else 0
+                    expected = re.compile(expected, flags)
+                matched = _equals(values, expected)
+            elif op == '$options':
+                continue
+            elif op == '$not':
+                matched = not _match_condition(values, expected)
+            elif op == '$exists':
+                matched = bool(values) == bool(expected)
+            else:
+                raise ValueError('Unsupported query operator %s' % op)
+            if not matched:
+                return False
+        return True
+
+    return _equals(values, condition)
+
+
+def match_query(query, document):
+    """
+    Returns True if a document matches a query the way MongoDB would, for the operators used by
+    parse_fields. Raises ValueError for other operators.
+    """
+    for key, condition in query.iteritems():
+        if key == '$and':
+            matched = all(match_query(q, document) for q in condition)
+        elif key == '$or':
+            matched = any(match_query(q, document) for q in condition)
+        elif key == '$nor':
+            matched = not any(match_query(q, document) for q in condition)
+        elif key.startswith('$'):
+            raise ValueError('Unsupported query operator %s' % key)
+        else:
+            matched = _match_condition(_resolve(document, key), condition)
+        if not matched:
+            return False
+    return True
+
+
+def check_query(query):
+    """
+    Raises ValueError if match_query does not support an operator in the query.
+    """
+    for key, condition in query.iteritems():
+        if key in ('$and', '$or', '$nor'):
+            for q in condition:
+                check_query(q)
+        elif key.startswith('$'):
+            raise ValueError('Unsupported query operator %s' % key)
+        else:
+            while isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+                for op in condition:
+                    if op not in _COMPARISONS and op not in ('$eq', '$ne', '$in', '$nin', '$regex', '$options', '$not', '$exists'):
+                        raise ValueError('Unsupported query operator %s' % op)
+                condition = condition.get('$not')
 
 
 def crossdomain(origin=None, methods=None, headers=None,
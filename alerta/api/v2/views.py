@@ -1,18 +1,22 @@
 import json
 import time
+import itertools
 
 from functools import wraps
-from flask import request, current_app, render_template, abort
+from bson import ObjectId
+from flask import request, current_app, render_template, abort, stream_with_context
 
 from alerta.api.v2 import app, db, mq
 from alerta.api.v2.switch import Switch
+from alerta.api.v2.push import AlertFeed
 from alerta.common import config
 from alerta.common import log as logging
 from alerta.common.alert import Alert
 from alerta.common.heartbeat import Heartbeat
 from alerta.common import status_code, severity_code
 from alerta.common.utils import DateEncoder
-from alerta.api.v2.utils import parse_fields, crossdomain
+from alerta.api.v2.utils import parse_fields, create_bulk, BulkError, crossdomain, encode_cursor, decode_cursor, after_cursor, QueryCache
+from alerta.api.v2.utils import match_query, check_query, QueryPlanner, without_request_time
 
 
 Version = '2.1.2'
@@ -20,6 +24,10 @@ Version = '2.1.2'
 LOG = logging.getLogger(__name__)
 CONF = config.CONF
 
+counts = QueryCache(CONF.counts_cache_ttl)
+planner = QueryPlanner(db.get_indexes)
+feed = AlertFeed(CONF.push_buffer_size, CONF.push_max_clients)
+
 
 # Over-ride jsonify to support Date Encoding
 def jsonify(*args, **kwargs):
@@ -27,6 +35,12 @@ def jsonify(*args, **kwargs):
                                                  indent=None if request.is_xhr else 2), mimetype='application/json')
 
 
+def bad_request(message):
+    response = jsonify(response={"status": "error", "message": message})
+    response.status_code = 400
+    return response
+
+
 def jsonp(func):
     """Wraps JSONified output for JSONP requests."""
     @wraps(func)
@@ -72,71 +86,128 @@ def get_alerts():
 
     try:
         query, sort, limit, query_time = parse_fields(request)
+        if 'cursor' in request.args:
+            if sort != [('lastReceiveTime', -1)]:
+                raise ValueError('cursor can only be used when sorting by lastReceiveTime')
     except Exception, e:
         return jsonify(response={"status": "error", "message": str(e)})
 
+    if 'cursor' in request.args:
+        try:
+            query = after_cursor(query, request.args['cursor'])
+        except ValueError, e:
+            return bad_request(str(e))
+
+    # keyset pagination, _id orders alerts received at the same time
+    paging = sort == [('lastReceiveTime', -1)]
+    if paging:
+        sort.append(('_id', -1))
+
     fields = dict()
-    fields['history'] = {'$slice': CONF.history_limit}
+    if request.args.get('hide-alert-history', 'false') == 'true':
+        fields['history'] = 0
+    else:
+        fields['history'] = {'$slice': CONF.history_limit}
 
-    alerts = db.get_alerts(query=query, fields=fields, sort=sort, limit=limit)
-    total = db.get_count(query=query)  # TODO(nsatterl): possible race condition?
+    count = None
+    if request.args.get('count', 'false') == 'true':
+        count = db.get_count(query=query)
+
+    # read one alert more than the limit to know if there are more
+    alerts = db.iter_alerts(query=query, fields=fields, sort=sort, limit=limit + 1 if limit else 0)
 
+    # read the first alert before the response is started, so that query errors are still reported as errors
+    try:
+        first = next(alerts, None)
+    except Exception, e:
+        LOG.error('Could not get alerts: %s', e)
+        return jsonify(response={"status": "error", "message": str(e)})
+    if first:
+        alerts = itertools.chain([first], alerts)
+
+    response = current_app.response_class(stream_alerts(
+        alerts,
+        limit=limit,
+        paging=paging,
+        count=count,
+        query_time=query_time,
+        hide_repeats=request.args.getlist('hide-alert-repeats'),
+        hide_details=request.args.get('hide-alert-details', 'false') == 'true',
+        auto_refresh=Switch.get('auto-refresh-allow').is_on(),
+        indent=None if request.is_xhr else 2,
+    ), mimetype='application/json')
+    response.headers['X-Alerta-Query-Plan'] = planner.plan(query)
+    return response
+
+
+def stream_alerts(alerts, limit, paging, count, query_time, hide_repeats, hide_details, auto_refresh, indent):
+    """
+    Generate the alert list response one alert at a time. Counts and the cursor for the next
+    page are only known at the end so they follow the alert details. If reading the alerts fails
+    after the response has started, the response is completed with an error status.
+    """
     found = 0
     severity_count = dict.fromkeys(severity_code.ALL, 0)
     status_count = dict.fromkeys(status_code.ALL, 0)
 
-    alert_details = list()
-    if len(alerts) > 0:
+    read = 0
+    last_alert = None
+    last_time = None
+    more = False
+    separator = ''
 
-        last_time = None
+    yield '{"response": {"alerts": {"alertDetails": ['
 
+    try:
         for alert in alerts:
+            if limit and read == limit:
+                more = True
+                break
+            read += 1
+            last_alert = alert
+
             body = alert.get_body()
 
-            if body['severity'] in request.args.getlist('hide-alert-repeats') and body['repeat']:
+            if body['severity'] in hide_repeats and body['repeat']:
                 continue
 
-            if not request.args.get('hide-alert-details', 'false') == 'true':
-                alert_details.append(body)
-
-            if request.args.get('hide-alert-history', 'false') == 'true':
-                body['history'] = []
+            if not hide_details:
+                yield separator + json.dumps(body, cls=DateEncoder, indent=indent)
+                separator = ', '
 
             found += 1
             severity_count[body['severity']] += 1
             status_count[body['status']] += 1
 
-            if not last_time:
+            if not last_time or body['lastReceiveTime'] > last_time:
                 last_time = body['lastReceiveTime']
-            elif body['lastReceiveTime'] > last_time:
-                last_time = body['lastReceiveTime']
-
-        return jsonify(response={
-            "alerts": {
-                "alertDetails": alert_details,
-                "severityCounts": severity_count,
-                "statusCounts": status_count,
-                "lastTime": last_time,
-            },
-            "status": "ok",
-            "total": found,
-            "more": total > limit,
-            "autoRefresh": Switch.get('auto-refresh-allow').is_on(),
-        })
+    except Exception, e:
+        LOG.error('Could not get alerts after %d alerts: %s', read, e)
+        error = str(e)
     else:
-        return jsonify(response={
-            "alerts": {
-                "alertDetails": [],
-                "severityCounts": severity_count,
-                "statusCounts": status_count,
-                "lastTime": query_time,
-            },
-            "status": "ok",
-            "message": "not found",
-            "total": 0,
-            "more": False,
-            "autoRefresh": Switch.get('auto-refresh-allow').is_on(),
-        })
+        error = None
+
+    yield '], "severityCounts": %s, "statusCounts": %s, "lastTime": %s}, ' % (
+        json.dumps(severity_count), json.dumps(status_count), json.dumps(last_time or query_time, cls=DateEncoder))
+
+    if error:
+        yield json.dumps({"status": "error", "message": error})[1:] + '}'
+        return
+
+    response = {
+        "status": "ok",
+        "total": found,
+        "more": more,
+        "autoRefresh": auto_refresh,
+    }
+    if not found:
+        response['message'] = 'not found'
+    if more and paging:
+        response['next'] = encode_cursor(last_alert.last_receive_time, last_alert.alertid)
+    if count is not None:
+        response['count'] = count
+
+    yield json.dumps(response)[1:] + '}'
 
 @app.route('/alerta/api/v2/alerts/alert.json', methods=['OPTIONS', 'POST'])
 @crossdomain(origin='*', headers=['Origin', 'X-Requested-With', 'Content-Type', 'Accept'])
@@ -157,6 +228,29 @@ def create_alert():
     else:
         return jsonify(response={"status": "error", "message": "something went wrong"})
 
+@app.route('/alerta/api/v2/alerts/bulk', methods=['OPTIONS', 'POST'])
+@crossdomain(origin='*', headers=['Origin', 'X-Requested-With', 'Content-Type', 'Accept'])
+@jsonp
+def create_alerts():
+
+    # Create new alerts from a JSON array or newline-delimited JSON, sent to the broker in batches
+    try:
+        results, error = create_bulk(request.stream, mq.send_batch, CONF.bulk_max_alerts, CONF.bulk_send_size)
+    except BulkError, e:
+        response = jsonify(response={"status": "error", "message": str(e), "alerts": e.results,
+                                     "total": len(e.results)})
+        response.status_code = 400
+        return response
+    if error:
+        return jsonify(response={"status": "error", "message": error, "alerts": results, "total": len(results)})
+
+    errors = len([r for r in results if r['status'] != 'ok'])
+    if errors:
+        return jsonify(response={"status": "error", "message": "%d of %d alerts failed" % (errors, len(results)),
+                                 "alerts": results, "total": len(results)})
+    else:
+        return jsonify(response={"status": "ok", "alerts": results, "total": len(results)})
+
 @app.route('/alerta/api/v2/alerts/alert/<alertid>', methods=['OPTIONS', 'GET'])
 @crossdomain(origin='*', headers=['Origin', 'X-Requested-With', 'Content-Type', 'Accept'])
 @jsonp
@@ -170,6 +264,41 @@ def get_alert(alertid):
         return jsonify(response={"alert": None, "status": "ok", "message": "not found", "total": 0})
 
 
+# Page through the full history of an alert, newest first
+@app.route('/alerta/api/v2/alerts/alert/<alertid>/history', methods=['GET'])
+@jsonp
+def get_history(alertid):
+
+    before = None
+    if 'cursor' in request.args:
+        try:
+            before = decode_cursor(request.args['cursor'])
+            if not ObjectId.is_valid(before[1]):
+                raise ValueError('Invalid cursor %r' % request.args['cursor'])
+        except ValueError, e:
+            return bad_request(str(e))
+
+    limit = request.args.get('limit', 100, int)
+
+    history = db.get_history(alertid, before=before, limit=limit + 1)
+    if history is None:
+        return jsonify(response={"history": [], "status": "ok", "message": "not found", "total": 0})
+
+    more = len(history) > limit
+    history = history[:limit]
+
+    response = {
+        "history": [dict((k, v) for k, v in entry.iteritems() if k not in ('_id', 'alertId', 'historyTime'))
+                    for entry in history],
+        "status": "ok",
+        "total": len(history),
+        "more": more,
+    }
+    if more:
+        response['next'] = encode_cursor(history[-1]['historyTime'], history[-1]['_id'])
+
+    return jsonify(response=response)
+
 @app.route('/alerta/api/v2/alerts/alert/<alertid>/tag', methods=['OPTIONS', 'PUT'])
 @crossdomain(origin='*', headers=['Origin', 'X-Requested-With', 'Content-Type', 'Accept'])
 @jsonp
@@ -199,8 +328,7 @@ def modify_status(alertid):
         modifiedAlert = db.update_status(alertid=alertid, status=status, text=text)
 
         # Forward alert to notify topic and logger queue
-        mq.send(modifiedAlert, CONF.outbound_queue)
-        mq.send(modifiedAlert, CONF.outbound_topic)
+        mq.send(modifiedAlert, [CONF.outbound_queue, CONF.outbound_topic])
         LOG.info('%s : Alert forwarded to %s and %s', modifiedAlert.get_id(), CONF.outbound_queue, CONF.outbound_topic)
 
     else:
@@ -229,6 +357,131 @@ def delete_alert(alertid):
     else:
         return jsonify(response={"status": "error", "message": "POST request without '_method' override?"})
 
+# Return alerts changed since a change sequence number, for consoles that keep a copy of the alert list
+@app.route('/alerta/api/v2/alerts/changes', methods=['GET'])
+@jsonp
+def get_changes():
+
+    try:
+        query, _, limit, query_time = parse_fields(request)
+        since = request.args.get('since', 0, int)
+    except Exception, e:
+        return jsonify(response={"status": "error", "message": str(e)})
+
+    fields = dict()
+    fields['history'] = {'$slice': CONF.history_limit}
+
+    changes = db.get_changes(since=since, query=query, fields=fields, limit=limit)
+
+    return jsonify(response={
+        "alerts": {
+            "alertDetails": [alert.get_body() for alert in changes['alerts']],
+            "deleted": changes['deleted'],
+            "lastTime": query_time,
+        },
+        "status": "ok",
+        "since": since,
+        "seq": changes['seq'],
+        "total": len(changes['alerts']),
+        "more": changes['more'],
+        "resync": changes['resync'],
+        "autoRefresh": Switch.get('auto-refresh-allow').is_on(),
+    })
+
+def parse_push(request):
+    """
+    Query for pushed alerts. The from-date upper bound is the time of the request so it is dropped.
+    """
+    query, _, _, query_time = parse_fields(request)
+    query = without_request_time(query, query_time)
+    check_query(query)
+
+    return query
+
+
+# Push alerts to consoles as they are received, as server-sent events
+@app.route('/alerta/api/v2/alerts/stream', methods=['GET'])
+def stream():
+
+    try:
+        query = parse_push(request)
+        after = int(request.headers.get('Last-Event-ID', request.args.get('after', feed.seq)))
+    except Exception, e:
+        return jsonify(response={"status": "error", "message": str(e)})
+
+    try:
+        joined = feed.join()
+    except Exception, e:
+        LOG.error('Could not subscribe to alerts for push clients: %s', e)
+        return jsonify(response={"status": "error", "message": "could not subscribe to alerts"}), 503
+    if not joined:
+        return jsonify(response={"status": "error", "message": "too many clients"}), 503
+
+    response = current_app.response_class(stream_with_context(push_events(query, after)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def push_events(query, after):
+
+    try:
+        yield 'retry: %d\n\n' % (CONF.push_keepalive * 1000)
+        while True:
+            events, after, overrun = feed.wait(after, CONF.push_keepalive)
+            if overrun:
+                yield 'event: overrun\ndata: {}\n\n'
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            sent = 0
+            for seq, document, data in events:
+                if match_query(query, document):
+                    yield 'id: %d\ndata: %s\n\n' % (seq, data)
+                    sent += 1
+            feed.sent(sent)
+    finally:
+        feed.leave()
+
+
+# Long-poll for alerts, for consoles that can't use server-sent events
+@app.route('/alerta/api/v2/alerts/poll', methods=['GET'])
+@jsonp
+def poll():
+
+    try:
+        query = parse_push(request)
+        after = request.args.get('after', feed.seq, int)
+    except Exception, e:
+        return jsonify(response={"status": "error", "message": str(e)})
+
+    try:
+        joined = feed.join()
+    except Exception, e:
+        LOG.error('Could not subscribe to alerts for push clients: %s', e)
+        return jsonify(response={"status": "error", "message": "could not subscribe to alerts"}), 503
+    if not joined:
+        return jsonify(response={"status": "error", "message": "too many clients"}), 503
+    try:
+        events, last, overrun = feed.wait(after, CONF.push_timeout)
+    finally:
+        feed.leave()
+
+    matched = [data for seq, document, data in events if match_query(query, document)]
+    feed.sent(len(matched))
+
+    response = {
+        "status": "ok",
+        "total": len(matched),
+        "last": last,
+        "overrun": overrun,
+        "autoRefresh": Switch.get('auto-refresh-allow').is_on(),
+    }
+
+    # alerts are serialized once when they are received
+    content = '{"response": {"alerts": {"alertDetails": [%s]}, %s}' % (', '.join(matched), json.dumps(response)[1:])
+    return current_app.response_class(content, mimetype='application/json')
+
 # Return severity and status counts
 @app.route('/alerta/api/v2/alerts/counts', methods=['GET'])
 @jsonp
@@ -239,9 +492,9 @@ def get_counts():
     except Exception, e:
         return jsonify(response={"status": "error", "message": str(e)})
 
-    found, severity_count, status_count = db.get_counts(query=query)
+    found, severity_count, status_count = counts.get(query, db.get_counts, key=without_request_time(query, query_time))
 
-    return jsonify(response={
+    response = jsonify(response={
         "alerts": {
             "alertDetails": [],
             "severityCounts": severity_count,
@@ -253,6 +506,8 @@ def get_counts():
         "more": False,
         "autoRefresh": Switch.get('auto-refresh-allow').is_on(),
     })
+    response.headers['X-Alerta-Query-Plan'] = planner.plan(query)
+    return response
 
 
 @app.route('/pagerduty', methods=['POST'])
@@ -320,8 +575,7 @@ def pagerduty():
         # Forward alert to notify topic and logger queue
         if pdAlert:
             pdAlert.origin = 'pagerduty/webhook'
-            mq.send(pdAlert, CONF.outbound_queue)
-            mq.send(pdAlert, CONF.outbound_topic)
+            mq.send(pdAlert, [CONF.outbound_queue, CONF.outbound_topic])
             LOG.info('%s : Alert forwarded to %s and %s', pdAlert.get_id(), CONF.outbound_queue, CONF.outbound_topic)
 
     return jsonify(response={"status": "ok"})
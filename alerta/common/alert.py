@@ -1,9 +1,10 @@
 import os
 import sys
+import time
 import datetime
 import json
 from uuid import uuid4
-import re
+import re       # parsers are exec'd with the globals of this module, so can use re, fnmatch and yaml
 import fnmatch
 
 import yaml
@@ -11,6 +12,7 @@ import yaml
 from alerta.common import log as logging
 from alerta.common import config
 from alerta.common import status_code, severity_code
+from alerta.common.transform import Transformer
 from alerta.common.utils import DateEncoder, isfloat
 
 
@@ -56,10 +58,17 @@ prog = os.path.basename(sys.argv[0])
 
 class Alert(object):
 
+    __slots__ = ['resource', 'event', 'correlate', 'group', 'value', 'status', 'severity', 'previous_severity',
+                 'environment', 'service', 'text', 'event_type', 'tags', 'origin', 'repeat', 'duplicate_count',
+                 'threshold_info', 'summary', 'timeout', 'alertid', 'last_receive_id', 'create_time', 'expire_time',
+                 'receive_time', 'last_receive_time', 'trend_indication', 'raw_data', 'more_info', 'graph_urls',
+                 'history']
+
     alert_opts = {
         'yaml_config': '/etc/alerta/%s.yaml' % prog,
         'parser_dir': '/etc/alerta/parsers',
     }
+    _registered = False
 
     def __init__(self, resource, event, correlate=None, group=None, value=None, status=status_code.UNKNOWN,
                  severity=severity_code.NORMAL, previous_severity=severity_code.UNKNOWN, environment=None, service=None,
@@ -68,9 +77,9 @@ class Alert(object):
                  create_time=None, expire_time=None, receive_time=None, last_receive_time=None, trend_indication=None,
                  raw_data=None, more_info=None, graph_urls=None, history=None):
 
-        config.register_opts(Alert.alert_opts)
-
-        prog = os.path.basename(sys.argv[0])
+        if not Alert._registered:
+            config.register_opts(Alert.alert_opts)
+            Alert._registered = True
 
         if not resource:
             raise ValueError('Missing mandatory value for resource')
@@ -120,6 +129,61 @@ class Alert(object):
         if history:
             self.history = history
 
+    @classmethod
+    def from_document(cls, document):
+        """
+        Create an alert from a stored alert document. Values are used as they are, nothing is
+        validated or derived.
+        """
+        alert = cls.__new__(cls)
+
+        alert.alertid = document['_id']
+        alert.resource = document['resource']
+        alert.event = document['event']
+        alert.correlate = document.get('correlatedEvents')
+        alert.group = document.get('group')
+        alert.value = document.get('value')
+        alert.status = document.get('status')
+        alert.severity = document.get('severity')
+        alert.previous_severity = document.get('previousSeverity')
+        alert.environment = document.get('environment')
+        alert.service = document.get('service')
+        alert.text = document.get('text')
+        alert.event_type = document.get('type')
+        alert.tags = document.get('tags')
+        alert.origin = document.get('origin')
+        alert.repeat = document.get('repeat')
+        alert.duplicate_count = document.get('duplicateCount')
+        alert.threshold_info = document.get('thresholdInfo')
+        alert.summary = document.get('summary')
+        alert.timeout = document.get('timeout')
+        alert.last_receive_id = document.get('lastReceiveId') or alert.alertid
+        alert.create_time = document.get('createTime')
+        alert.expire_time = document.get('expireTime')
+        alert.raw_data = document.get('rawData')
+        alert.more_info = document.get('moreInfo')
+        alert.graph_urls = document.get('graphUrls')
+
+        if document.get('receiveTime'):
+            alert.receive_time = document['receiveTime']
+        if document.get('lastReceiveTime'):
+            alert.last_receive_time = document['lastReceiveTime']
+        if document.get('trendIndication'):
+            alert.trend_indication = document['trendIndication']
+        if document.get('history'):
+            alert.history = document['history']
+
+        return alert
+
+    def __getstate__(self):
+
+        return dict((k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k))
+
+    def __setstate__(self, state):
+
+        for k, v in state.iteritems():
+            setattr(self, k, v)
+
     def get_id(self, short=False):
         if short:
             return self.alertid.split('-')[0]
@@ -205,14 +269,23 @@ class Alert(object):
     @staticmethod
     def parse_alert(alert):
 
-        try:
-            alert = json.loads(alert)
-        except ValueError, e:
-            LOG.error('Could not parse alert - %s: %s', e, alert)
-            raise
+        if isinstance(alert, basestring):
+            try:
+                alert = json.loads(alert)
+            except ValueError, e:
+                LOG.error('Could not parse alert - %s: %s', e, alert)
+                raise
+        if not isinstance(alert, dict):
+            raise ValueError('Alert must be a JSON object')
+
+        for k in ['severity', 'previousSeverity', 'status']:
+            if k in alert and not isinstance(alert[k], basestring):
+                raise ValueError('%s must be a string' % k)
 
         for k, v in alert.iteritems():
             if k in ['createTime', 'receiveTime', 'lastReceiveTime', 'expireTime']:
+                if not isinstance(v, basestring):
+                    raise ValueError('%s must be a date time string' % k)
                 try:
                     alert[k] = datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%fZ')
                 except ValueError, e:
@@ -255,92 +328,78 @@ class Alert(object):
 
         LOG.info('Transform alert %s using %s', self.get_id(), CONF.yaml_config)
 
-        if not os.path.exists(CONF.yaml_config):
+        transformer = Transformer.get_transformer(CONF.yaml_config, CONF.parser_dir)
+        if not transformer.load():
             return
 
         suppress = False
 
-        try:
-            conf = yaml.load(open(CONF.yaml_config))
-            LOG.info('Loaded %d transformer configurations OK', len(conf))
-        except Exception, e:
-            LOG.error('Failed to load transformer configuration %s: %s', CONF.yaml_config, e)
-            raise RuntimeError
-
-        for c in conf:
+        for rule, pattern in transformer.matches(self, trapoid, facility, level):
+            c = rule.conf
             LOG.debug('YAML config: %s', c)
-
-            match = None
-            pattern = None
-
-            if self.get_type() == 'snmptrapAlert' and trapoid and c.get('trapoid'):
-                match = re.match(c['trapoid'], trapoid)
-                pattern = trapoid
-            elif self.get_type() == 'syslogAlert' and facility and level and c.get('priority'):
-                match = fnmatch.fnmatch('%s.%s' % (facility, level), c['priority'])
-                pattern = c['priority']
-            elif c.get('match'):
+            LOG.debug('Matched %s for %s', pattern, self.get_type())
+
+            # 1. Simple substitutions
+            if 'event' in c:
+                self.event = c['event']
+            if 'resource' in c:
+                self.resource = c['resource']
+            if 'severity' in c:
+                self.severity = c['severity']
+            if 'group' in c:
+                self.group = c['group']
+            if 'value' in c:
+                self.value = c['value']
+            if 'text' in c:
+                self.text = c['text']
+            if 'environment' in c:
+                self.environment = c['environment']
+            if 'service' in c:
+                self.service = c['service']
+            if 'tags' in c:
+                self.tags.update(c['tags'])  # merge tags
+            if 'correlate' in c:
+                self.correlate = c['correlate']
+            if 'threshold_info' in c:
+                self.threshold_info = c['threshold_info']
+            if 'summary' in c:
+                self.summary = c['summary']
+            if 'timeout' in c:
+                self.timeout = c['timeout']
+
+            # 2. Complex transformations
+            if 'parser' in c:
+                LOG.debug('Loading parser %s', c['parser'])
+
+                context = kwargs
+                context.update(self.__getstate__())
+
+                start = time.time()
                 try:
-                    match = all(item in self.__dict__.items() for item in c['match'].items())
-                    pattern = c['match'].items()
-                except AttributeError:
-                    pass
-
-            if match:
-                LOG.debug('Matched %s for %s', pattern, self.get_type())
-
-                # 1. Simple substitutions
-                if 'event' in c:
-                    self.event = c['event']
-                if 'resource' in c:
-                    self.resource = c['resource']
-                if 'severity' in c:
-                    self.severity = c['severity']
-                if 'group' in c:
-                    self.group = c['group']
-                if 'value' in c:
-                    self.value = c['value']
-                if 'text' in c:
-                    self.text = c['text']
-                if 'environment' in c:
-                    self.environment = c['environment']
-                if 'service' in c:
-                    self.service = c['service']
-                if 'tags' in c:
-                    self.tags.update(c['tags'])  # merge tags
-                if 'correlate' in c:
-                    self.correlate = c['correlate']
-                if 'threshold_info' in c:
-                    self.threshold_info = c['threshold_info']
-                if 'summary' in c:
-                    self.summary = c['summary']
-                if 'timeout' in c:
-                    self.timeout = c['timeout']
-
-                # 2. Complex transformations
-                if 'parser' in c:
-                    LOG.debug('Loading parser %s', c['parser'])
-
-                    context = kwargs
-                    context.update(self.__dict__)
-
-                    try:
-                        exec(open('%s/%s.py' % (CONF.parser_dir, c['parser']))) in globals(), context
-                        LOG.info('Parser %s/%s exec OK', CONF.parser_dir, c['parser'])
-                    except Exception, e:
-                        LOG.warning('Parser %s failed: %s', c['parser'], e)
-                        raise RuntimeError
-
-                    for k, v in context.iteritems():
-                        if hasattr(self, k):
-                            setattr(self, k, v)
-
-                    if 'suppress' in context:
-                        suppress = context['suppress']
-
-                # 3. Suppress based on results of 1 or 2
-                if 'suppress' in c:
-                    suppress = suppress or c['suppress']
+                    exec transformer.parser(c['parser']) in globals(), context
+                    LOG.info('Parser %s/%s exec OK', CONF.parser_dir, c['parser'])
+                except Exception, e:
+                    LOG.warning('Parser %s failed: %s', c['parser'], e)
+                    raise RuntimeError
+                finally:
+                    rule.stats.parsed(time.time() - start)
+
+                for k in self.__slots__:
+                    if k in context:  # parsers can use any names, eg. of methods, but only attributes are set
+                        setattr(self, k, context[k])
+
+                if 'suppress' in context:
+                    suppress = context['suppress']
+                    if suppress:
+                        rule.stats.suppressed()
+
+            # 3. Suppress based on results of 1 or 2
+            if 'suppress' in c:
+                if c['suppress'] and not ('parser' in c and context.get('suppress')):
+                    rule.stats.suppressed()
+                suppress = suppress or c['suppress']
+
+        transformer.report()
 
         return suppress
 
@@ -42,6 +42,7 @@ import atexit
 from alerta.common import log as logging
 from alerta.common import config
 
+import signal
 from signal import SIGTERM
 
 _DEFAULT_WAIT_ON_DISABLE = 120  # number of seconds to idle before checking disable flag again
@@ -85,6 +86,8 @@ class Daemon:
         self.running = False
         self.shuttingdown = False
 
+        self.children = dict()
+
     def daemonize(self):
         """
         do the UNIX double-fork magic, see Stevens' "Advanced
@@ -229,6 +232,46 @@ class Daemon:
     def getpid(self):
         return self.pid
 
+    def start_child(self, name, factory):
+        """
+        Start a child process returned by factory(), eg. a multiprocessing.Process, and supervise it.
+        The factory is kept so that a crashed child can be replaced with a new process.
+        """
+        child = factory()
+        child.start()
+        self.children[name] = (factory, child)
+        LOG.info('Started child process %s with pid %s', name, child.pid)
+
+        # stop() sends SIGTERM to the parent, which must shut down its children cleanly
+        signal.signal(SIGTERM, self.handle_sigterm)
+
+    def supervise_children(self):
+        """
+        Restart any child processes that have exited unexpectedly. Returns the number of restarts.
+        """
+        restarts = 0
+        for name, (factory, child) in self.children.items():
+            if self.shuttingdown or child.is_alive():
+                continue
+            LOG.error('Child process %s with pid %s exited with code %s, restarting...', name, child.pid,
+                      child.exitcode)
+            self.start_child(name, factory)
+            restarts += 1
+        return restarts
+
+    def stop_children(self, timeout=None):
+
+        for name, (factory, child) in self.children.items():
+            child.join(timeout)
+            if child.is_alive():
+                LOG.warning('Child process %s with pid %s did not stop, terminating...', name, child.pid)
+                child.terminate()
+            LOG.info('Child process %s stopped.', name)
+
+    def handle_sigterm(self, signum, frame):
+        LOG.info('Received SIGTERM, shutting down...')
+        self.shuttingdown = True
+
     def run(self):
         """
         You should override this method when you subclass Daemon. It will be called after the process has been
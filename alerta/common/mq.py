@@ -1,10 +1,15 @@
 
 import json
+import time
+import threading
+import Queue
+
 import stomp
 from stomp import exception, ConnectionListener
 
 from alerta.common import log as logging
 from alerta.common import config
+from alerta.common.spool import Spool
 from alerta.common.utils import DateEncoder
 
 LOG = logging.getLogger('stomp.py')
@@ -15,6 +20,8 @@ _RECONNECT_SLEEP_INCREASE = 2
 _RECONNECT_SLEEP_MAX = 300    # seconds
 _RECONNECT_ATTEMPTS_MAX = 20
 
+_RECEIPT_TIMEOUT = 10  # seconds
+
 
 class Messaging(object):
 
@@ -32,14 +39,45 @@ class Messaging(object):
         'rabbit_userid': 'guest',
         'rabbit_password': 'guest',
         'rabbit_virtual_host': '/',
-    }
 
-    def __init__(self):
+        'send_buffer_size': 0,        # max messages waiting to be sent, 0 sends synchronously
+        'send_batch_size': 100,       # max messages sent between receipts
+        'send_flush_interval': 100,   # ms
+
+        'inbound_ack': 'auto',        # auto or client-individual, to ack inbound messages once processed
+        'inbound_prefetch': 100,      # max unacknowledged inbound messages if not auto ack
 
+        'send_spool': 'no',           # spool messages to disk if the broker is unavailable
+    }
+
+    def __init__(self, publish=True):
+        """
+        Set publish to False for a connection that only subscribes and so needs no send buffer or spool.
+        """
         config.register_opts(Messaging.mq_opts)
 
         logging.setup('stomp.py')
 
+        self.conn = None
+        self.sent = 0
+        self.dropped = 0
+
+        self.subscription = None
+        self.unacked = dict()  # message-id -> size of messages delivered but not acked
+        self.lock = threading.Lock()
+
+        if publish and CONF.send_buffer_size:
+            self.publisher = Publisher(self, CONF.send_buffer_size, CONF.send_batch_size, CONF.send_flush_interval)
+            self.publisher.start()
+        else:
+            self.publisher = None
+
+        if publish and CONF.send_spool:
+            self.spool = Spool('mq')
+            self.spool.start_replay(self.deliver)
+        else:
+            self.spool = None
+
     def connect(self, callback=None, wait=False):
         self.callback = callback
         self.wait = wait
@@ -53,6 +91,8 @@ class Messaging(object):
             )
             if self.callback:
                 self.conn.set_listener('', self.callback)
+            if self.publisher:
+                self.conn.set_listener('publisher', self.publisher.listener)
             self.conn.start()
             self.conn.connect(wait=self.wait)
         except Exception, e:
@@ -73,6 +113,8 @@ class Messaging(object):
             )
             if self.callback:
                 self.conn.set_listener('', self.callback)
+            if self.publisher:
+                self.conn.set_listener('publisher', self.publisher.listener)
             self.conn.start()
             self.conn.connect(wait=self.wait)
         except Exception, e:
@@ -81,28 +123,170 @@ class Messaging(object):
 
         LOG.info('Reconnected to broker %s:%s', CONF.stomp_host, CONF.stomp_port)
 
-    def subscribe(self, destination=None, ack='auto'):
+        # unacked messages are redelivered by the broker on the new subscription
+        with self.lock:
+            self.unacked.clear()
+        if self.subscription:
+            self.subscribe(*self.subscription)
 
+    def subscribe(self, destination=None, ack='auto'):
+        """
+        Subscribe to a destination. Unless ack is auto, the broker delivers at most inbound_prefetch
+        messages that have not been acked with ack().
+        """
         self.destination = destination or CONF.inbound_queue
-        self.conn.subscribe(destination=self.destination, ack=ack)
+        self.subscription = (self.destination, ack)
+
+        headers = dict()
+        if ack != 'auto' and CONF.inbound_prefetch:
+            headers['prefetch-count'] = CONF.inbound_prefetch          # RabbitMQ
+            headers['activemq.prefetchSize'] = CONF.inbound_prefetch   # ActiveMQ
+
+        LOG.info('Subscribe to %s with %s ack', self.destination, ack)
+        self.conn.subscribe(destination=self.destination, ack=ack, headers=headers)
+
+    def received(self, headers, body):
+        """
+        Track a delivered message until it is acked. Returns the message-id to ack or None for auto ack.
+        """
+        if not self.client_ack() or 'message-id' not in headers:
+            return
+
+        with self.lock:
+            self.unacked[headers['message-id']] = len(body)
+        return headers['message-id']
+
+    def client_ack(self):
+
+        return self.subscription is not None and self.subscription[1] != 'auto'
+
+    def ack(self, message_id):
+
+        if not message_id:
+            return
+
+        with self.lock:
+            if self.unacked.pop(message_id, None) is None:
+                return  # delivered before a reconnect, will be redelivered
+
+        try:
+            self.conn.ack(id=message_id)
+        except exception.NotConnectedException, e:
+            LOG.error('Could not ack message %s to broker %s:%s : %s', message_id, CONF.stomp_host,
+                      CONF.stomp_port, e)
 
     def send(self, msg, destination=None):
+        """
+        Send a message to one or more destinations. The message is serialized once and, if a
+        send buffer is configured, queued for the publisher thread.
+        """
+        destinations = destination if isinstance(destination, list) else [destination or CONF.inbound_queue]
+        self.destination = destinations[-1]
 
-        self.destination = destination or CONF.inbound_queue
+        body = json.dumps(msg.get_body(), cls=DateEncoder)
+        headers = msg.get_header()
+
+        for destination in destinations:
+            LOG.debug('Send %s %s to %s', msg.get_type(), msg.get_id(), destination)
+            if self.publisher:
+                self.publisher.put((destination, body, headers))
+            else:
+                self.send_frame(destination, body, headers)
+
+    def send_frame(self, destination, body, headers, **keyword_headers):
 
-        LOG.debug('header = %s', msg.get_header())
-        LOG.debug('message = %s', msg.get_body())
+        # messages are spooled until the spool has been replayed so they are sent in order
+        if self.spool is not None and len(self.spool):
+            return self.spool_frame(destination, body, headers)
 
-        LOG.info('Send %s %s to %s', msg.get_type(), msg.get_id(), self.destination)
         try:
-            self.conn.send(destination=self.destination, body=json.dumps(msg.get_body(), cls=DateEncoder),
-                           headers=msg.get_header())
+            self.conn.send(destination=destination, body=body, headers=headers, **keyword_headers)
         except exception.NotConnectedException, e:
             LOG.error('Could not send message to broker %s:%s : %s', CONF.stomp_host, CONF.stomp_port, e)
-            return
-        LOG.info('Message sent to broker %s:%s', CONF.stomp_host, CONF.stomp_port)
+            if self.spool is not None:
+                return self.spool_frame(destination, body, headers)
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def spool_frame(self, destination, body, headers):
+
+        if not self.spool.put({"destination": destination, "body": body, "headers": headers}):
+            self.dropped += 1
+        return False
+
+    def deliver(self, record):
+        """
+        Send a spooled message. Returns False if the broker is still unavailable.
+        """
+        if not self.conn or not self.is_connected():
+            return False
+        try:
+            self.conn.send(destination=record['destination'], body=record['body'], headers=record['headers'])
+        except exception.NotConnectedException:
+            return False
+        self.sent += 1
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until buffered messages have been sent. Returns False on timeout.
+        """
+        if self.publisher:
+            return self.publisher.flush(timeout)
+        return True
+
+    def get_stats(self):
+
+        stats = {
+            'sent': self.sent,
+            'dropped': self.dropped,
+        }
+        if self.client_ack():
+            with self.lock:
+                stats['inFlight'] = len(self.unacked)
+                stats['inFlightBytes'] = sum(self.unacked.itervalues())
+        if self.publisher:
+            stats.update(self.publisher.get_stats())
+        if self.spool is not None:
+            stats.update(self.spool.get_stats())
+        return stats
+
+    def send_batch(self, msgs, destination=None):
+        """
+        Send messages to the same destination in one transaction. Returns the number of messages sent.
+        """
+        self.destination = destination or CONF.inbound_queue
+
+        if not msgs:
+            return 0
+
+        LOG.info('Send batch of %d messages to %s', len(msgs), self.destination)
+        try:
+            transaction = self.conn.begin()
+            for msg in msgs:
+                LOG.debug('Send %s %s to %s', msg.get_type(), msg.get_id(), self.destination)
+                headers = msg.get_header()
+                headers['transaction'] = transaction
+                self.conn.send(destination=self.destination, body=json.dumps(msg.get_body(), cls=DateEncoder),
+                               headers=headers)
+            self.conn.commit(transaction=transaction)
+        except exception.NotConnectedException, e:
+            LOG.error('Could not send messages to broker %s:%s : %s', CONF.stomp_host, CONF.stomp_port, e)
+            self.dropped += len(msgs)
+            return 0
+        self.sent += len(msgs)
+        LOG.info('%d messages sent to broker %s:%s', len(msgs), CONF.stomp_host, CONF.stomp_port)
+
+        return len(msgs)
 
     def disconnect(self):
+        if self.publisher:
+            self.publisher.flush(_RECEIPT_TIMEOUT)
+            self.publisher.shutdown()
+        if self.spool is not None:
+            self.spool.close()
         if self.is_connected():
             LOG.info('Disconnecting from broker %s:%s', CONF.stomp_host, CONF.stomp_port)
             self.conn.disconnect()
@@ -112,6 +296,164 @@ class Messaging(object):
         return self.conn.is_connected()
 
 
+class Publisher(threading.Thread):
+    """
+    Sends messages queued by Messaging.send() on a separate thread. Messages are sent in batches
+    of up to batch_size and the last message of each batch asks for a receipt, which is waited for
+    before the next batch is sent. If the broker is slow the buffer fills and Messaging.send()
+    blocks until there is room. Messages that fail to send are spooled if there is a spool, or
+    dropped, and the thread carries on with the next batch.
+    """
+
+    def __init__(self, mq, size, batch_size, interval):
+
+        threading.Thread.__init__(self, name='Publisher')
+        self.daemon = True
+
+        self.mq = mq
+        self.queue = Queue.Queue(size)
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval / 1000.0
+
+        self.listener = ReceiptListener()
+        self.receipt = 0
+        self.shuttingdown = False
+
+        self.batches = 0
+        self.blocked = 0
+        self.receipt_time = 0.0
+        self.receipt_timeouts = 0
+        self.errors = 0
+
+    def put(self, frame):
+
+        try:
+            self.queue.put_nowait(frame)
+        except Queue.Full:
+            self.blocked += 1
+            self.queue.put(frame)
+
+    def get_batch(self):
+
+        try:
+            batch = [self.queue.get(True, self.interval)]
+        except Queue.Empty:
+            return list()
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+
+        while not self.shuttingdown:
+            batch = self.get_batch()
+            if not batch:
+                continue
+
+            try:
+                self.send_batch(batch)
+            except Exception, e:
+                LOG.exception('Publisher failed to send batch of %d messages: %s', len(batch), e)
+                self.errors += 1
+            finally:
+                for frame in batch:
+                    self.queue.task_done()
+
+    def send_batch(self, batch):
+
+        self.receipt += 1
+        receipt = 'publisher-%d' % self.receipt
+        waiting = self.listener.expect(receipt)
+
+        try:
+            sent = True
+            for i, (destination, body, headers) in enumerate(batch):
+                keyword_headers = {'receipt': receipt} if i == len(batch) - 1 else dict()
+                try:
+                    sent = self.mq.send_frame(destination, body, headers, **keyword_headers) and sent
+                except Exception, e:
+                    LOG.error('Could not send message to broker %s:%s : %s', CONF.stomp_host, CONF.stomp_port, e)
+                    self.errors += 1
+                    self.spool(batch[i:])
+                    return
+
+            if sent:
+                start = time.time()
+                if not waiting.wait(_RECEIPT_TIMEOUT):
+                    LOG.warning('No receipt from broker %s:%s after %ss', CONF.stomp_host, CONF.stomp_port,
+                                _RECEIPT_TIMEOUT)
+                    self.receipt_timeouts += 1
+                self.receipt_time += time.time() - start
+            self.batches += 1
+        finally:
+            self.listener.forget(receipt)
+
+    def spool(self, frames):
+        """
+        Spool frames that could not be sent, or drop them if there is no spool.
+        """
+        for destination, body, headers in frames:
+            if self.mq.spool is not None:
+                self.mq.spool_frame(destination, body, headers)
+            else:
+                self.mq.dropped += 1
+
+    def flush(self, timeout=None):
+
+        deadline = time.time() + timeout if timeout else None
+        while self.queue.unfinished_tasks:
+            if deadline and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def shutdown(self):
+
+        self.shuttingdown = True
+
+    def get_stats(self):
+
+        return {
+            'buffered': self.queue.qsize(),
+            'batches': self.batches,
+            'blocked': self.blocked,
+            'receiptTime': int(self.receipt_time * 1000),  # ms
+            'receiptTimeouts': self.receipt_timeouts,
+            'errors': self.errors,
+        }
+
+
+class ReceiptListener(ConnectionListener):
+
+    def __init__(self):
+
+        self.waiting = dict()
+        self.lock = threading.Lock()
+
+    def expect(self, receipt):
+
+        with self.lock:
+            self.waiting[receipt] = threading.Event()
+            return self.waiting[receipt]
+
+    def forget(self, receipt):
+
+        with self.lock:
+            self.waiting.pop(receipt, None)
+
+    def on_receipt(self, headers, body):
+
+        with self.lock:
+            waiting = self.waiting.get(headers.get('receipt-id'))
+        if waiting:
+            waiting.set()
+
+
 class MessageHandler(ConnectionListener):
     """
     A generic message handler class.
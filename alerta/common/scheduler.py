@@ -0,0 +1,157 @@
+
+import time
+import heapq
+import random
+import hashlib
+import threading
+
+from alerta.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Schedules checks to run every period seconds, spread evenly across the period instead of all at
+    once. Each check is given a fixed phase in its period from a hash of its key, plus up to jitter
+    periods of random jitter every time it runs. Checks that are due at the same time run in order
+    of priority, highest first.
+
+    A check that is still queued or running when it is next due is skipped and counted as coalesced,
+    and runs missed because the scheduler fell more than a period behind are counted as skipped.
+
+    >>> scheduler = Scheduler(30, jitter=0.1)
+    >>> scheduler.add(('Production', 'router1'), item, period=60, priority=1)
+    >>> for key, item in scheduler.due():
+    >>>     queue.put(...)                      # worker calls scheduler.done(key) when finished
+    >>> time.sleep(scheduler.next_due() - time.time())
+    """
+
+    def __init__(self, period, jitter=0.0):
+
+        self.period = period
+        self.jitter = jitter
+
+        self.heap = list()     # (fire time, id, key)
+        self.entries = dict()  # key -> entry, an entry is only run by the heap item with its id
+        self.running = set()
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+        self.started = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.expired = 0
+        self.lag_max = 0
+        self.lag_total = 0
+        self.lag_count = 0
+
+    def _schedule(self, key, entry, due):
+
+        self.next_id += 1
+        entry['id'] = self.next_id
+        entry['due'] = due
+        fire = due + random.uniform(-self.jitter, self.jitter) * entry['period']
+        heapq.heappush(self.heap, (fire, entry['id'], key))
+
+    def add(self, key, item, period=None, priority=0):
+        """
+        Add a check, or replace the check with the same key without changing when it is due.
+        """
+        period = period or self.period
+        phase = int(hashlib.md5(repr(key)).hexdigest()[:8], 16) / float(0x100000000) * period
+
+        now = time.time()
+        due = now - now % period + phase
+        if due < now:
+            due += period
+
+        with self.lock:
+            entry = {'item': item, 'period': period, 'priority': priority}
+            self._schedule(key, entry, due)
+            self.entries[key] = entry
+
+    def remove(self, key):
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def keys(self):
+
+        with self.lock:
+            return self.entries.keys()
+
+    def due(self, now=None):
+        """
+        Returns a list of (key, item) for the checks that are due, highest priority first.
+        """
+        now = now or time.time()
+
+        checks = list()
+        coalesced = skipped = 0
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                fire, id, key = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if not entry or entry['id'] != id:
+                    continue  # removed or replaced
+
+                lag = now - fire
+                missed = int(lag // entry['period'])
+                if missed:
+                    LOG.debug('Check %s is %d seconds late, skipping %d missed runs', key, lag, missed)
+                    skipped += missed
+                self._schedule(key, entry, entry['due'] + (missed + 1) * entry['period'])
+
+                if key in self.running:
+                    LOG.debug('Check %s is still queued or running, skipping it', key)
+                    coalesced += 1
+                    continue
+                self.running.add(key)
+
+                self.started += 1
+                self.lag_max = max(self.lag_max, lag)
+                self.lag_total += lag
+                self.lag_count += 1
+                checks.append((-entry['priority'], fire, key, entry['item']))
+
+            self.coalesced += coalesced
+            self.skipped += skipped
+
+        if coalesced or skipped:
+            LOG.warning('Skipped %d checks still queued or running and %d runs missed by falling behind',
+                        coalesced, skipped)
+
+        return [(key, item) for priority, fire, key, item in sorted(checks)]
+
+    def done(self, key, expired=False):
+        """
+        Called when a check has finished, or was dropped because it expired in the queue.
+        """
+        with self.lock:
+            self.running.discard(key)
+            if expired:
+                self.expired += 1
+
+    def next_due(self):
+
+        with self.lock:
+            return self.heap[0][0] if self.heap else time.time() + self.period
+
+    def get_stats(self):
+        """
+        Counts since the scheduler started, and the max and average lag since the last call.
+        """
+        with self.lock:
+            stats = {
+                'scheduled': len(self.entries),
+                'running': len(self.running),
+                'started': self.started,
+                'coalesced': self.coalesced,
+                'skipped': self.skipped,
+                'expired': self.expired,
+                'maxLag': self.lag_max,
+                'avgLag': self.lag_total / self.lag_count if self.lag_count else 0,
+            }
+            self.lag_max = self.lag_total = self.lag_count = 0
+        return stats
@@ -0,0 +1,324 @@
+
+import os
+import sys
+import json
+import time
+import threading
+import multiprocessing
+
+from alerta.common import log as logging
+from alerta.common import config
+from alerta.common.utils import DateEncoder
+
+LOG = logging.getLogger(__name__)
+CONF = config.CONF
+
+prog = os.path.basename(sys.argv[0])
+
+
+class Spool(object):
+    """
+    Disk-backed, append-only queue of JSON records used to keep messages that could not be
+    delivered. Records are appended to segment files and fsync'ed every spool_sync_every records
+    or spool_sync_interval milliseconds. Records are replayed in order, fully replayed segments
+    are deleted and the replay position is saved so a restart does not replay them again.
+
+    If the spool grows beyond spool_max_size the oldest segment is dropped.
+
+    Spools created in a child process, eg. a server process, are named after the process so
+    processes never share a spool directory.
+
+    >>> spool = Spool('mq')              # /var/spool/alerta/<prog>-mq/ or <prog>-<process>-mq/
+    >>> spool.put({"body": body})
+    >>> spool.start_replay(deliver)      # deliver(record) returns False to retry later
+    >>> spool.close()
+    """
+
+    spool_opts = {
+        'spool_dir': '/var/spool/alerta',
+        'spool_max_size': 100,          # MB
+        'spool_segment_size': 4,        # MB
+        'spool_sync_every': 100,        # records
+        'spool_sync_interval': 1000,    # ms
+        'spool_replay_rate': 100,       # max records replayed per second
+    }
+
+    def __init__(self, name, spool_dir=None):
+
+        config.register_opts(Spool.spool_opts)
+
+        spool_dir = spool_dir or CONF.spool_dir
+        process = multiprocessing.current_process().name
+        if process == 'MainProcess':
+            self.path = os.path.join(spool_dir, '%s-%s' % (prog, name))
+        else:
+            self.path = os.path.join(spool_dir, '%s-%s-%s' % (prog, process, name))
+
+        self.max_size = CONF.spool_max_size * 1024 * 1024
+        self.segment_size = CONF.spool_segment_size * 1024 * 1024
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.segments = sorted(int(f[:-4]) for f in os.listdir(self.path) if f.endswith('.seg'))
+        self.sizes = dict((s, os.path.getsize(self._segment_path(s))) for s in self.segments)
+        self.position = self._load_position()
+        self.count = self._count()
+
+        self.writer = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+        self.written = 0
+        self.replayed = 0
+        self.dropped = 0
+
+        self.replayer = None
+        self.lock = threading.Lock()
+
+        if self.count:
+            LOG.warning('Spool %s has %d records to replay', self.path, self.count)
+
+    def __len__(self):
+
+        return self.count
+
+    def _segment_path(self, segment):
+
+        return os.path.join(self.path, '%020d.seg' % segment)
+
+    def _load_position(self):
+
+        try:
+            with open(os.path.join(self.path, 'position')) as f:
+                segment, offset = json.load(f)
+        except (IOError, ValueError):
+            segment, offset = 0, 0
+
+        if self.segments and segment < self.segments[0]:
+            segment, offset = self.segments[0], 0
+
+        return segment, offset
+
+    def _save_position(self):
+
+        path = os.path.join(self.path, 'position')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.position, f)
+        os.rename(path + '.tmp', path)
+
+    def _count(self):
+
+        count = 0
+        for segment in self.segments:
+            if segment < self.position[0]:
+                continue
+            with open(self._segment_path(segment)) as f:
+                if segment == self.position[0]:
+                    f.seek(self.position[1])
+                for line in f:
+                    count += 1
+        return count
+
+    def _rotate(self):
+
+        if self.writer:
+            self._sync()
+            self.writer.close()
+
+        segment = self.segments[-1] + 1 if self.segments else 1
+        self.writer = open(self._segment_path(segment), 'ab')
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+
+    def _drop_oldest(self):
+
+        segment = self.segments.pop(0)
+        with open(self._segment_path(segment)) as f:
+            if segment == self.position[0]:
+                f.seek(self.position[1])
+            dropped = sum(1 for line in f)
+        if segment >= self.position[0]:
+            self.position = (self.segments[0], 0)
+
+        os.remove(self._segment_path(segment))
+        del self.sizes[segment]
+
+        self.count -= dropped
+        self.dropped += dropped
+        LOG.warning('Spool %s is full, dropped %d records', self.path, dropped)
+
+    def _sync(self):
+
+        if self.writer and self.unsynced:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.unsynced = 0
+        self.last_sync = time.time()
+
+    def size(self):
+
+        return sum(self.sizes.values())
+
+    def put(self, record):
+        """
+        Append a record to the spool. Returns False if the record was dropped.
+        """
+        line = json.dumps(record, cls=DateEncoder) + '\n'
+
+        with self.lock:
+            while self.size() + len(line) > self.max_size and len(self.segments) > 1:
+                self._drop_oldest()
+            if self.size() + len(line) > self.max_size:
+                LOG.warning('Spool %s is full, dropped record', self.path)
+                self.dropped += 1
+                return False
+
+            if not self.writer or self.sizes[self.segments[-1]] + len(line) > self.segment_size:
+                self._rotate()
+
+            self.writer.write(line)
+            self.sizes[self.segments[-1]] += len(line)
+            self.count += 1
+            self.written += 1
+
+            self.unsynced += 1
+            if self.unsynced >= CONF.spool_sync_every or \
+                    time.time() - self.last_sync >= CONF.spool_sync_interval / 1000.0:
+                self._sync()
+
+        return True
+
+    def sync(self):
+
+        with self.lock:
+            self._sync()
+
+    def _read(self, limit):
+
+        if self.writer:
+            self.writer.flush()
+
+        records = list()
+        segment, offset = self.position
+        for s in self.segments:
+            if s < segment:
+                continue
+            with open(self._segment_path(s)) as f:
+                f.seek(offset if s == segment else 0)
+                while len(records) < limit:
+                    line = f.readline()
+                    if not line.endswith('\n'):
+                        break  # end of segment or record still being written
+                    try:
+                        record = json.loads(line)
+                    except ValueError, e:
+                        LOG.error('Skipping corrupt record in spool %s: %s', self.path, e)
+                        record = None
+                    records.append(((s, f.tell()), record))
+            if len(records) >= limit:
+                break
+
+        return records
+
+    def _advance(self, position, count):
+
+        self.position = position
+        self.count -= count
+        self.replayed += count
+
+        # delete fully replayed segments, except the one being written
+        while self.segments and (self.segments[0] < position[0] or (self.segments[0] == position[0] and
+                self.sizes[self.segments[0]] == position[1] and self.segments[0] != self.segments[-1])):
+            segment = self.segments.pop(0)
+            os.remove(self._segment_path(segment))
+            del self.sizes[segment]
+            if segment == self.position[0]:
+                self.position = (self.segments[0], 0)
+
+        self._save_position()
+
+    def replay(self, deliver, limit):
+        """
+        Deliver up to limit records in order, stopping at the first record that is not delivered.
+        Returns the number of records replayed.
+        """
+        with self.lock:
+            if not self.count:
+                return 0
+            records = self._read(limit)
+
+        position = None
+        replayed = 0
+        for p, record in records:
+            if record is not None and not deliver(record):
+                break
+            position = p
+            replayed += 1
+
+        if replayed:
+            with self.lock:
+                self._advance(position, replayed)
+            LOG.info('Replayed %d records from spool %s, %d remaining', replayed, self.path, self.count)
+
+        return replayed
+
+    def start_replay(self, deliver):
+
+        self.replayer = SpoolReplayer(self, deliver, CONF.spool_replay_rate)
+        self.replayer.start()
+
+    def close(self):
+
+        if self.replayer:
+            self.replayer.shutdown()
+            self.replayer.join()
+
+        with self.lock:
+            if self.writer:
+                self._sync()
+                self.writer.close()
+                self.writer = None
+
+    def get_stats(self):
+
+        return {
+            'spooled': self.count,
+            'spoolBytes': self.size(),
+            'spoolWritten': self.written,
+            'spoolReplayed': self.replayed,
+            'spoolDropped': self.dropped,
+        }
+
+
+class SpoolReplayer(threading.Thread):
+    """
+    Replays spooled records at up to rate records per second and fsyncs the spool at least
+    every second.
+    """
+
+    def __init__(self, spool, deliver, rate):
+
+        threading.Thread.__init__(self, name='SpoolReplayer')
+        self.daemon = True
+
+        self.spool = spool
+        self.deliver = deliver
+        self.rate = max(rate, 1)
+
+        self.shuttingdown = threading.Event()
+
+    def run(self):
+
+        while not self.shuttingdown.is_set():
+            start = time.time()
+            self.spool.sync()
+            try:
+                self.spool.replay(self.deliver, self.rate)
+            except Exception, e:
+                LOG.error('Spool replay failed: %s', e)
+            self.shuttingdown.wait(max(1 - (time.time() - start), 0))
+
+    def shutdown(self):
+
+        self.shuttingdown.set()
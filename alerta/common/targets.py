@@ -0,0 +1,81 @@
+
+import os
+import time
+
+import yaml
+
+from alerta.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class TargetFile(object):
+    """
+    A YAML file of check targets that is reloaded when it changes. Parse turns the YAML into a dict
+    of target key to target, and each reload returns the targets that were added, removed or
+    modified since the last load, so that they can be applied to a running scheduler. If the file
+    can't be read or parsed the targets are left unchanged.
+
+    >>> targets = TargetFile('/etc/alerta/alert-pinger.targets', parse_targets)
+    >>> if targets.changed():
+    >>>     added, removed, modified = targets.reload()
+    """
+
+    def __init__(self, path, parse):
+
+        self.path = path
+        self.parse = parse
+
+        self.targets = dict()
+        self.stat = None
+
+        self.reloads = 0
+        self.errors = 0
+        self.last_reload = None  # {'reloadTime', 'added', 'removed', 'modified', 'total'}, None if it failed
+
+    def changed(self):
+
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if self.stat is not None:
+                LOG.error('Failed to stat %s: %s', self.path, e)
+            self.stat = None
+            return False
+        return (st.st_ino, st.st_size, st.st_mtime) != self.stat
+
+    def reload(self):
+        """
+        Returns a tuple of dicts (added, removed, modified) of the targets that changed, which are
+        all empty if the file could not be loaded.
+        """
+        start = time.time()
+        try:
+            st = os.stat(self.path)
+            self.stat = (st.st_ino, st.st_size, st.st_mtime)  # don't retry a bad file until it changes again
+            with open(self.path) as f:
+                targets = self.parse(yaml.safe_load(f) or list())
+        except Exception, e:
+            LOG.error('Failed to load targets from %s: %s', self.path, e)
+            self.errors += 1
+            self.last_reload = None
+            return dict(), dict(), dict()
+
+        added = dict((key, target) for key, target in targets.iteritems() if key not in self.targets)
+        removed = dict((key, target) for key, target in self.targets.iteritems() if key not in targets)
+        modified = dict((key, target) for key, target in targets.iteritems()
+                        if key in self.targets and self.targets[key] != target)
+        self.targets = targets
+
+        self.reloads += 1
+        self.last_reload = {
+            'reloadTime': int((time.time() - start) * 1000),  # ms
+            'added': len(added),
+            'removed': len(removed),
+            'modified': len(modified),
+            'total': len(targets),
+        }
+        LOG.info('Loaded %d targets from %s in %d ms: %d added, %d removed, %d modified', len(targets),
+                 self.path, self.last_reload['reloadTime'], len(added), len(removed), len(modified))
+
+        return added, removed, modified
@@ -0,0 +1,339 @@
+
+import os
+import re
+import sys
+import json
+import time
+import bisect
+import fnmatch
+import threading
+import multiprocessing
+
+from collections import deque
+
+import yaml
+
+from alerta.common import log as logging
+from alerta.common import config
+from alerta.common.graphite import StatsD
+
+LOG = logging.getLogger(__name__)
+CONF = config.CONF
+
+_SAMPLES = 1000  # evaluation times kept per rule for percentiles
+
+# most selective alert attributes are preferred for indexing match rules
+_INDEX_PREFERENCE = ['resource', 'event', 'origin', 'group', 'value', 'text']
+
+prog = os.path.basename(sys.argv[0])
+
+_MISSING = object()
+
+
+def _index_order(attribute):
+
+    if attribute in _INDEX_PREFERENCE:
+        return _INDEX_PREFERENCE.index(attribute), attribute
+    return len(_INDEX_PREFERENCE), attribute
+
+
+def _hashable(value):
+
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return _MISSING
+    return value
+
+
+class RuleStats(object):
+
+    def __init__(self):
+
+        self.evaluations = 0
+        self.matches = 0
+        self.suppressions = 0
+        self.total_time = 0.0
+        self.samples = deque(maxlen=_SAMPLES)
+        self.parser_count = 0
+        self.parser_time = 0.0
+
+        self.lock = threading.Lock()
+
+    def evaluated(self, elapsed, match):
+
+        with self.lock:
+            self.evaluations += 1
+            self.total_time += elapsed
+            self.samples.append(elapsed)
+            if match:
+                self.matches += 1
+
+    def parsed(self, elapsed):
+
+        with self.lock:
+            self.parser_count += 1
+            self.parser_time += elapsed
+
+    def suppressed(self):
+
+        with self.lock:
+            self.suppressions += 1
+
+    def p99(self):
+
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+
+
+class Rule(object):
+
+    def __init__(self, position, conf):
+
+        self.position = position
+        self.conf = conf
+        self.name = re.sub(r'[^\w-]', '_', str(conf.get('name') or 'rule%03d' % position))
+        self.stats = RuleStats()
+
+        self.trapoid = re.compile(conf['trapoid']) if conf.get('trapoid') else None
+        self.priority = re.compile(fnmatch.translate(conf['priority'])) if conf.get('priority') else None
+        self.match = conf['match'] if isinstance(conf.get('match'), dict) and conf['match'] else None
+
+    def __repr__(self):
+        return 'Rule(position=%r, conf=%r)' % (self.position, self.conf)
+
+
+class RuleSet(object):
+
+    def __init__(self, conf):
+
+        self.rules = [Rule(position, c) for position, c in enumerate(conf)]
+
+        self.trap_rules = list()      # positions of rules with trapoid
+        self.priority_rules = list()  # positions of rules with priority
+        self.index = dict()           # attribute -> value -> positions of match rules
+        self.unindexed = list()       # positions of match rules without a hashable value
+
+        for rule in self.rules:
+            if rule.trapoid:
+                self.trap_rules.append(rule.position)
+            if rule.priority:
+                self.priority_rules.append(rule.position)
+            if rule.match:
+                for attribute in sorted(rule.match, key=_index_order):
+                    value = _hashable(rule.match[attribute])
+                    if value is not _MISSING:
+                        self.index.setdefault(attribute, dict()).setdefault(value, list()).append(rule.position)
+                        break
+                else:
+                    self.unindexed.append(rule.position)
+
+    def __len__(self):
+
+        return len(self.rules)
+
+    def candidates(self, alert, trapoid=None, facility=None, level=None, after=-1):
+
+        positions = set(self.unindexed)
+        if alert.get_type() == 'snmptrapAlert' and trapoid:
+            positions.update(self.trap_rules)
+        elif alert.get_type() == 'syslogAlert' and facility and level:
+            positions.update(self.priority_rules)
+
+        for attribute, values in self.index.iteritems():
+            value = _hashable(getattr(alert, attribute, _MISSING))
+            if value is not _MISSING:
+                positions.update(values.get(value, list()))
+
+        positions = sorted(positions)
+        return positions[bisect.bisect_right(positions, after):]
+
+
+class Transformer(object):
+    """
+    Transform rules and parsers compiled once and reloaded when the file changes. Match rules are
+    indexed by the value of one attribute so only candidate rules are evaluated for an alert. Rules
+    are still applied in the order they appear in the file.
+
+    Every rule is profiled. If transform_profile is set, rule stats are written to transform_stats_dir
+    for "alertctl --rules" and sent to StatsD every transform_stats_every seconds. Stats are reset when
+    the rules are reloaded.
+
+    >>> transformer = Transformer.get_transformer(CONF.yaml_config, CONF.parser_dir)
+    >>> for rule, pattern in transformer.matches(alert, trapoid, facility, level):
+    >>>     exec transformer.parser(rule.conf['parser']) in globals(), context
+    >>> transformer.report()
+    """
+
+    transform_opts = {
+        'transform_profile': 'no',
+        'transform_stats_dir': '/var/lib/alerta',
+        'transform_stats_every': 60,  # seconds
+    }
+
+    _transformers = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, path, parser_dir):
+
+        config.register_opts(Transformer.transform_opts)
+
+        self.path = path
+        self.parser_dir = parser_dir
+
+        self.statsd = None
+        self.next_report = 0
+
+        self.mtime = None
+        self.ruleset = RuleSet(list())
+        self.parsers = dict()  # name -> (mtime, code)
+
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_transformer(cls, path, parser_dir):
+
+        with cls._lock:
+            if (path, parser_dir) not in cls._transformers:
+                cls._transformers[(path, parser_dir)] = cls(path, parser_dir)
+            return cls._transformers[(path, parser_dir)]
+
+    def load(self):
+        """
+        Reload rules if the config file has changed. Returns False if there is no config file.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+
+        if mtime == self.mtime:
+            return True
+
+        with self.lock:
+            if mtime == self.mtime:
+                return True
+
+            try:
+                with open(self.path) as f:
+                    self.ruleset = RuleSet(yaml.safe_load(f) or list())
+            except Exception, e:
+                LOG.error('Failed to load transformer configuration %s: %s', self.path, e)
+                raise RuntimeError
+            self.mtime = mtime
+
+        LOG.info('Loaded %d transformer configurations from %s OK', len(self.ruleset), self.path)
+        return True
+
+    def matches(self, alert, trapoid=None, facility=None, level=None):
+        """
+        Generate matching rules in order. A matched rule can change the alert so candidate rules
+        are found again after each match.
+        """
+        ruleset = self.ruleset
+        positions = ruleset.candidates(alert, trapoid, facility, level)
+
+        while positions:
+            rule = ruleset.rules[positions.pop(0)]
+
+            match = None
+            pattern = None
+            start = time.time()
+
+            if alert.get_type() == 'snmptrapAlert' and trapoid and rule.trapoid:
+                match = rule.trapoid.match(trapoid)
+                pattern = trapoid
+            elif alert.get_type() == 'syslogAlert' and facility and level and rule.priority:
+                match = rule.priority.match('%s.%s' % (facility, level))
+                pattern = rule.conf['priority']
+            elif rule.match:
+                match = all(getattr(alert, k, _MISSING) == v for k, v in rule.match.iteritems())
+                pattern = rule.match.items()
+
+            rule.stats.evaluated(time.time() - start, match)
+
+            if match:
+                yield rule, pattern
+                positions = ruleset.candidates(alert, trapoid, facility, level, after=rule.position)
+
+    def parser(self, name):
+        """
+        Returns compiled parser code, compiled again if the parser file has changed.
+        """
+        path = '%s/%s.py' % (self.parser_dir, name)
+        mtime = os.stat(path).st_mtime
+
+        cached = self.parsers.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(path) as f:
+            code = compile(f.read(), path, 'exec')
+        self.parsers[name] = (mtime, code)
+        LOG.info('Parser %s compiled OK', path)
+
+        return code
+
+    def stats(self):
+
+        stats = list()
+        for rule in self.ruleset.rules:
+            stats.append({
+                "position": rule.position,
+                "name": rule.name,
+                "rule": dict((k, v) for k, v in rule.conf.iteritems() if k in ['match', 'trapoid', 'priority', 'parser']),
+                "evaluations": rule.stats.evaluations,
+                "matches": rule.stats.matches,
+                "suppressions": rule.stats.suppressions,
+                "totalTime": rule.stats.total_time * 1000,  # ms
+                "p99Time": rule.stats.p99() * 1000,
+                "parserCount": rule.stats.parser_count,
+                "parserTime": rule.stats.parser_time * 1000,
+            })
+        return stats
+
+    def send_metrics(self, sender):
+        """
+        Send rule stats using Carbon or StatsD.
+        """
+        for rule in self.stats():
+            for metric in ['evaluations', 'matches', 'suppressions', 'totalTime', 'p99Time', 'parserCount',
+                           'parserTime']:
+                name = 'alerta.transform.%s.%s.%s' % (prog, rule['name'], metric)
+                if isinstance(sender, StatsD):
+                    sender.metric_send(name, rule[metric], 'g')
+                else:
+                    sender.metric_send(name, rule[metric])
+
+    def report(self):
+
+        if not CONF.transform_profile or time.time() < self.next_report:
+            return
+
+        with self.lock:
+            if time.time() < self.next_report:
+                return
+            self.next_report = time.time() + CONF.transform_stats_every
+
+        process = multiprocessing.current_process().name
+        if process == 'MainProcess':
+            filename = '%s.rules.json' % prog
+        else:
+            filename = '%s-%s.rules.json' % (prog, process)
+        path = os.path.join(CONF.transform_stats_dir, filename)
+
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({"config": self.path, "prog": prog, "time": time.time(), "rules": self.stats()}, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            LOG.warning('Failed to write transform rule stats to %s: %s', path, e)
+
+        if not self.statsd:
+            self.statsd = StatsD()
+        self.send_metrics(self.statsd)
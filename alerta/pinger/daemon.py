@@ -1,11 +1,11 @@
 
 import time
+import socket
 import subprocess
 import threading
 import Queue
 import re
-
-import yaml
+import functools
 
 from alerta.common import log as logging
 from alerta.common import config
@@ -16,6 +16,9 @@ from alerta.common.mq import Messaging, MessageHandler
 from alerta.common.daemon import Daemon
 from alerta.common.dedup import DeDup
 from alerta.common.graphite import Carbon
+from alerta.common.scheduler import Scheduler
+from alerta.common.targets import TargetFile
+from alerta.pinger.icmp import IcmpPinger, PING_OK, PING_FAILED, PING_ERROR
 
 Version = '2.1.0'
 
@@ -30,28 +33,27 @@ _PING_ALERTS = [
     'PingError',
 ]
 
-PING_OK = 0       # all ping replies received within timeout
-PING_FAILED = 1   # some or all ping replies not received or did not respond within timeout
-PING_ERROR = 2    # unspecified error with ping
-
-
 # Initialise Rules
-def init_targets():
-
-    targets = list()
-    LOG.info('Loading Ping targets...')
-    try:
-        targets = yaml.load(open(CONF.ping_file))
-    except Exception, e:
-        LOG.error('Failed to load Ping targets: %s', e)
-    LOG.info('Loaded %d Ping targets OK', len(targets))
+def parse_targets(ping_list):
+    """
+    Returns a dict of (environment, service, target) to the ping check and its interval and priority.
+    """
+    targets = dict()
+    for p in ping_list:
+        if 'targets' in p and p['targets']:
+            for target in p['targets']:
+                environment = p['environment']
+                service = p['service']
+                retries = p.get('retries', CONF.ping_max_retries)
+                targets[(environment, service, target)] = \
+                    ((environment, service, target, retries), p.get('interval'), p.get('priority', 0))
 
     return targets
 
 
 class WorkerThread(threading.Thread):
 
-    def __init__(self, mq, queue, dedup, carbon):
+    def __init__(self, mq, queue, dedup, carbon, scheduler):
 
         threading.Thread.__init__(self)
         LOG.debug('Initialising %s...', self.getName())
@@ -61,6 +63,7 @@ class WorkerThread(threading.Thread):
         self.mq = mq               # message broker
         self.dedup = dedup
         self.carbon = carbon  # graphite metrics
+        self.scheduler = scheduler
 
     def run(self):
 
@@ -76,6 +79,7 @@ class WorkerThread(threading.Thread):
 
             if time.time() - queue_time > CONF.loop_every:
                 LOG.warning('Ping request to %s expired after %d seconds.', resource, int(time.time() - queue_time))
+                self.scheduler.done((environment, service, resource), expired=True)
                 self.queue.task_done()
                 continue
 
@@ -91,80 +95,85 @@ class WorkerThread(threading.Thread):
                 self.queue.task_done()
                 continue
 
-            if rc == PING_OK:
-                avg, max = rtt
-                self.carbon.metric_send('alert.pinger.%s.avgRoundTrip' % resource, avg)
-                self.carbon.metric_send('alert.pinger.%s.maxRoundTrip' % resource, max)
-                self.carbon.metric_send('alert.pinger.%s.availability' % resource, 100.0)
-                if avg > CONF.ping_slow_critical:
-                    event = 'PingSlow'
-                    severity = severity_code.CRITICAL
-                    text = 'Node responded to ping in %s ms avg (> %s ms)' % (avg, CONF.ping_slow_critical)
-                elif avg > CONF.ping_slow_warning:
-                    event = 'PingSlow'
-                    severity = severity_code.WARNING
-                    text = 'Node responded to ping in %s ms avg (> %s ms)' % (avg, CONF.ping_slow_warning)
-                else:
-                    event = 'PingOK'
-                    severity = severity_code.NORMAL
-                    text = 'Node responding to ping avg/max %s/%s ms.' % tuple(rtt)
-                value = '%s/%s ms' % tuple(rtt)
-            elif rc == PING_FAILED:
-                event = 'PingFailed'
-                severity = severity_code.MAJOR
-                text = 'Node did not respond to ping or timed out within %s seconds' % CONF.ping_max_timeout
-                value = '%s%% packet loss' % loss
-                self.carbon.metric_send('alert.pinger.%s.availability' % resource, 100.0 - float(loss))
-            elif rc == PING_ERROR:
-                event = 'PingError'
-                severity = severity_code.WARNING
-                text = 'Could not ping node %s.' % resource
-                value = stdout
-                self.carbon.metric_send('alert.pinger.%s.availability' % resource, 0.0)
-            else:
-                LOG.warning('Unknown ping return code: %s', rc)
-                continue
-
-            # Defaults
-            resource += ':icmp'
-            group = 'Ping'
-            correlate = _PING_ALERTS
-            timeout = None
-            threshold_info = None
-            summary = None
-            raw_data = stdout
-
-            pingAlert = Alert(
-                resource=resource,
-                event=event,
-                correlate=correlate,
-                group=group,
-                value=value,
-                severity=severity,
-                environment=environment,
-                service=service,
-                text=text,
-                event_type='serviceAlert',
-                tags=None,
-                timeout=timeout,
-                threshold_info=threshold_info,
-                summary=summary,
-                raw_data=raw_data,
-            )
-
-            suppress = pingAlert.transform_alert()
-            if suppress:
-                LOG.info('Suppressing %s alert', pingAlert.event)
-                LOG.debug('%s', pingAlert)
-
-            elif self.dedup.is_send(pingAlert):
-                self.mq.send(pingAlert)
+            self.send_result(environment, service, resource, rc, rtt, loss, stdout)
+            self.scheduler.done((environment, service, resource))
 
             self.queue.task_done()
             LOG.info('%s ping %s complete.', self.getName(), resource)
 
         self.queue.task_done()
 
+    def send_result(self, environment, service, resource, rc, rtt, loss, stdout):
+
+        if rc == PING_OK:
+            avg, max = rtt
+            self.carbon.metric_send('alert.pinger.%s.avgRoundTrip' % resource, avg)
+            self.carbon.metric_send('alert.pinger.%s.maxRoundTrip' % resource, max)
+            self.carbon.metric_send('alert.pinger.%s.availability' % resource, 100.0)
+            if avg > CONF.ping_slow_critical:
+                event = 'PingSlow'
+                severity = severity_code.CRITICAL
+                text = 'Node responded to ping in %s ms avg (> %s ms)' % (avg, CONF.ping_slow_critical)
+            elif avg > CONF.ping_slow_warning:
+                event = 'PingSlow'
+                severity = severity_code.WARNING
+                text = 'Node responded to ping in %s ms avg (> %s ms)' % (avg, CONF.ping_slow_warning)
+            else:
+                event = 'PingOK'
+                severity = severity_code.NORMAL
+                text = 'Node responding to ping avg/max %s/%s ms.' % tuple(rtt)
+            value = '%s/%s ms' % tuple(rtt)
+        elif rc == PING_FAILED:
+            event = 'PingFailed'
+            severity = severity_code.MAJOR
+            text = 'Node did not respond to ping or timed out within %s seconds' % CONF.ping_max_timeout
+            value = '%s%% packet loss' % loss
+            self.carbon.metric_send('alert.pinger.%s.availability' % resource, 100.0 - float(loss))
+        elif rc == PING_ERROR:
+            event = 'PingError'
+            severity = severity_code.WARNING
+            text = 'Could not ping node %s.' % resource
+            value = stdout
+            self.carbon.metric_send('alert.pinger.%s.availability' % resource, 0.0)
+        else:
+            LOG.warning('Unknown ping return code: %s', rc)
+            return
+
+        # Defaults
+        resource += ':icmp'
+        group = 'Ping'
+        correlate = _PING_ALERTS
+        timeout = None
+        threshold_info = None
+        summary = None
+        raw_data = stdout
+
+        pingAlert = Alert(
+            resource=resource,
+            event=event,
+            correlate=correlate,
+            group=group,
+            value=value,
+            severity=severity,
+            environment=environment,
+            service=service,
+            text=text,
+            event_type='serviceAlert',
+            tags=None,
+            timeout=timeout,
+            threshold_info=threshold_info,
+            summary=summary,
+            raw_data=raw_data,
+        )
+
+        suppress = pingAlert.transform_alert()
+        if suppress:
+            LOG.info('Suppressing %s alert', pingAlert.event)
+            LOG.debug('%s', pingAlert)
+
+        elif self.dedup.is_send(pingAlert):
+            self.mq.send(pingAlert)
+
     @staticmethod
     def pinger(node, count=1, interval=1, timeout=5):
 
@@ -199,6 +208,74 @@ class WorkerThread(threading.Thread):
         return rc, rtt, loss, stdout
 
 
+class IcmpThread(WorkerThread):
+    """
+    Pings targets with the ICMP engine, instead of one ping command per target, so that one thread
+    has every due target in flight at once. Targets the engine can't ping are passed to the worker
+    threads.
+    """
+
+    def __init__(self, mq, queue, dedup, carbon, scheduler, engine, fallback):
+
+        WorkerThread.__init__(self, mq, queue, dedup, carbon, scheduler)
+
+        self.engine = engine
+        self.fallback = fallback  # worker thread queue
+
+    def run(self):
+
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                try:
+                    self.engine.poll(0.1)
+                except socket.error, e:
+                    LOG.error('ICMP engine error: %s', e)
+                continue
+
+            if not item:
+                LOG.info('%s is shutting down.', self.getName())
+                break
+
+            environment, service, resource, retries, queue_time = item
+
+            if time.time() - queue_time > CONF.loop_every:
+                LOG.warning('Ping request to %s expired after %d seconds.', resource, int(time.time() - queue_time))
+                self.scheduler.done((environment, service, resource), expired=True)
+            elif not self.engine.supports(resource):
+                self.fallback.put(item)
+            else:
+                try:
+                    if retries > 1:
+                        self.engine.submit(resource, functools.partial(self.on_result, item), count=2, timeout=5)
+                    else:
+                        self.engine.submit(resource, functools.partial(self.on_result, item), count=5,
+                                           timeout=CONF.ping_max_timeout)
+                except Exception, e:
+                    LOG.exception('Could not ping %s: %s', resource, e)
+                    self.scheduler.done((environment, service, resource))
+
+            self.queue.task_done()
+
+        self.queue.task_done()
+
+    def on_result(self, item, result):
+
+        environment, service, resource, retries, queue_time = item
+        rc, rtt, loss, stdout = result
+
+        if rc != PING_OK and retries:
+            LOG.info('Retrying ping %s %s more times', resource, retries)
+            self.queue.put((environment, service, resource, retries - 1, time.time()))
+            return
+
+        try:
+            self.send_result(environment, service, resource, rc, rtt, loss, stdout)
+        finally:
+            self.scheduler.done((environment, service, resource))
+
+
 class PingerMessage(MessageHandler):
 
     def __init__(self, mq):
@@ -217,6 +294,9 @@ class PingerDaemon(Daemon):
         'ping_max_retries': 2,
         'ping_slow_warning': 5,    # ms
         'ping_slow_critical': 10,  # ms
+        'ping_engine': 'icmp',     # icmp or subprocess
+        'schedule_jitter': 10,     # percent of loop_every
+        'reload_every': 10,        # seconds between checks for changes to ping_file, 0 to never reload
         'server_threads': 20,
     }
 
@@ -241,13 +321,29 @@ class PingerDaemon(Daemon):
 
         self.carbon = Carbon()  # graphite metrics
 
-        # Initialiase ping targets
-        ping_list = init_targets()
+        # Initialiase ping targets, spread across loop_every or the interval of each target
+        self.scheduler = Scheduler(CONF.loop_every, jitter=CONF.schedule_jitter / 100.0)
+        self.targets = TargetFile(CONF.ping_file, parse_targets)
+        self.reload_targets()
+
+        # Start ICMP engine, or fall back to ping commands if it has no ICMP socket
+        self.icmp_queue = None
+        if CONF.ping_engine == 'icmp':
+            try:
+                engine = IcmpPinger()
+            except socket.error, e:
+                LOG.warning('Could not open ICMP socket, using ping command: %s', e)
+            else:
+                self.icmp_queue = Queue.Queue()
+                icmp = IcmpThread(self.mq, self.icmp_queue, self.dedup, self.carbon, self.scheduler, engine,
+                                  self.queue)
+                icmp.start()
+                LOG.info('Started ICMP thread: %s', icmp.getName())
 
         # Start worker threads
         LOG.debug('Starting %s worker threads...', CONF.server_threads)
         for i in range(CONF.server_threads):
-            w = WorkerThread(self.mq, self.queue, self.dedup, self.carbon)
+            w = WorkerThread(self.mq, self.queue, self.dedup, self.carbon, self.scheduler)
             try:
                 w.start()
             except Exception, e:
@@ -255,23 +351,30 @@ class PingerDaemon(Daemon):
                 continue
             LOG.info('Started worker thread: %s', w.getName())
 
+        next_heartbeat = 0
+        next_reload = time.time() + CONF.reload_every if CONF.reload_every else float('inf')
         while not self.shuttingdown:
             try:
-                for p in ping_list:
-                    if 'targets' in p and p['targets']:
-                        for target in p['targets']:
-                            environment = p['environment']
-                            service = p['service']
-                            retries = p.get('retries', CONF.ping_max_retries)
-                            self.queue.put((environment, service, target, retries, time.time()))
-
-                LOG.debug('Send heartbeat...')
-                heartbeat = Heartbeat(version=Version)
-                self.mq.send(heartbeat)
-
-                time.sleep(CONF.loop_every)
-                LOG.info('Ping queue length is %d', self.queue.qsize())
-                self.carbon.metric_send('alert.pinger.queueLength', self.queue.qsize())
+                if time.time() >= next_reload:
+                    if self.targets.changed():
+                        self.reload_targets()
+                    next_reload = time.time() + CONF.reload_every if CONF.reload_every else float('inf')
+
+                for key, (environment, service, target, retries) in self.scheduler.due():
+                    (self.icmp_queue or self.queue).put((environment, service, target, retries, time.time()))
+
+                if time.time() >= next_heartbeat:
+                    LOG.debug('Send heartbeat...')
+                    heartbeat = Heartbeat(version=Version)
+                    self.mq.send(heartbeat)
+                    next_heartbeat = time.time() + CONF.loop_every
+
+                    LOG.info('Ping queue length is %d', self.queue.qsize())
+                    self.carbon.metric_send('alert.pinger.queueLength', self.queue.qsize())
+                    for name, value in self.scheduler.get_stats().iteritems():
+                        self.carbon.metric_send('alert.pinger.scheduler.%s' % name, value)
+
+                time.sleep(max(min(self.scheduler.next_due(), next_heartbeat, next_reload) - time.time(), 0))
 
             except (KeyboardInterrupt, SystemExit):
                 self.shuttingdown = True
@@ -279,9 +382,28 @@ class PingerDaemon(Daemon):
         LOG.info('Shutdown request received...')
         self.running = False
 
+        if self.icmp_queue:
+            self.icmp_queue.put(None)
+            icmp.join()
         for i in range(CONF.server_threads):
             self.queue.put(None)
         w.join()
 
         LOG.info('Disconnecting from message broker...')
         self.mq.disconnect()
+
+    def reload_targets(self):
+        """
+        Apply changes to the ping targets file to the scheduler. Checks in progress carry on and
+        modified targets keep their place in the schedule.
+        """
+        added, removed, modified = self.targets.reload()
+
+        for key in removed:
+            self.scheduler.remove(key)
+        for key, (item, period, priority) in added.items() + modified.items():
+            self.scheduler.add(key, item, period=period, priority=priority)
+
+        if self.targets.last_reload:
+            for name, value in self.targets.last_reload.iteritems():
+                self.carbon.metric_send('alert.pinger.targets.%s' % name, value)
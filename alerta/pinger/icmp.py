@@ -0,0 +1,301 @@
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import socket
+import struct
+import threading
+import functools
+import Queue
+
+from alerta.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+PING_OK = 0       # all ping replies received within timeout
+PING_FAILED = 1   # some or all ping replies not received or did not respond within timeout
+PING_ERROR = 2    # unspecified error with ping
+
+_ICMP_ECHO_REQUEST = 8
+_ICMP_ECHO_REPLY = 0
+
+_PAYLOAD = 'alerta-pinger'.ljust(48, '.')  # 56 data bytes with the timestamp, like ping
+
+_RESOLVE_TTL = 300  # seconds host addresses are cached
+
+_SO_TIMESTAMP = 29     # Linux, timestamp packets as they are received
+_SIOCGSTAMP = 0x8906   # Linux, get the timestamp of the last packet read
+
+
+def checksum(data):
+
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpPinger(object):
+    """
+    Pings many hosts concurrently from one ICMP socket. Hosts are submitted at any time and every
+    reply is matched to its host by sequence number, so one thread calling poll() can ping thousands
+    of hosts in the time it takes to ping one. Host names are resolved by resolver threads and
+    callbacks are only called once every waiting reply has been read, so neither delays replies
+    to other hosts. Not thread-safe.
+
+    Needs a raw socket (root or CAP_NET_RAW) or, on Linux, an unprivileged ICMP socket allowed by
+    net.ipv4.ping_group_range. Raises socket.error if neither can be opened.
+
+    >>> pinger = IcmpPinger()
+    >>> pinger.submit('router1', callback, count=5, interval=1, timeout=15)
+    >>> while True:
+    >>>     pinger.poll(1)     # callback((0, (0.512, 0.634), '0', '5 packets transmitted, 5 received, ...'))
+    """
+
+    def __init__(self, resolvers=2):
+
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname('icmp'))
+            self.raw = True
+        except socket.error:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.getprotobyname('icmp'))
+            self.raw = False
+        self.sock.setblocking(0)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMP, 1)
+        except socket.error:
+            pass  # replies are timed when they are read
+
+        self.ident = os.getpid() & 0xFFFF
+        self.seq = 0
+        self.addresses = dict()  # host -> (address, expires)
+
+        self.schedule = list()     # heap of (send time, id, target)
+        self.outstanding = dict()  # seq -> (target, sent time)
+        self.finished = list()     # targets to call back at the end of poll()
+
+        self.resolving = Queue.Queue()  # (host, target) to resolve
+        self.resolved = Queue.Queue()   # (host, address, target) from resolver threads
+        for i in range(resolvers):
+            t = threading.Thread(target=self._resolver, name='IcmpResolver-%d' % i)
+            t.daemon = True
+            t.start()
+
+        LOG.info('Using %s ICMP socket', 'raw' if self.raw else 'unprivileged')
+
+    def supports(self, host):
+        """
+        False for hosts that can only be pinged by the ping command, ie. IPv6.
+        """
+        return ':' not in host
+
+    def _resolver(self):
+
+        while True:
+            host, target = self.resolving.get()
+            try:
+                address = socket.gethostbyname(host)
+            except socket.error, e:
+                LOG.warning('Could not resolve %s: %s', host, e)
+                address = None
+            self.resolved.put((host, address, target))
+
+    def _received(self):
+        """
+        When the last reply read was received, so that the round trip time does not include the time
+        it waited on the socket. Falls back to now where the socket can't tell.
+        """
+        try:
+            seconds, microseconds = struct.unpack('ll', fcntl.ioctl(self.sock.fileno(), _SIOCGSTAMP,
+                                                                    struct.pack('ll', 0, 0)))
+        except (IOError, OSError):
+            return time.time()
+        return seconds + microseconds / 1000000.0
+
+    def _packet(self, seq):
+
+        payload = struct.pack('!d', time.time()) + _PAYLOAD
+        header = struct.pack('!BBHHH', _ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+        return struct.pack('!BBHHH', _ICMP_ECHO_REQUEST, 0, checksum(header + payload), self.ident, seq) + payload
+
+    def _replies(self):
+        """
+        Yields (address, seq, received time) for every echo reply waiting on the socket.
+        """
+        while True:
+            try:
+                data, (address, port) = self.sock.recvfrom(2048)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if self.raw:
+                data = data[(ord(data[0]) & 0x0F) * 4:]  # skip IP header
+            if len(data) < 8:
+                continue
+            icmp_type, code, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+            if icmp_type != _ICMP_ECHO_REPLY:
+                continue
+            if self.raw and ident != self.ident:
+                continue  # reply to another process, the kernel filters them for unprivileged sockets
+            yield address, seq, self._received()
+
+    def submit(self, host, callback, count=5, interval=1, timeout=5):
+        """
+        Start pinging host. Sends count echo requests, interval seconds apart, and waits up to timeout
+        seconds after the first request for the replies, then calls callback with a tuple of (rc, (avg, max),
+        loss, text) like the ping command. Callbacks are called from poll().
+        """
+        target = {
+            'address': None,
+            'callback': callback,
+            'count': count,
+            'interval': interval,
+            'wait': max(timeout - (count - 1) * interval, 1),  # seconds each request waits for its reply
+            'sent': 0,
+            'failed': 0,
+            'outstanding': 0,
+            'rtts': list(),
+            'error': None,
+        }
+
+        address, expires = self.addresses.get(host, (None, 0))
+        if expires < time.time():
+            self.resolving.put((host, target))  # started by poll() once resolved
+        else:
+            self._start(target, address)
+
+    def _start(self, target, address):
+
+        if not address:
+            target['error'] = 'unknown host'
+            self._finish(target)
+            return
+
+        target['address'] = address
+        now = time.time()
+        for k in range(target['count']):
+            heapq.heappush(self.schedule, (now + k * target['interval'], id(target), target))
+
+    def _finish(self, target):
+
+        self.finished.append(target)
+
+    def _callbacks(self):
+
+        finished, self.finished = self.finished, list()
+        for target in finished:
+            try:
+                target['callback'](self._result(target, target['count']))
+            except Exception, e:
+                LOG.exception('Ping callback failed: %s', e)
+
+    def _next_seq(self):
+        """
+        The next sequence number that is not waiting for a reply, as they wrap around at 16 bits.
+        """
+        for _ in range(0x10000):
+            self.seq = (self.seq + 1) & 0xFFFF
+            if self.seq not in self.outstanding:
+                return self.seq
+        raise socket.error(errno.ENOBUFS, 'too many echo requests waiting for a reply')
+
+    def _settle(self, target):
+        """
+        Called when a request is answered, times out or could not be sent.
+        """
+        target['outstanding'] -= 1
+        if not target['outstanding'] and target['sent'] + target['failed'] == target['count']:
+            self._finish(target)
+
+    def poll(self, timeout):
+        """
+        Send the echo requests that are due, wait up to timeout seconds for replies and then call
+        back the targets that are finished.
+        """
+        while True:
+            try:
+                host, address, target = self.resolved.get_nowait()
+            except Queue.Empty:
+                break
+            self.addresses[host] = (address, time.time() + _RESOLVE_TTL)
+            self._start(target, address)
+
+        now = time.time()
+        while self.schedule and self.schedule[0][0] <= now:
+            send_time, _, target = heapq.heappop(self.schedule)
+            target['outstanding'] += 1
+            try:
+                self.sock.sendto(self._packet(self._next_seq()), (target['address'], 0))
+            except socket.error, e:
+                target['error'] = str(e)
+                target['failed'] += 1
+                self._settle(target)
+                continue
+            target['sent'] += 1
+            self.outstanding[self.seq] = (target, time.time())
+
+        self._read()  # replies that arrived in time are not timed out
+
+        for seq in [seq for seq, (target, sent) in self.outstanding.iteritems() if now - sent > target['wait']]:
+            target, sent = self.outstanding.pop(seq)
+            self._settle(target)
+
+        deadlines = [sent + target['wait'] for target, sent in self.outstanding.itervalues()]
+        if self.schedule:
+            deadlines.append(self.schedule[0][0])
+        readable, _, _ = select.select([self.sock], [], [], max(min(deadlines + [now + timeout]) - time.time(), 0))
+        if readable:
+            self._read()
+
+        self._callbacks()
+
+    def _read(self):
+        """
+        Read every waiting reply before any target is called back, so that replies are timed when they
+        arrive and not after callbacks for other targets have run.
+        """
+        for address, seq, received in list(self._replies()):
+            if seq not in self.outstanding:
+                continue  # late or duplicate reply
+            target, sent = self.outstanding[seq]
+            if target['address'] != address:
+                continue
+            del self.outstanding[seq]
+            target['rtts'].append(max(received - sent, 0) * 1000)
+            self._settle(target)
+
+    def ping(self, hosts, count=5, interval=1, timeout=5):
+        """
+        Ping every host at once and return a dict of host to (rc, (avg, max), loss, text).
+        """
+        results = dict()
+        for host in set(hosts):
+            self.submit(host, functools.partial(results.__setitem__, host), count, interval, timeout)
+        while len(results) < len(set(hosts)):
+            self.poll(1)
+        return results
+
+    @staticmethod
+    def _result(target, count):
+
+        rtts = target['rtts']
+        if not target['sent']:
+            return PING_ERROR, (0, 0), 'n/a', 'ping: %s' % target['error']
+
+        loss = 100.0 * (count - len(rtts)) / count
+        loss = '%g' % loss
+        text = '%d packets transmitted, %d received, %s%% packet loss' % (count, len(rtts), loss)
+
+        if not rtts:
+            return PING_FAILED, (0, 0), loss, text
+
+        rtt = (round(sum(rtts) / len(rtts), 3), round(max(rtts), 3))
+        text += '\nrtt min/avg/max = %.3f/%.3f/%.3f ms' % (min(rtts), rtt[0], rtt[1])
+
+        return PING_OK if len(rtts) == count else PING_FAILED, rtt, loss, text
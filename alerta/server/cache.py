@@ -0,0 +1,191 @@
+
+import threading
+
+from collections import OrderedDict
+
+from alerta.common import log as logging
+from alerta.common import status_code
+from alerta.server.database import Mongo
+
+LOG = logging.getLogger(__name__)
+
+_CACHED_FIELDS = {"environment": 1, "resource": 1, "event": 1, "correlatedEvents": 1, "severity": 1, "status": 1,
+                  "duplicateCount": 1}
+
+
+class AlertCache(object):
+    """
+    Bounded, write-through cache of alert state used to classify incoming alerts without reading
+    from the database. Alerts are cached per environment and resource, ie. the set of alerts an
+    incoming alert can correlate with, and least recently used resources are evicted first.
+
+    A resource that was loaded from the database is "complete" and a cache hit can also tell that
+    an alert is new. Resources added by warm-up or by a write are partial so only alerts found in
+    them are hits.
+
+    >>> cache = AlertCache(50000)
+    >>> hit, existing = cache.get(alert)   # existing is None and hit is True for a new alert
+    >>> if not hit:
+    >>>     cache.load(alert, documents)   # all alerts for alert environment and resource
+    >>> cache.update(savedAlert)           # write-through after a successful save
+    """
+
+    def __init__(self, size):
+
+        self.size = size
+        self.resources = OrderedDict()  # (environment, resource) -> {'complete': bool, 'alerts': [...]}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+
+        return len(self.resources)
+
+    @staticmethod
+    def _key(environment, resource):
+
+        return tuple(environment), resource
+
+    @staticmethod
+    def _entry(alert):
+
+        return {
+            '_id': alert.alertid,
+            'event': alert.event,
+            'correlatedEvents': alert.correlate,
+            'severity': alert.severity,
+            'status': alert.status,
+            'duplicateCount': alert.duplicate_count,
+        }
+
+    @staticmethod
+    def _from_document(document):
+
+        return {
+            '_id': document['_id'],
+            'event': document['event'],
+            'correlatedEvents': document.get('correlatedEvents'),
+            'severity': document['severity'],
+            'status': document['status'],
+            'duplicateCount': document.get('duplicateCount', 0),
+        }
+
+    def _put(self, key, complete, alerts):
+
+        self.resources[key] = {'complete': complete, 'alerts': alerts}
+        while len(self.resources) > self.size:
+            self.resources.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, alert):
+        """
+        Returns a tuple of (hit, existing) where existing is a copy of the cached alert state.
+        """
+        key = self._key(alert.environment, alert.resource)
+
+        with self.lock:
+            cached = self.resources.pop(key, None)
+            if cached is None:
+                self.misses += 1
+                return False, None
+            self.resources[key] = cached  # most recently used
+
+            existing = Mongo._match_document(alert, cached['alerts'])
+            if existing or cached['complete']:
+                self.hits += 1
+                return True, dict(existing) if existing else None
+
+            self.misses += 1
+            return False, None
+
+    def get_resource(self, environment, resource, alerts):
+        """
+        Returns copies of the cached state of the alerts for an environment and resource that match
+        any of alerts, if every one of alerts is a hit, or None.
+        """
+        key = self._key(environment, resource)
+
+        with self.lock:
+            cached = self.resources.pop(key, None)
+            if cached is None:
+                self.misses += len(alerts)
+                return
+            self.resources[key] = cached  # most recently used
+
+            matched = [Mongo._match_document(alert, cached['alerts']) for alert in alerts]
+            if not cached['complete'] and not all(matched):
+                self.misses += len(alerts)
+                return
+
+            self.hits += len(alerts)
+            return [dict(existing) for existing in dict((e['_id'], e) for e in matched if e).itervalues()]
+
+    def load(self, alert, documents):
+
+        key = self._key(alert.environment, alert.resource)
+        alerts = [self._from_document(d) for d in documents]
+
+        with self.lock:
+            self.resources.pop(key, None)
+            self._put(key, True, alerts)
+
+    def update(self, alert):
+
+        key = self._key(alert.environment, alert.resource)
+        entry = self._entry(alert)
+
+        with self.lock:
+            cached = self.resources.pop(key, None)
+            if cached is None:
+                self._put(key, False, [entry])
+                return
+
+            cached['alerts'] = [a for a in cached['alerts'] if a['_id'] != entry['_id']] + [entry]
+            self._put(key, cached['complete'], cached['alerts'])
+
+    def invalidate(self, alert):
+
+        with self.lock:
+            self.resources.pop(self._key(alert.environment, alert.resource), None)
+
+    def warm_up(self, db, owns=None):
+        """
+        Load open alerts until the cache is full. If given, owns(environment, resource) restricts the
+        cache to the resources processed by this server.
+        """
+        LOG.info('Warming up alert cache from database...')
+
+        # no hint, so the query still works if the status index is missing or was dropped for a compound one
+        if not any(keys[0][0] == 'status' for keys in db.get_indexes().itervalues()):
+            LOG.warning('No index on alert status so warming up the alert cache scans every alert, '
+                        'run alerta-indexes --create')
+
+        count = 0
+        cursor = db.db.alerts.find({"status": {'$in': [status_code.OPEN, status_code.ASSIGN, status_code.ACK]}},
+                                   _CACHED_FIELDS)
+        with self.lock:
+            for document in cursor:
+                if owns and not owns(document['environment'], document['resource']):
+                    continue
+                key = self._key(document['environment'], document['resource'])
+                cached = self.resources.get(key)
+                if cached is None:
+                    if len(self.resources) >= self.size:
+                        break
+                    cached = self.resources[key] = {'complete': False, 'alerts': list()}
+                cached['alerts'].append(self._from_document(document))
+                count += 1
+
+        LOG.info('Loaded %d alerts for %d resources into alert cache', count, len(self.resources))
+
+    def stats(self):
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.resources),
+        }
@@ -1,16 +1,25 @@
 
+import json
 import time
+import functools
+import signal
 import threading
+import multiprocessing
 import Queue
 
+from collections import OrderedDict
+from pymongo.errors import ConnectionFailure
+
 from alerta.common import config
 from alerta.common import log as logging
 from alerta.common.daemon import Daemon
 from alerta.common.alert import Alert
 from alerta.common.heartbeat import Heartbeat
-from alerta.common import status_code, severity_code
 from alerta.common.mq import Messaging, MessageHandler
-from alerta.server.database import Mongo
+from alerta.common.spool import Spool
+from alerta.server.database import Mongo, DUPLICATE_ALERT, CORRELATED_ALERT
+from alerta.server.dispatcher import Dispatcher
+from alerta.server.cache import AlertCache
 from alerta.common.graphite import Carbon, StatsD
 
 Version = '2.1.0'
@@ -19,9 +28,75 @@ LOG = logging.getLogger(__name__)
 CONF = config.CONF
 
 
+def forward(mq, statsd, incomingAlert, action, processedAlert):
+    """
+    Forward a saved alert unless it is a duplicate. Returns the times for the alert timer metric.
+    """
+    if not processedAlert:
+        statsd.metric_send('alerta.alerts.error', 1)
+        return
+
+    if action == DUPLICATE_ALERT:
+        LOG.info('%s : Duplicate alert -> update dup count', incomingAlert.get_id())
+
+        if CONF.forward_duplicate:
+            # Forward alert to notify topic and logger queue
+            mq.send(processedAlert, [CONF.outbound_queue, CONF.outbound_topic])
+            LOG.info('%s : Alert forwarded to %s and %s', processedAlert.get_id(), CONF.outbound_queue, CONF.outbound_topic)
+
+        timing = (processedAlert.create_time, processedAlert.last_receive_time)
+
+    else:
+        if action == CORRELATED_ALERT:
+            LOG.info('%s : Event and/or severity change %s %s -> %s update details', incomingAlert.get_id(),
+                     processedAlert.event, processedAlert.previous_severity, processedAlert.severity)
+        else:
+            LOG.info('%s : New alert -> insert', incomingAlert.get_id())
+
+        # Forward alert to notify topic and logger queue
+        mq.send(processedAlert, [CONF.outbound_queue, CONF.outbound_topic])
+        LOG.info('%s : Alert forwarded to %s and %s', processedAlert.get_id(), CONF.outbound_queue, CONF.outbound_topic)
+
+        timing = (processedAlert.create_time, processedAlert.receive_time)
+
+    # update application stats
+    statsd.metric_send('alerta.alerts.total', 1)
+    statsd.metric_send('alerta.alerts.%s' % incomingAlert.severity, 1)
+
+    return timing
+
+
+def replay(db, mq, statsd, cache, record):
+    """
+    Save and forward a spooled alert. Returns False if MongoDB is still unavailable. An alert that
+    can't be parsed or saved for any other reason is logged and dropped, so it doesn't stop the
+    replay of the alerts spooled after it.
+    """
+    try:
+        incomingAlert = Alert.parse_alert(record)
+    except ValueError, e:
+        LOG.error('Dropping spooled alert that could not be parsed - %s: %s', e, record)
+        statsd.metric_send('alerta.alerts.rejected', 1)
+        return True
+
+    try:
+        action, processedAlert = db.ingest_alert(incomingAlert, cache)
+    except ConnectionFailure:
+        return False
+    except Exception, e:
+        LOG.error('Dropping spooled alert %s that could not be saved: %s', incomingAlert.get_id(), e)
+        statsd.metric_send('alerta.alerts.error', 1)
+        return True
+
+    timing = forward(mq, statsd, incomingAlert, action, processedAlert)
+    if timing:
+        db.update_timer_metric(*timing)
+    return True
+
+
 class WorkerThread(threading.Thread):
 
-    def __init__(self, mq, queue, statsd):
+    def __init__(self, mq, queue, statsd, cache=None, ack=None, spool=None):
 
         threading.Thread.__init__(self)
         LOG.debug('Initialising %s...', self.getName())
@@ -30,146 +105,197 @@ class WorkerThread(threading.Thread):
         self.mq = mq               # message broker
         self.db = Mongo()       # mongo database
         self.statsd = statsd  # graphite metrics
+        self.cache = cache    # alert cache shared by worker threads
+        self.ack = ack or mq.ack  # ack inbound message once processed
+        self.spool = spool    # alerts that could not be saved while MongoDB is unavailable
 
     def run(self):
 
         while True:
             LOG.debug('Waiting on input queue...')
             try:
-                incomingAlert = self.queue.get(True, CONF.loop_every)
+                item = self.queue.get(True, CONF.loop_every)
             except Queue.Empty:
                 continue
 
-            if not incomingAlert:
+            if not item:
                 LOG.info('%s is shutting down.', self.getName())
                 break
+            incomingAlert, message_id = item
 
             if incomingAlert.get_type() == 'Heartbeat':
                 heartbeat = incomingAlert
                 LOG.info('Heartbeat received from %s...', heartbeat.origin)
                 self.db.update_hb(heartbeat)
-                self.queue.task_done()
+                self.done(message_id)
                 continue
             else:
                 LOG.info('Alert received from %s...', incomingAlert.origin)
 
-            try:
-                suppress = incomingAlert.transform_alert()
-            except RuntimeError:
-                self.statsd.metric_send('alerta.alerts.error', 1)
-                self.queue.task_done()
+            if self.spooled([incomingAlert]):
+                self.done(message_id)
                 continue
 
-            if suppress:
-                LOG.info('Suppressing alert %s', incomingAlert.get_id())
-                self.queue.task_done()
+            # Classify alert as new, duplicate or correlated and save it in a single guarded write
+            #   new        ... insert entire document with history and status, duplicate count of zero
+            #   duplicate  ... increment duplicate count, update lastReceiveTime, lastReceiveId, text, summary,
+            #                  value, tags and origin, and push status if changed
+            #   correlated ... update severity, createTime, receiveTime, lastReceiveTime, previousSeverity,
+            #                  lastReceiveId, text, summary, value, tags and origin, set duplicate count to
+            #                  zero, and push history and status if changed
+            try:
+                action, processedAlert = self.db.ingest_alert(incomingAlert, self.cache)
+            except ConnectionFailure, e:
+                if not self.spool_alerts([incomingAlert], e):
+                    raise
+                self.done(message_id)
                 continue
 
-            if self.db.is_duplicate(incomingAlert, incomingAlert.severity):
-                # Duplicate alert .. 1. update existing document with lastReceiveTime, lastReceiveId, text, summary,
-                #                       value, status, tags and origin
-                #                    2. increment duplicate count
-                #                    3. update and push status if changed
-
-                LOG.info('%s : Duplicate alert -> update dup count', incomingAlert.alertid)
-                duplicateAlert = self.db.duplicate_alert(incomingAlert)
+            timing = self.forward(incomingAlert, action, processedAlert)
+            if timing:
+                self.db.update_timer_metric(*timing)
 
-                if incomingAlert.status != status_code.UNKNOWN and incomingAlert.status != duplicateAlert.status:
-                    self.db.update_status(alert=duplicateAlert, status=incomingAlert.status, text='Alerta server')
-                    duplicateAlert.status = incomingAlert.status
+            self.done(message_id)
 
-                if CONF.forward_duplicate:
-                    # Forward alert to notify topic and logger queue
-                    self.mq.send(duplicateAlert, CONF.outbound_queue)
-                    self.mq.send(duplicateAlert, CONF.outbound_topic)
-                    LOG.info('%s : Alert forwarded to %s and %s', duplicateAlert.get_id(), CONF.outbound_queue, CONF.outbound_topic)
-
-                self.db.update_timer_metric(duplicateAlert.create_time, duplicateAlert.last_receive_time)
-                self.queue.task_done()
+        self.queue.task_done()
 
-            elif self.db.is_correlated(incomingAlert):
-                # Diff sev alert ... 1. update existing document with severity, createTime, receiveTime,
-                #                       lastReceiveTime, previousSeverity,
-                #                       severityCode, lastReceiveId, text, summary, value, tags and origin
-                #                    2. set duplicate count to zero
-                #                    3. push history and status if changed
+    def spooled(self, alerts):
 
-                previous_severity = self.db.get_severity(incomingAlert)
-                LOG.info('%s : Event and/or severity change %s %s -> %s update details', incomingAlert.get_id(),
-                         incomingAlert.event, previous_severity, incomingAlert.severity)
+        # alerts are spooled until the spool has been replayed so they are saved in order
+        if self.spool is not None and len(self.spool):
+            for alert in alerts:
+                self.spool.put(alert.get_body())
+            return True
+        return False
 
-                trend_indication = severity_code.trend(previous_severity, incomingAlert.severity)
+    def spool_alerts(self, alerts, error):
 
-                correlatedAlert = self.db.correlate_alert(incomingAlert, previous_severity, trend_indication)
+        if self.spool is None:
+            return False
 
-                if incomingAlert.status == status_code.UNKNOWN:
-                    incomingAlert.status = severity_code.status_from_severity(previous_severity, incomingAlert.severity,
-                                                                              correlatedAlert.status)
-                if incomingAlert.status != correlatedAlert.status:
-                    self.db.update_status(alert=correlatedAlert, status=incomingAlert.status, text='Alerta server')
-                    correlatedAlert.status = incomingAlert.status
+        LOG.error('Could not save alerts to MongoDB, spooling %d alerts : %s', len(alerts), error)
+        for alert in alerts:
+            self.spool.put(alert.get_body())
+        return True
 
-                # Forward alert to notify topic and logger queue
-                self.mq.send(correlatedAlert, CONF.outbound_queue)
-                self.mq.send(correlatedAlert, CONF.outbound_topic)
-                LOG.info('%s : Alert forwarded to %s and %s', correlatedAlert.get_id(), CONF.outbound_queue, CONF.outbound_topic)
+    def done(self, message_id):
 
-                self.db.update_timer_metric(correlatedAlert.create_time, correlatedAlert.receive_time)
-                self.queue.task_done()
+        # ack only once the alert has been saved and forwarded, so unprocessed alerts are redelivered
+        self.ack(message_id)
+        self.queue.task_done()
 
-            else:
-                # New alert so ... 1. insert entire document
-                #                  2. push history and status
-                #                  3. set duplicate count to zero
+    def forward(self, incomingAlert, action, processedAlert):
 
-                LOG.info('%s : New alert -> insert', incomingAlert.get_id())
+        return forward(self.mq, self.statsd, incomingAlert, action, processedAlert)
 
-                trend_indication = severity_code.trend(severity_code.UNKNOWN, incomingAlert.severity)
 
-                incomingAlert.repeat = False
-                incomingAlert.duplicate_count = 0
-                incomingAlert.last_receive_id = incomingAlert.alertid
-                incomingAlert.last_receive_time = incomingAlert.receive_time
-                incomingAlert.trend_indication = trend_indication
+class BatchWorkerThread(WorkerThread):
+    """
+    Drains up to ingest_batch_size alerts from the internal queue, or as many as arrive within
+    ingest_batch_wait milliseconds of the first, and saves them with one bulk write. Alerts are
+    still forwarded one at a time in the order they were received.
+    """
 
-                if incomingAlert.status == status_code.UNKNOWN:
-                    incomingAlert.status = severity_code.status_from_severity(severity_code.UNKNOWN, incomingAlert.severity)
+    def get_batch(self):
 
-                if incomingAlert.alertid != self.db.save_alert(incomingAlert):
-                    LOG.critical('Alert was not saved with submitted alert id. Race condition?')
+        batch = list()
+        try:
+            item = self.queue.get(True, CONF.loop_every)
+        except Queue.Empty:
+            return batch
+        batch.append(item)
 
-                self.db.update_status(alert=incomingAlert, status=incomingAlert.status, text='Alerta server')
+        deadline = time.time() + CONF.ingest_batch_wait / 1000.0
+        while item and len(batch) < CONF.ingest_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(True, timeout)
+            except Queue.Empty:
+                break
+            batch.append(item)
 
-                # Forward alert to notify topic and logger queue
-                self.mq.send(incomingAlert, CONF.outbound_queue)
-                self.mq.send(incomingAlert, CONF.outbound_topic)
-                LOG.info('%s : Alert forwarded to %s and %s', incomingAlert.get_id(), CONF.outbound_queue, CONF.outbound_topic)
+        return batch
 
-                self.db.update_timer_metric(incomingAlert.create_time, incomingAlert.receive_time)
-                self.queue.task_done()
+    def run(self):
 
-            # update application stats
-            self.statsd.metric_send('alerta.alerts.total', 1)
-            self.statsd.metric_send('alerta.alerts.%s' % incomingAlert.severity, 1)
+        while True:
+            LOG.debug('Waiting on input queue...')
+            batch = self.get_batch()
+
+            alerts = list()
+            message_ids = list()
+            for item in batch:
+                if not item:
+                    break
+                incomingAlert, message_id = item
+
+                if incomingAlert.get_type() == 'Heartbeat':
+                    heartbeat = incomingAlert
+                    LOG.info('Heartbeat received from %s...', heartbeat.origin)
+                    self.db.update_hb(heartbeat)
+                    self.done(message_id)
+                    continue
+                else:
+                    LOG.info('Alert received from %s...', incomingAlert.origin)
+
+                alerts.append(incomingAlert)
+                message_ids.append(message_id)
+
+            if alerts and self.spooled(alerts):
+                for message_id in message_ids:
+                    self.done(message_id)
+                alerts = list()
+
+            if alerts:
+                LOG.debug('Saving batch of %d alerts...', len(alerts))
+                timings = list()
+                try:
+                    results = self.db.ingest_alerts(alerts, self.cache)
+                except ConnectionFailure, e:
+                    if not self.spool_alerts(alerts, e):
+                        raise
+                    results = list()
+                    for message_id in message_ids:
+                        self.done(message_id)
+                for incomingAlert, message_id, (action, processedAlert) in zip(alerts, message_ids, results):
+                    timing = self.forward(incomingAlert, action, processedAlert)
+                    if timing:
+                        timings.append(timing)
+                    self.done(message_id)
+
+                if timings:
+                    self.db.update_timer_metrics(timings)
+
+            if batch and not batch[-1]:
+                LOG.info('%s is shutting down.', self.getName())
+                break
 
         self.queue.task_done()
 
 
 class ServerMessage(MessageHandler):
 
-    def __init__(self, mq, queue, statsd):
+    def __init__(self, mq, queue, statsd, ack=None):
 
         self.mq = mq
         self.queue = queue
         self.statsd = statsd
+        self.ack = ack or mq.ack
 
         MessageHandler.__init__(self)
 
     def on_message(self, headers, body):
 
+        self.dispatch(headers, body, self.mq.received(headers, body))
+
+    def dispatch(self, headers, body, message_id=None):
+
         if 'type' not in headers or 'correlation-id' not in headers:
             LOG.warning('Malformed header missing "type" or "correlation-id": %s', headers)
             self.statsd.metric_send('alerta.alerts.rejected', 1)
+            self.ack(message_id)
             return
 
         LOG.info("Received %s %s", headers['type'], headers['correlation-id'])
@@ -180,26 +306,310 @@ class ServerMessage(MessageHandler):
             if heartbeat:
                 heartbeat.receive_now()
                 LOG.debug('Queueing successfully parsed heartbeat %s', heartbeat.get_body())
-                self.queue.put(heartbeat)
+                self.put(heartbeat, message_id)
+            else:
+                self.ack(message_id)
         else:
             try:
                 alert = Alert.parse_alert(body)
             except ValueError:
                 self.statsd.metric_send('alerta.alerts.rejected', 1)
+                self.ack(message_id)
                 return
             if alert:
                 alert.receive_now()
+                # transform before the alert is sharded, rules can change its environment and resource
+                if not self.transform(alert):
+                    self.ack(message_id)
+                    return
                 LOG.debug('Queueing successfully parsed alert %s', alert.get_body())
-                self.queue.put(alert)
+                self.put(alert, message_id)
+            else:
+                self.ack(message_id)
+
+    def transform(self, incomingAlert):
+
+        try:
+            suppress = incomingAlert.transform_alert()
+        except RuntimeError:
+            self.statsd.metric_send('alerta.alerts.error', 1)
+            return False
+
+        if suppress:
+            LOG.info('Suppressing alert %s', incomingAlert.get_id())
+            return False
+
+        return True
+
+    def put(self, item, message_id):
+
+        self.queue.put((item, message_id), key=Dispatcher.shard_key(item))
 
     def on_disconnected(self):
         self.mq.reconnect()
 
 
+class ProcessServerMessage(ServerMessage):
+    """
+    Queue the alerts dispatched to a server worker process on its worker threads, unless a
+    transform changed their correlation key to one that belongs to another process. Those are
+    moved to that process through the parent, already parsed and transformed.
+    """
+
+    def __init__(self, mq, queue, statsd, process):
+
+        self.process = process
+
+        ServerMessage.__init__(self, mq, queue, statsd, ack=process.ack)
+
+    def put(self, item, message_id):
+
+        if item.get_type() != 'Heartbeat':
+            index = Dispatcher.shard_for(Dispatcher.shard_key(item), CONF.server_processes)
+            if index != self.process.index:
+                LOG.debug('Moving alert %s to ServerProcess-%d', item.get_id(), index)
+                self.process.move(message_id, item)
+                return
+
+        ServerMessage.put(self, item, message_id)
+
+
+class ProcessDispatchMessage(MessageHandler):
+    """
+    Route raw messages to server worker processes by correlation key. Only the JSON is decoded
+    in the parent process, alerts are parsed, transformed and saved by the workers. A process
+    moves an alert back through the parent if a transform changed its correlation key.
+    """
+
+    def __init__(self, mq, dispatcher, statsd):
+
+        self.mq = mq
+        self.dispatcher = dispatcher
+        self.statsd = statsd
+
+        # message-id -> (headers, body) of messages dispatched to each process and not yet acked
+        self.outstanding = [OrderedDict() for q in dispatcher.queues]
+        self.lock = threading.Lock()
+
+        MessageHandler.__init__(self)
+
+    def on_message(self, headers, body):
+
+        message_id = self.mq.received(headers, body)
+
+        if 'type' not in headers or 'correlation-id' not in headers:
+            LOG.warning('Malformed header missing "type" or "correlation-id": %s', headers)
+            self.statsd.metric_send('alerta.alerts.rejected', 1)
+            self.mq.ack(message_id)
+            return
+
+        try:
+            message = json.loads(body)
+        except ValueError, e:
+            LOG.error('Could not parse %s - %s: %s', headers['type'], e, body)
+            self.statsd.metric_send('alerta.alerts.rejected', 1)
+            self.mq.ack(message_id)
+            return
+
+        if headers['type'] == 'Heartbeat':
+            key = message.get('origin') or headers['correlation-id']
+        else:
+            key = Dispatcher.correlation_key(message.get('environment'), message.get('resource'))
+
+        self.put(Dispatcher.shard_for(key, self.dispatcher.shards), headers, body, message_id)
+
+    def put(self, index, headers, body, message_id):
+
+        with self.lock:
+            if message_id:
+                self.outstanding[index][message_id] = (headers, body)
+            self.dispatcher.queues[index].put((headers, body, message_id))
+
+    def moved(self, message_id, alert):
+        """
+        Dispatch an alert that was transformed by one process to the process for its new correlation
+        key. It is queued without headers so that it is not parsed or transformed again.
+        """
+        self.acked(message_id)
+        self.put(Dispatcher.shard_for(Dispatcher.shard_key(alert), self.dispatcher.shards), None, alert, message_id)
+
+    def acked(self, message_id):
+
+        with self.lock:
+            for outstanding in self.outstanding:
+                if outstanding.pop(message_id, None) is not None:
+                    return
+
+    def redispatch(self, index):
+        """
+        Dispatch the messages that a process had not acked again, after it exited and before it is
+        restarted, so they are not left unacked until the broker connection closes. Messages still in
+        its queue are removed first so that each one is queued once. Returns the number of messages.
+        """
+        if not self.mq.client_ack():
+            return 0  # auto acked messages are not tracked
+
+        queue = self.dispatcher.queues[index]
+        with self.lock:
+            try:
+                while True:
+                    queue.get(True, 0.1)
+            except Queue.Empty:
+                pass
+            for message_id, (headers, body) in self.outstanding[index].iteritems():
+                queue.put((headers, body, message_id))
+            return len(self.outstanding[index])
+
+    def on_disconnected(self):
+        with self.lock:
+            for outstanding in self.outstanding:
+                outstanding.clear()  # redelivered by the broker on the new subscription
+        self.mq.reconnect()
+
+
+class ServerProcess(multiprocessing.Process):
+    """
+    Server worker process. Parses raw messages dispatched by the parent process and processes
+    them on its own worker threads. Shares nothing with other processes except MongoDB and
+    reports its internal queue lengths to the parent. Processed messages are acked by the
+    parent, which owns the broker subscription.
+    """
+
+    def __init__(self, index, inbound, stats, acks):
+
+        multiprocessing.Process.__init__(self, name='ServerProcess-%d' % index)
+
+        self.index = index
+        self.inbound = inbound  # raw messages from parent
+        self.stats = stats      # queue lengths and cache stats to parent
+        self.acks = acks        # message-ids of processed messages, or moved alerts, to parent
+        self.daemon = True
+
+    def ack(self, message_id):
+
+        if message_id:
+            self.acks.put(message_id)
+
+    def move(self, message_id, alert):
+
+        self.acks.put((message_id, alert))
+
+    def run(self):
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)  # ignore parent shutdown handler
+
+        dispatcher = Dispatcher(CONF.server_threads)
+        statsd = StatsD()
+
+        # only cache alerts dispatched to this process
+        cache = create_cache(Mongo(), owns=lambda environment, resource: Dispatcher.shard_for(
+            Dispatcher.correlation_key(environment, resource), CONF.server_processes) == self.index)
+
+        mq = Messaging()
+        handler = ProcessServerMessage(mq, dispatcher, statsd, self)
+        mq.connect(callback=handler)
+
+        spool = create_spool(mq, statsd, cache)
+        workers = start_workers(mq, dispatcher, statsd, cache, ack=self.ack, spool=spool)
+
+        last_report = time.time()
+        while True:
+            try:
+                item = self.inbound.get(True, CONF.loop_every)
+            except Queue.Empty:
+                item = True
+            except (KeyboardInterrupt, SystemExit):
+                break
+
+            if not item:
+                LOG.info('%s is shutting down.', self.name)
+                break
+
+            if item is not True:
+                headers, body, message_id = item
+                if headers is None:
+                    handler.put(body, message_id)  # moved from another process
+                else:
+                    handler.dispatch(headers, body, message_id)
+
+            if time.time() - last_report >= CONF.loop_every:
+                self.stats.put((self.index, dispatcher.qsizes(), cache.stats() if cache is not None else None))
+                for name, value in mq.get_stats().iteritems():
+                    statsd.metric_send('alerta.processes.%d.mq.%s' % (self.index, name), value, 'g')
+                if spool is not None:
+                    for name, value in spool.get_stats().iteritems():
+                        statsd.metric_send('alerta.processes.%d.db.%s' % (self.index, name), value, 'g')
+                last_report = time.time()
+
+        dispatcher.shutdown()
+        for w in workers:
+            w.join()
+
+        if spool is not None:
+            spool.close()
+
+        mq.disconnect()
+
+
+def create_cache(db, owns=None):
+
+    if not CONF.alert_cache_size:
+        return
+
+    LOG.info('Caching alerts for up to %s resources...', CONF.alert_cache_size)
+    cache = AlertCache(CONF.alert_cache_size)
+    cache.warm_up(db, owns)
+
+    return cache
+
+
+def create_spool(mq, statsd, cache=None):
+    """
+    Spool for alerts that could not be saved to MongoDB. Server processes each create their own
+    after they are started, so the spool directory is named after the process.
+    """
+    if not CONF.ingest_spool:
+        return
+
+    spool = Spool('db')
+    spool.start_replay(functools.partial(replay, Mongo(), mq, statsd, cache))
+
+    return spool
+
+
+def start_workers(mq, dispatcher, statsd, cache=None, ack=None, spool=None):
+
+    # Start worker threads, one per shard
+    if CONF.ingest_batch_size > 1:
+        LOG.info('Batching up to %s alerts every %sms...', CONF.ingest_batch_size, CONF.ingest_batch_wait)
+        worker = BatchWorkerThread
+    else:
+        worker = WorkerThread
+
+    LOG.debug('Starting %s worker threads...', dispatcher.shards)
+    workers = list()
+    for i, queue in enumerate(dispatcher.queues):
+        w = worker(mq, queue, statsd, cache, ack, spool)
+        try:
+            w.start()
+        except Exception, e:
+            LOG.error('Worker thread #%s did not start: %s', i, e)
+            continue
+        workers.append(w)
+        LOG.info('Started worker thread: %s', w.getName())
+
+    return workers
+
+
 class AlertaDaemon(Daemon):
 
     alerta_opts = {
         'forward_duplicate': 'no',
+        'ingest_batch_size': 0,     # max alerts per bulk write, 0 disables batching
+        'ingest_batch_wait': 100,   # ms
+        'server_processes': 1,      # worker processes, each running server_threads worker threads
+        'alert_cache_size': 0,      # max resources in alert cache, 0 disables the cache
+        'ingest_spool': 'no',       # spool alerts to disk if MongoDB is unavailable
     }
 
     def __init__(self, prog, **kwargs):
@@ -210,28 +620,24 @@ class AlertaDaemon(Daemon):
 
     def run(self):
 
+        if CONF.server_processes > 1:
+            return self.run_processes()
+
         self.running = True
 
-        self.queue = Queue.Queue()  # Create internal queue
+        self.dispatcher = Dispatcher(CONF.server_threads)  # Create internal queue per worker
         self.db = Mongo()       # mongo database
         self.carbon = Carbon()  # carbon metrics
         self.statsd = StatsD()  # graphite metrics
 
         # Connect to message queue
         self.mq = Messaging()
-        self.mq.connect(callback=ServerMessage(self.mq, self.queue, self.statsd))
-        self.mq.subscribe()
+        self.mq.connect(callback=ServerMessage(self.mq, self.dispatcher, self.statsd))
+        self.mq.subscribe(ack=CONF.inbound_ack)
 
-        # Start worker threads
-        LOG.debug('Starting %s worker threads...', CONF.server_threads)
-        for i in range(CONF.server_threads):
-            w = WorkerThread(self.mq, self.queue, self.statsd)
-            try:
-                w.start()
-            except Exception, e:
-                LOG.error('Worker thread #%s did not start: %s', i, e)
-                continue
-            LOG.info('Started worker thread: %s', w.getName())
+        self.cache = create_cache(self.db)
+        self.spool = create_spool(self.mq, self.statsd, self.cache)
+        workers = start_workers(self.mq, self.dispatcher, self.statsd, self.cache, spool=self.spool)
 
         while not self.shuttingdown:
             try:
@@ -240,9 +646,21 @@ class AlertaDaemon(Daemon):
                 self.mq.send(heartbeat)
 
                 time.sleep(CONF.loop_every)
-                LOG.info('Alert processing queue length is %d', self.queue.qsize())
-                self.carbon.metric_send('alerta.alerts.queueLength', self.queue.qsize())
-                self.db.update_queue_metric(self.queue.qsize())
+                queue_lengths = self.dispatcher.qsizes()
+                LOG.info('Alert processing queue lengths are %s', queue_lengths)
+                for shard, queue_length in enumerate(queue_lengths):
+                    self.carbon.metric_send('alerta.alerts.shards.%d.queueLength' % shard, queue_length)
+                self.db.update_queue_metric(queue_lengths)
+
+                for name, value in self.mq.get_stats().iteritems():
+                    self.carbon.metric_send('alerta.mq.%s' % name, value)
+
+                if self.cache is not None:
+                    self.db.update_cache_metric(self.cache.stats())
+
+                if self.spool is not None:
+                    for name, value in self.spool.get_stats().iteritems():
+                        self.carbon.metric_send('alerta.db.%s' % name, value)
 
             except (KeyboardInterrupt, SystemExit):
                 self.shuttingdown = True
@@ -250,9 +668,131 @@ class AlertaDaemon(Daemon):
         LOG.info('Shutdown request received...')
         self.running = False
 
-        for i in range(CONF.server_threads):
-            self.queue.put(None)
-        w.join()
+        self.dispatcher.shutdown()
+        for w in workers:
+            w.join()
+
+        if self.spool is not None:
+            self.spool.close()
 
         LOG.info('Disconnecting from message broker...')
         self.mq.disconnect()
+
+    def run_processes(self):
+
+        self.running = True
+
+        # Fork worker processes before connecting to MongoDB or the broker so no connections are shared
+        self.dispatcher = Dispatcher(CONF.server_processes, queue_class=multiprocessing.Queue)
+        self.stats = multiprocessing.Queue()
+        self.acks = multiprocessing.Queue()
+
+        LOG.debug('Starting %s worker processes...', CONF.server_processes)
+        for i, inbound in enumerate(self.dispatcher.queues):
+            self.start_child('ServerProcess-%d' % i,
+                             lambda i=i, inbound=inbound: ServerProcess(i, inbound, self.stats, self.acks))
+
+        self.db = Mongo()       # mongo database
+        self.carbon = Carbon()  # carbon metrics
+        self.statsd = StatsD()  # graphite metrics
+
+        # Connect to message queue
+        self.mq = Messaging()
+        self.handler = ProcessDispatchMessage(self.mq, self.dispatcher, self.statsd)
+        self.mq.connect(callback=self.handler)
+        self.mq.subscribe(ack=CONF.inbound_ack)
+
+        shard_lengths = dict()
+        cache_stats = dict()
+        next_heartbeat = 0
+        while not self.shuttingdown:
+            try:
+                self.redispatch_messages()
+                restarts = self.supervise_children()
+                if restarts:
+                    self.statsd.metric_send('alerta.server.restarts', restarts)
+
+                if time.time() >= next_heartbeat:
+                    if all([child.is_alive() for factory, child in self.children.values()]):
+                        LOG.debug('Send heartbeat...')
+                        heartbeat = Heartbeat(version=Version, timeout=CONF.loop_every)
+                        self.mq.send(heartbeat)
+
+                    while True:
+                        try:
+                            index, queue_lengths, stats = self.stats.get_nowait()
+                        except Queue.Empty:
+                            break
+                        shard_lengths[index] = queue_lengths
+                        if stats:
+                            cache_stats[index] = stats
+
+                    process_lengths = self.dispatcher.qsizes()
+                    LOG.info('Alert dispatch queue lengths are %s', process_lengths)
+                    queue_lengths = list()
+                    for index, process_length in enumerate(process_lengths):
+                        self.carbon.metric_send('alerta.alerts.processes.%d.queueLength' % index, process_length)
+                        for shard, queue_length in enumerate(shard_lengths.get(index, list())):
+                            self.carbon.metric_send('alerta.alerts.processes.%d.shards.%d.queueLength' % (index, shard),
+                                                    queue_length)
+                            queue_lengths.append(queue_length)
+                    self.db.update_queue_metric(queue_lengths)
+
+                    if cache_stats:
+                        self.db.update_cache_metric(dict((name, sum([s[name] for s in cache_stats.values()]))
+                                                         for name in ['hits', 'misses', 'evictions', 'size']))
+
+                    for name, value in self.mq.get_stats().iteritems():
+                        self.carbon.metric_send('alerta.mq.%s' % name, value)
+
+                    next_heartbeat = time.time() + CONF.loop_every
+
+                self.ack_messages(timeout=1)
+
+            except (KeyboardInterrupt, SystemExit):
+                self.shuttingdown = True
+
+        LOG.info('Shutdown request received...')
+        self.running = False
+
+        # children ack the messages they finish through the parent, so stop them before disconnecting
+        self.dispatcher.shutdown()
+        deadline = time.time() + CONF.loop_every
+        while time.time() < deadline and any([child.is_alive() for factory, child in self.children.values()]):
+            self.ack_messages(timeout=0.1)
+        self.stop_children(timeout=0)
+        self.ack_messages(timeout=0)
+
+        LOG.info('Disconnecting from message broker...')
+        self.mq.disconnect()
+
+    def redispatch_messages(self):
+
+        crashed = [index for index in range(self.dispatcher.shards)
+                   if not self.children['ServerProcess-%d' % index][1].is_alive()]
+        if not crashed or self.shuttingdown:
+            return
+
+        self.ack_messages(timeout=0)  # messages the processes finished before they exited
+        for index in crashed:
+            count = self.handler.redispatch(index)
+            if count:
+                LOG.warning('Dispatched %d messages not acked by ServerProcess-%d again', count, index)
+
+    def ack_messages(self, timeout):
+
+        try:
+            message_id = self.acks.get(True, timeout)
+        except Queue.Empty:
+            return
+
+        while True:
+            if isinstance(message_id, tuple):
+                self.handler.moved(*message_id)
+            else:
+                self.mq.ack(message_id)
+                self.handler.acked(message_id)
+            try:
+                message_id = self.acks.get_nowait()
+            except Queue.Empty:
+                break
@@ -1,16 +1,32 @@
 import sys
 import datetime
+import threading
 import pytz
 import pymongo
 
+from bson import ObjectId
+
 from alerta.common import log as logging
 from alerta.common import config
 from alerta.common.alert import Alert
 from alerta.common import severity_code, status_code
+from alerta.server.indexes import QueryShapes, REQUIRED_INDEXES
 
 LOG = logging.getLogger(__name__)
 CONF = config.CONF
 
+_INGEST_ATTEMPTS_MAX = 3  # retries if alert is modified by another writer between classify and write
+
+_CHANGE_LAG = 5  # seconds, max time between reserving a change sequence number and the write
+_CHANGE_BLOCK_LEASE = 1  # seconds, max time a block of reserved change sequence numbers is used for
+
+_SHORT_ID_LENGTH = 8  # console and IRC bot show the first 8 characters of alert ids
+_ID_LENGTH = 36
+
+NEW_ALERT = 'new'
+DUPLICATE_ALERT = 'duplicate'
+CORRELATED_ALERT = 'correlated'
+
 
 class Mongo(object):
 
@@ -21,6 +37,11 @@ class Mongo(object):
         'mongo_collection': 'alerts',
         'mongo_username': 'admin',
         'mongo_password': '',
+
+        'tombstone_retention': 86400,  # seconds deleted alerts are kept in the changes feed
+        'change_block_size': 100,      # change sequence numbers reserved at a time, 1 reserves one for every write
+        'query_shapes_interval': 60,   # seconds between writes of query shapes for the index advisor, 0 disables
+        'history_retention': 2592000,  # seconds alert history is kept in the history collection
     }
 
     def __init__(self):
@@ -49,21 +70,78 @@ class Mongo(object):
                 LOG.error('MongoDB authentication failed: %s', e)
                 sys.exit(1)
 
+        # $push with $slice but no $sort and $max need MongoDB 2.6
+        try:
+            version = self.conn.server_info()['versionArray']
+        except Exception, e:
+            LOG.error('MongoDB server info error : %s', e)
+            sys.exit(1)
+        if version < [2, 6]:
+            LOG.error('MongoDB server version %s is not supported, version 2.6 or later is required',
+                      '.'.join(str(v) for v in version[:3]))
+            sys.exit(1)
+
         LOG.info('Connected to MongoDB server %s:%s', CONF.mongo_host, CONF.mongo_port)
 
-        self.create_indexes()
+        self.shapes = QueryShapes(self.db.queryShapes, CONF.query_shapes_interval)
+
+        self.change_block = None  # [next seq, last seq, changeTime] of reserved change sequence numbers
+        self.change_lock = threading.Lock()
+
+        self.check_indexes()
+
+    def check_indexes(self):
+        """
+        Indexes are created by alerta-indexes, not at startup, so only warn if required ones are missing.
+        """
+        try:
+            indexes = [index['key'] for index in self.db.alerts.index_information().values()]
+        except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
+            LOG.error('MongoDB error: %s', e)
+            return
+
+        for keys in REQUIRED_INDEXES['alerts']:
+            if keys not in indexes:
+                LOG.warning('Index %s on alerts is missing, run alerta-indexes --create', keys)
 
     def create_indexes(self):
 
-        self.db.alerts.create_index([('environment', pymongo.ASCENDING), ('resource', pymongo.ASCENDING),
-                                     ('event', pymongo.ASCENDING), ('severity', pymongo.ASCENDING)])
-        self.db.alerts.create_index([('status', pymongo.ASCENDING), ('lastReceiveTime', pymongo.ASCENDING)])
-        self.db.alerts.create_index([('status', pymongo.ASCENDING), ('lastReceiveTime', pymongo.ASCENDING),
-                                     ('environment', pymongo.ASCENDING)])
-        self.db.alerts.create_index([('status', pymongo.ASCENDING), ('service', pymongo.ASCENDING)])
-        self.db.alerts.create_index([('status', pymongo.ASCENDING), ('environment', pymongo.ASCENDING)])
-        self.db.alerts.create_index([('status', pymongo.ASCENDING), ('expireTime', pymongo.ASCENDING)])
-        self.db.alerts.create_index([('status', pymongo.ASCENDING)])
+        for collection, indexes in REQUIRED_INDEXES.iteritems():
+            for keys in indexes:
+                self.db[collection].create_index(keys)
+
+        # history retention, changing it needs the index to be dropped first
+        self.db.history.create_index([('historyTime', pymongo.ASCENDING)], expireAfterSeconds=CONF.history_retention)
+
+    def create_index(self, keys):
+
+        return self.db.alerts.create_index(keys, background=True)
+
+    def drop_index(self, name):
+
+        self.db.alerts.drop_index(name)
+
+    def backfill_short_ids(self):
+        """
+        Set shortId on alerts created before it was added. Returns the number of alerts updated.
+        """
+        count = 0
+        for response in self.db.alerts.find({'shortId': {'$exists': False}}, {"_id": 1}):
+            self.db.alerts.update({'_id': response['_id']}, {'$set': {'shortId': response['_id'][:_SHORT_ID_LENGTH]}})
+            count += 1
+        return count
+
+    def get_query_shapes(self, min_count=1):
+
+        return list(self.db.queryShapes.find({'count': {'$gte': min_count}}, sort=[('count', pymongo.DESCENDING)]))
+
+    def reset_query_shapes(self):
+
+        self.db.queryShapes.remove()
+
+    def get_indexes(self):
+
+        return dict((name, index['key']) for name, index in self.db.alerts.index_information().iteritems())
 
     def is_duplicate(self, alert, severity=None):
 
@@ -88,25 +166,34 @@ class Mongo(object):
 
     def get_count(self, query=None):
 
+        self.shapes.record('count', query)
         return self.db.alerts.find(query).count()
 
     def get_counts(self, query=None):
-
+        """
+        Count matching alerts by severity and status with a single aggregation.
+        """
         query = query or dict()
+        self.shapes.record('counts', query)
 
         found = 0
         severity_count = dict.fromkeys(severity_code.ALL, 0)
         status_count = dict.fromkeys(status_code.ALL, 0)
 
-        responses = self.db.alerts.find(query, {"severity": 1, "status": 1})
-        if not responses:
-            LOG.warning('No alerts found with query = %s', query)
-            return None
+        pipeline = [
+            {'$match': query},
+            {'$group': {"_id": {"severity": "$severity", "status": "$status"}, "count": {'$sum': 1}}}
+        ]
+        responses = self.db.alerts.aggregate(pipeline)
+        if isinstance(responses, dict):
+            responses = responses.get('result', list())  # pymongo < 3.0
 
         for response in responses:
-            severity_count[response['severity']] += 1
-            status_count[response['status']] += 1
-            found += 1
+            severity = response['_id']['severity']
+            status = response['_id']['status']
+            severity_count[severity] = severity_count.get(severity, 0) + response['count']
+            status_count[status] = status_count.get(status, 0) + response['count']
+            found += response['count']
 
         return found, severity_count, status_count
 
@@ -115,6 +202,7 @@ class Mongo(object):
         query = query or dict()
         fields = fields or list()
         sort = sort or dict()
+        self.shapes.record('alerts', query, sort)
 
         responses = self.db.alerts.find(query, fields=fields, sort=sort).limit(limit)
         if not responses:
@@ -123,52 +211,27 @@ class Mongo(object):
 
         alerts = list()
         for response in responses:
-            alerts.append(
-                Alert(
-                    alertid=response['_id'],
-                    resource=response['resource'],
-                    event=response['event'],
-                    correlate=response['correlatedEvents'],
-                    group=response['group'],
-                    value=response['value'],
-                    status=response['status'],
-                    severity=response['severity'],
-                    previous_severity=response['previousSeverity'],
-                    environment=response['environment'],
-                    service=response['service'],
-                    text=response['text'],
-                    event_type=response['type'],
-                    tags=response['tags'],
-                    origin=response['origin'],
-                    repeat=response['repeat'],
-                    duplicate_count=response['duplicateCount'],
-                    threshold_info=response['thresholdInfo'],
-                    summary=response['summary'],
-                    timeout=response['timeout'],
-                    last_receive_id=response['lastReceiveId'],
-                    create_time=response['createTime'],
-                    expire_time=response['expireTime'],
-                    receive_time=response['receiveTime'],
-                    last_receive_time=response['lastReceiveTime'],
-                    trend_indication=response['trendIndication'],
-                    raw_data=response['rawData'],
-                    more_info=response['moreInfo'],
-                    graph_urls=response['graphUrls'],
-                    history=response['history'],
-                )
-            )
+            alerts.append(Alert.from_document(response))
         return alerts
 
+    def iter_alerts(self, query=None, fields=None, sort=None, limit=0):
+        """
+        Like get_alerts() but yields alerts as they are read from the cursor.
+        """
+        self.shapes.record('alerts', query, sort)
+        for response in self.db.alerts.find(query or dict(), fields=fields or None, sort=sort or None).limit(limit):
+            yield Alert.from_document(response)
+
     def get_alert(self, alertid=None, environment=None, resource=None, event=None, severity=None):
 
         if alertid:
-            query = {'$or': [{'_id': {'$regex': '^' + alertid}},
-                    {'lastReceiveId': {'$regex': '^' + alertid}}]}
+            query = self._id_query(alertid)
         elif severity:
             query = {"environment": environment, "resource": resource, "event": event, "severity": severity}
         else:
             query = {"environment": environment, "resource": resource, "event": event}
 
+        self.shapes.record('alert', query)
         response = self.db.alerts.find_one(query)
         LOG.debug('db.alerts.findOne(query=%s)', query)
 
@@ -176,38 +239,30 @@ class Mongo(object):
             LOG.warning('Alert not found with environment, resource, event, severity = %s %s %s %s', environment, resource, event, severity)
             return None
 
-        return Alert(
-            resource=response.get('resource', None),
-            event=response.get('event', None),
-            correlate=response.get('correlatedEvents', None),
-            group=response.get('group', None),
-            value=response.get('value', None),
-            status=response.get('status', None),
-            severity=response.get('severity', None),
-            previous_severity=response.get('previousSeverity', None),
-            environment=response.get('environment', None),
-            service=response.get('service', None),
-            text=response.get('text', None),
-            event_type=response.get('type', None),
-            tags=response.get('tags', None),
-            origin=response.get('origin', None),
-            repeat=response.get('repeat', None),
-            duplicate_count=response.get('duplicateCount', None),
-            threshold_info=response.get('thresholdInfo', None),
-            summary=response.get('summary', None),
-            timeout=response.get('timeout', None),
-            alertid=response.get('_id', None),
-            last_receive_id=response.get('lastReceiveId', None),
-            create_time=response.get('createTime', None),
-            expire_time=response.get('expireTime', None),
-            receive_time=response.get('receiveTime', None),
-            last_receive_time=response.get('lastReceiveTime', None),
-            trend_indication=response.get('trendIndication', None),
-            raw_data=response.get('rawData', None),
-            more_info=response.get('moreInfo', None),
-            graph_urls=response.get('graphUrls', None),
-            history=response.get('history', None),
-        )
+        return Alert.from_document(response)
+
+    @staticmethod
+    def _id_query(alertid, last_receive_id=True):
+        """
+        Query for an alert by full id, short id or id prefix, and optionally by the id of its last duplicate.
+        Full ids are exact matches and prefixes are _id ranges, so every lookup uses an index. Short ids
+        also match the indexed shortId field.
+        """
+        if len(alertid) == _ID_LENGTH:
+            by_id = [{'_id': alertid}]
+            by_last = {'lastReceiveId': alertid}
+        else:
+            prefix = {'$gte': alertid, '$lt': alertid[:-1] + unichr(ord(alertid[-1]) + 1)}
+            if len(alertid) == _SHORT_ID_LENGTH:
+                # alerts saved before shortId was added have none until alerta-indexes backfills it
+                by_id = [{'shortId': alertid}, {'_id': prefix}]
+            else:
+                by_id = [{'_id': prefix}]
+            by_last = {'lastReceiveId': prefix}
+
+        if last_receive_id:
+            by_id.append(by_last)
+        return {'$or': by_id} if len(by_id) > 1 else by_id[0]
 
     def correlate_alert(self, alert, previous_severity=None, trend_indication=None):
 
@@ -240,6 +295,7 @@ class Mongo(object):
             "moreInfo": alert.more_info,
             "graphUrls": alert.graph_urls,
         }
+        update.update(self._next_change())
 
         query = {"environment": alert.environment, "resource": alert.resource,
                      '$or': [{"event": alert.event}, {"correlatedEvents": alert.event}]}
@@ -250,58 +306,20 @@ class Mongo(object):
                                    allowable_errors=[no_obj_error],
                                    query=query,
                                    update={'$set': update,
-                                           '$push': {
-                                               "history": {
-                                                    "id": update['lastReceiveId'],
-                                                    "event": update['event'],
-                                                    "severity": update['severity'],
-                                                    "value": update['value'],
-                                                    "text": update['text'],
-                                                    "createTime": update['createTime'],
-                                                    "receiveTime": update['receiveTime'],
-                                               }
-                                           }
+                                           '$push': self._push_history([self._event_history(alert)])
                                            },
                                    new=True,
                                    fields={"history": 0})['value']
 
-        return Alert(
-            alertid=response['_id'],
-            resource=response['resource'],
-            event=response['event'],
-            correlate=response['correlatedEvents'],
-            group=response['group'],
-            value=response['value'],
-            status=response['status'],
-            severity=response['severity'],
-            previous_severity=response['previousSeverity'],
-            environment=response['environment'],
-            service=response['service'],
-            text=response['text'],
-            event_type=response['type'],
-            tags=response['tags'],
-            origin=response['origin'],
-            repeat=response['repeat'],
-            duplicate_count=response['duplicateCount'],
-            threshold_info=response['thresholdInfo'],
-            summary=response['summary'],
-            timeout=response['timeout'],
-            last_receive_id=response['lastReceiveId'],
-            create_time=response['createTime'],
-            expire_time=response['expireTime'],
-            receive_time=response['receiveTime'],
-            last_receive_time=response['lastReceiveTime'],
-            trend_indication=response['trendIndication'],
-            raw_data=response['rawData'],
-            more_info=response['moreInfo'],
-            graph_urls=response['graphUrls'],
-        )
+        if response:
+            self._save_history(response['_id'], [self._event_history(alert)])
+
+        return Alert.from_document(response)
 
     def update_status(self, alertid=None, alert=None, status=None, text=None):
 
         if alertid:
-            query = {'$or': [{'_id': {'$regex': '^' + alertid}},
-                    {'lastReceiveId': {'$regex': '^' + alertid}}]}
+            query = self._id_query(alertid)
         else:
             query = {"environment": alert.environment, "resource": alert.resource,
                      '$or': [{"event": alert.event}, {"correlatedEvents": alert.event}]}
@@ -309,19 +327,22 @@ class Mongo(object):
         update_time = datetime.datetime.utcnow()
         update_time = update_time.replace(tzinfo=pytz.utc)
 
+        update = {"status": status}
+        update.update(self._next_change())
+
+        history = {
+            "status": status,
+            "updateTime": update_time,
+            "text": text,
+        }
+
         # FIXME - no native find_and_modify method in this version of pymongo
         no_obj_error = "No matching object found"
         response = self.db.command("findAndModify", 'alerts',
                                    allowable_errors=[no_obj_error],
                                    query=query,
-                                   update={'$set': {"status": status},
-                                           '$push': {
-                                               "history": {
-                                                   "status": status,
-                                                   "updateTime": update_time,
-                                                   "text": text,
-                                               }
-                                           }
+                                   update={'$set': update,
+                                           '$push': self._push_history([history])
                                    },
                                    multi=False,
                                    new=True,
@@ -331,43 +352,16 @@ class Mongo(object):
             LOG.warn('Alert %s not found - could not update status to %s', alertid, status)
             return
 
-        return Alert(
-            alertid=response['_id'],
-            resource=response['resource'],
-            event=response['event'],
-            correlate=response['correlatedEvents'],
-            group=response['group'],
-            value=response['value'],
-            status=response['status'],
-            severity=response['severity'],
-            previous_severity=response['previousSeverity'],
-            environment=response['environment'],
-            service=response['service'],
-            text=response['text'],
-            event_type=response['type'],
-            tags=response['tags'],
-            origin=response['origin'],
-            repeat=response['repeat'],
-            duplicate_count=response['duplicateCount'],
-            threshold_info=response['thresholdInfo'],
-            summary=response['summary'],
-            timeout=response['timeout'],
-            last_receive_id=response['lastReceiveId'],
-            create_time=response['createTime'],
-            expire_time=response['expireTime'],
-            receive_time=response['receiveTime'],
-            last_receive_time=response['lastReceiveTime'],
-            trend_indication=response['trendIndication'],
-            raw_data=response['rawData'],
-            more_info=response['moreInfo'],
-            graph_urls=response['graphUrls'],
-        )
+        self._save_history(response['_id'], [history])
+
+        return Alert.from_document(response)
 
     def delete_alert(self, alertid):
 
-        response = self.db.alerts.remove({'_id': {'$regex': '^' + alertid}})
+        query = self._id_query(alertid, last_receive_id=False)
+        self.shapes.record('delete', query)
 
-        return True if 'ok' in response else False
+        return self._delete_alerts(query)
 
     def tag_alert(self, alertid, tag):
 
@@ -377,24 +371,24 @@ class Mongo(object):
             key = tag
             value = ''
 
-        response = self.db.alerts.update({'_id': {'$regex': '^' + alertid}}, {'$set': {"tags." + key: value}})
+        update = {"tags." + key: value}
+        update.update(self._next_change())
+
+        query = self._id_query(alertid, last_receive_id=False)
+        self.shapes.record('tag', query)
+
+        response = self.db.alerts.update(query, {'$set': update})
 
         return True if 'ok' in response else False
 
     def save_alert(self, alert):
 
         body = alert.get_body()
-        body['history'] = [{
-            "id": alert.alertid,
-            "event": alert.event,
-            "severity": alert.severity,
-            "value": alert.value,
-            "text": alert.text,
-            "createTime": alert.create_time,
-            "receiveTime": alert.receive_time,
-        }]
+        body['history'] = [self._event_history(alert)]
         body['_id'] = body['id']
+        body['shortId'] = body['id'][:_SHORT_ID_LENGTH]
         del body['id']
+        body.update(self._next_change())
 
         try:
             response = self.db.alerts.insert(body)
@@ -405,6 +399,8 @@ class Mongo(object):
             LOG.critical('Unhandled exception - %s: %s', e, body)
             return
 
+        self._save_history(body['_id'], body['history'])
+
         return response
 
     def duplicate_alert(self, alert):
@@ -428,6 +424,7 @@ class Mongo(object):
             "moreInfo": alert.more_info,
             "graphUrls": alert.graph_urls,
         }
+        update.update(self._next_change())
 
         # FIXME - no native find_and_modify method in this version of pymongo
         no_obj_error = "No matching object found"
@@ -440,42 +437,549 @@ class Mongo(object):
                                    new=True,
                                    fields={"history": 0})['value']
 
-        return Alert(
-            alertid=response['_id'],
-            resource=response['resource'],
-            event=response['event'],
-            correlate=response['correlatedEvents'],
-            group=response['group'],
-            value=response['value'],
-            status=response['status'],
-            severity=response['severity'],
-            previous_severity=response['previousSeverity'],
-            environment=response['environment'],
-            service=response['service'],
-            text=response['text'],
-            event_type=response['type'],
-            tags=response['tags'],
-            origin=response['origin'],
-            repeat=response['repeat'],
-            duplicate_count=response['duplicateCount'],
-            threshold_info=response['thresholdInfo'],
-            summary=response['summary'],
-            timeout=response['timeout'],
-            last_receive_id=response['lastReceiveId'],
-            create_time=response['createTime'],
-            expire_time=response['expireTime'],
-            receive_time=response['receiveTime'],
-            last_receive_time=response['lastReceiveTime'],
-            trend_indication=response['trendIndication'],
-            raw_data=response['rawData'],
-            more_info=response['moreInfo'],
-            graph_urls=response['graphUrls'],
+        return Alert.from_document(response)
+
+    def ingest_alert(self, alert, cache=None):
+        """
+        Classify an incoming alert as new, duplicate or correlated and apply the alert
+        update, history and status change as a single guarded write. If the matching
+        alert is modified by another writer between the read and the write the guard
+        fails and the alert is re-classified. New alerts are only inserted if there is
+        still no matching alert, but that check is not atomic, see _insert_alert().
+
+        If an alert cache is given the alert is classified from the cache when possible
+        and the cache is updated with the result of the write. A stale cache entry fails
+        the guard so it is dropped and the alert is re-classified from the database.
+
+        Returns a tuple of (action, alert) or (None, None) if the alert was not saved.
+        """
+        for attempt in range(_INGEST_ATTEMPTS_MAX):
+
+            hit = False
+            if cache is not None and attempt == 0:
+                hit, existing = cache.get(alert)
+            if not hit:
+                existing = self._get_correlated(alert, cache)
+
+            if not existing:
+                action = NEW_ALERT
+                response = self._insert_alert(alert)
+            elif existing['event'] == alert.event and existing['severity'] == alert.severity:
+                action = DUPLICATE_ALERT
+                response = self._find_and_modify(
+                    query={'_id': existing['_id'], 'event': existing['event'], 'severity': existing['severity'],
+                           'status': existing['status']},
+                    update=self._duplicate_update(alert, existing)
+                )
+            else:
+                action = CORRELATED_ALERT
+                response = self._find_and_modify(
+                    query={'_id': existing['_id'], 'event': existing['event'], 'severity': existing['severity'],
+                           'status': existing['status']},
+                    update=self._correlate_update(alert, existing)
+                )
+
+            if response:
+                if cache is not None:
+                    cache.update(response)
+                return action, response
+
+            if cache is not None:
+                cache.invalidate(alert)
+
+            LOG.warning('%s : Alert modified by another writer during %s update (attempt %d)', alert.get_id(),
+                        action, attempt + 1)
+
+        LOG.critical('%s : Alert could not be saved after %d attempts', alert.get_id(), _INGEST_ATTEMPTS_MAX)
+        return None, None
+
+    def ingest_alerts(self, alerts, cache=None):
+        """
+        Batch version of ingest_alert(). Alerts for every environment and resource in the batch
+        are read with one query, alerts for the same alert are applied in arrival order in memory
+        and the resulting changes are written with one unordered bulk operation. If an alert
+        cache is given alerts are classified from the cache when possible, so only the alerts
+        they update are read, by _id, and the cache is updated with the written alerts.
+
+        Returns a list of (action, alert) tuples in the same order as the alerts.
+        """
+        if not alerts:
+            return list()
+
+        groups = dict()
+        for alert in alerts:
+            groups.setdefault((tuple(alert.environment), alert.resource), list()).append(alert)
+
+        documents = self._cached_documents(groups, cache) if cache is not None else dict()
+
+        missing = [(environment, resource, set(alert.event for alert in group))
+                   for (environment, resource), group in groups.iteritems() if (environment, resource) not in documents]
+        if missing:
+            query = {'$or': [{"environment": list(environment), "resource": resource,
+                              '$or': [{"event": {'$in': list(e)}}, {"correlatedEvents": {'$in': list(e)}}]}
+                             for environment, resource, e in missing]}
+            for response in self.db.alerts.find(query, {"history": 0}):
+                documents.setdefault((tuple(response['environment']), response['resource']), list()).append(response)
+
+        changes = list()  # one change per alert document, in order of first change
+        change_for = dict()
+        results = list()
+
+        for position, alert in enumerate(alerts):
+            candidates = documents.setdefault((tuple(alert.environment), alert.resource), list())
+            existing = self._match_document(alert, candidates)
+
+            if not existing:
+                action = NEW_ALERT
+                document = self._new_alert_document(alert)
+                candidates.append(document)
+                change = {'document': document, 'insert': True, 'set': dict(), 'inc': 0, 'reset': False,
+                          'history': list(document['history']), 'alert': alert, 'positions': [position]}
+                change_for[document['_id']] = change
+                changes.append(change)
+            else:
+                if existing['event'] == alert.event and existing['severity'] == alert.severity:
+                    action = DUPLICATE_ALERT
+                    update = self._duplicate_update(alert, existing)
+                else:
+                    action = CORRELATED_ALERT
+                    update = self._correlate_update(alert, existing)
+
+                document = existing
+                change = change_for.get(document['_id'])
+                if not change:
+                    change = {'document': document, 'insert': False, 'set': dict(), 'inc': 0, 'reset': False,
+                              'history': list(), 'alert': alert, 'positions': list(),
+                              'guard': {'_id': document['_id'], 'event': document['event'],
+                                        'severity': document['severity'], 'status': document['status']}}
+                    change_for[document['_id']] = change
+                    changes.append(change)
+                change['positions'].append(position)
+                self._apply_update(document, update, change)
+
+            results.append((action, Alert.from_document(document)))
+
+        bulk = self.db.alerts.initialize_unordered_bulk_op()
+        for change, change_seq in zip(changes, self._next_changes(len(changes))):
+            document = change['document']
+            change['changeSeq'] = change_seq['changeSeq']
+            if change['insert']:
+                alert = change['alert']
+                document.update(change_seq)
+                document['history'] = self._trim_history(change['history'])
+                bulk.find({"environment": alert.environment, "resource": alert.resource,
+                           '$or': [{"event": alert.event}, {"correlatedEvents": alert.event}]}) \
+                    .upsert().update_one({'$setOnInsert': document})
+            else:
+                update = {'$set': change['set']}
+                update['$set'].update(change_seq)
+                if change['reset']:
+                    update['$set']['duplicateCount'] = document['duplicateCount']
+                elif change['inc']:
+                    update['$inc'] = {"duplicateCount": change['inc']}
+                if change['history']:
+                    update['$push'] = self._push_history(change['history'])
+                bulk.find(change['guard']).update_one(update)
+
+        try:
+            response = bulk.execute()
+        except pymongo.errors.BulkWriteError, e:
+            LOG.error('Bulk write of %d alerts failed: %s', len(alerts), e.details.get('writeErrors'))
+            response = e.details
+
+        # there is one write per change, so write errors are indexed by change
+        failed = set([error['index'] for error in response.get('writeErrors', list())])
+        upserted = set([u['index'] for u in response.get('upserted', list())])
+
+        # new alerts not upserted were inserted by another writer after classification, and match it
+        matched = [index for index, change in enumerate(changes) if index not in failed and index not in upserted]
+        if response['nMatched'] < len(matched):
+            failed.update(self._unwritten(changes, [index for index in matched if not changes[index]['insert']]))
+
+        self._save_histories([(change['document']['_id'], change['history']) for index, change in enumerate(changes)
+                              if change['history'] and index not in failed and
+                              (index in upserted or not change['insert'])])
+
+        # alerts that were not written, because they were modified by another writer or could not be written,
+        # are ingested one by one in order
+        for index, change in enumerate(changes):
+            if index in failed or (change['insert'] and index not in upserted):
+                LOG.warning('%s : Alert modified by another writer or not written during batch update',
+                            change['document']['_id'])
+                if cache is not None:
+                    cache.invalidate(change['alert'])
+                for position in change['positions']:
+                    results[position] = self.ingest_alert(alerts[position], cache)
+            elif cache is not None:
+                cache.update(results[change['positions'][-1]][1])
+
+        return results
+
+    def _unwritten(self, changes, indexes):
+        """
+        Indexes of the batch updates that did not match their alert, because it was modified or deleted after
+        it was classified. An unordered bulk write only counts the updates that matched, so the alerts are read
+        to find the ones that don't have the changeSeq of the update.
+        """
+        written = dict()
+        for response in self.db.alerts.find({'_id': {'$in': [changes[index]['document']['_id'] for index in indexes]}},
+                                            {"changeSeq": 1}):
+            written[response['_id']] = response.get('changeSeq')
+
+        unwritten = [index for index in indexes
+                     if written.get(changes[index]['document']['_id']) != changes[index]['changeSeq']]
+        LOG.warning('%d of %d alerts were modified or deleted before they could be updated', len(unwritten),
+                    len(indexes))
+        return unwritten
+
+    def _cached_documents(self, groups, cache):
+        """
+        Documents for the batch alerts grouped by environment and resource that are classified by the cache,
+        read by _id because the bulk write doesn't return the updated alerts. A resource whose alerts are all
+        new in the cache needs no read at all. A resource that has changed since it was cached is dropped from
+        the cache and left to be read by the batch query.
+        """
+        cached = dict()
+        for key, group in groups.iteritems():
+            entries = cache.get_resource(key[0], key[1], group)
+            if entries is not None:
+                cached[key] = entries
+
+        ids = [entry['_id'] for entries in cached.itervalues() for entry in entries]
+        found = dict()
+        if ids:
+            for response in self.db.alerts.find({'_id': {'$in': ids}}, {"history": 0}):
+                found[response['_id']] = response
+
+        documents = dict()
+        for key, entries in cached.iteritems():
+            if all(entry['_id'] in found and all(found[entry['_id']].get(k) == entry[k]
+                                                 for k in ('event', 'correlatedEvents', 'severity', 'status'))
+                   for entry in entries):
+                documents[key] = [found[entry['_id']] for entry in entries]
+            else:
+                LOG.debug('Cached alerts for %s %s are stale', key[0], key[1])
+                cache.invalidate(groups[key][0])
+
+        return documents
+
+    def _get_correlated(self, alert, cache=None):
+
+        if cache is not None:
+            # load every alert for the environment and resource so that the cache can also tell new alerts
+            documents = list(self.db.alerts.find({"environment": alert.environment, "resource": alert.resource},
+                                                 {"event": 1, "correlatedEvents": 1, "severity": 1, "status": 1,
+                                                  "duplicateCount": 1}))
+            cache.load(alert, documents)
+            return self._match_document(alert, documents)
+
+        return self._match_document(
+            alert,
+            self.db.alerts.find({"environment": alert.environment, "resource": alert.resource,
+                                 '$or': [{"event": alert.event}, {"correlatedEvents": alert.event}]},
+                                {"event": 1, "correlatedEvents": 1, "severity": 1, "status": 1})
         )
 
+    @staticmethod
+    def _match_document(alert, documents):
+
+        found = None
+        for document in documents:
+            if document['event'] == alert.event:
+                return document  # exact event match takes precedence over correlated events
+            if not found and alert.event in (document.get('correlatedEvents') or list()):
+                found = document
+
+        return found
+
+    @staticmethod
+    def _apply_update(document, update, change):
+
+        document.update(update['$set'])
+        change['set'].update(update['$set'])
+
+        if 'duplicateCount' in update['$set']:
+            change['reset'] = True
+            change['inc'] = 0
+        if '$inc' in update:
+            document['duplicateCount'] = document.get('duplicateCount', 0) + update['$inc']['duplicateCount']
+            change['inc'] += update['$inc']['duplicateCount']
+
+        if '$push' in update:
+            history = update['$push']['history']
+            change['history'].extend(history['$each'] if '$each' in history else [history])
+
+    @staticmethod
+    def _event_history(alert):
+
+        return {
+            "id": alert.alertid,
+            "event": alert.event,
+            "severity": alert.severity,
+            "value": alert.value,
+            "text": alert.text,
+            "createTime": alert.create_time,
+            "receiveTime": alert.receive_time,
+        }
+
+    @staticmethod
+    def _status_history(status, text='Alerta server'):
+
+        update_time = datetime.datetime.utcnow()
+        update_time = update_time.replace(tzinfo=pytz.utc)
+
+        return {
+            "status": status,
+            "updateTime": update_time,
+            "text": text,
+        }
+
+    @staticmethod
+    def _push_history(history):
+        """
+        Push history onto an alert, keeping only the latest history_limit entries. Full history is
+        in the history collection.
+        """
+        return {"history": {'$each': history, '$slice': -abs(CONF.history_limit)}}
+
+    @staticmethod
+    def _trim_history(history):
+        """
+        The latest history_limit entries of history, as kept in an alert by _push_history().
+        """
+        limit = abs(CONF.history_limit)
+        return history[-limit:] if limit else list()
+
+    @staticmethod
+    def _history_document(alertid, entry):
+
+        document = dict(entry, alertId=alertid)
+        history_time = entry.get('updateTime') or entry.get('receiveTime') or datetime.datetime.utcnow()
+        if history_time.tzinfo:
+            history_time = history_time.astimezone(pytz.utc).replace(tzinfo=None)
+        document['historyTime'] = history_time
+        return document
+
+    def _save_history(self, alertid, history):
+
+        self._save_histories([(alertid, history)])
+
+    def _save_histories(self, histories):
+        """
+        Insert history for alerts in one unacknowledged write, so saving history doesn't add a round-trip
+        to ingesting alerts. Alerts keep their latest history_limit entries whatever happens to it.
+        """
+        documents = [self._history_document(alertid, entry) for alertid, history in histories for entry in history]
+        if not documents:
+            return
+        try:
+            self.db.history.insert(documents, w=0)  # unacknowledged write, no round-trip
+        except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
+            LOG.error('MongoDB error: %s', e)
+
+    def get_history(self, alertid, before=None, limit=100):
+        """
+        Returns history for an alert, newest first, before a (historyTime, _id) position. Returns None
+        if there is no such alert and no history for it.
+        """
+        if len(alertid) != _ID_LENGTH:
+            response = self.db.alerts.find_one(self._id_query(alertid, last_receive_id=False), {"_id": 1})
+            if not response:
+                return
+            alertid = response['_id']
+
+        query = {'alertId': alertid}
+        if before:
+            history_time, history_id = before
+            query['$or'] = [{'historyTime': {'$lt': history_time}},
+                            {'historyTime': history_time, '_id': {'$lt': ObjectId(history_id)}}]
+
+        return list(self.db.history.find(query, sort=[('historyTime', pymongo.DESCENDING),
+                                                      ('_id', pymongo.DESCENDING)]).limit(limit))
+
+    def migrate_history(self, batch_size=100):
+        """
+        Copy history embedded in alerts to the history collection and trim it to the latest history_limit
+        entries. Entries already in the history collection are not copied again. Returns the number of
+        alerts and entries migrated.
+        """
+        alerts = 0
+        entries = 0
+        for response in self.db.alerts.find({'history.0': {'$exists': True}}, {"history": 1}).batch_size(batch_size):
+            for entry in response['history']:
+                document = self._history_document(response['_id'], entry)
+                self.db.history.update(document, document, upsert=True)
+                entries += 1
+            self.db.alerts.update({'_id': response['_id']}, {'$push': self._push_history(list())})
+            alerts += 1
+
+        return alerts, entries
+
+    def _new_alert_document(self, alert):
+
+        status = alert.status
+        if status == status_code.UNKNOWN:
+            status = severity_code.status_from_severity(severity_code.UNKNOWN, alert.severity)
+
+        body = alert.get_body()
+        body.update({
+            "status": status,
+            "repeat": False,
+            "duplicateCount": 0,
+            "lastReceiveId": alert.alertid,
+            "lastReceiveTime": alert.receive_time,
+            "trendIndication": severity_code.trend(severity_code.UNKNOWN, alert.severity),
+            "history": [self._event_history(alert), self._status_history(status)],
+        })
+        body['_id'] = body['id']
+        body['shortId'] = body['id'][:_SHORT_ID_LENGTH]
+        del body['id']
+
+        return body
+
+    def _insert_alert(self, alert):
+
+        body = self._new_alert_document(alert)
+        body.update(self._next_change())
+        history = body['history']
+        body['history'] = self._trim_history(history)
+
+        # insert only if no alert was created for the same environment, resource and event since it was classified.
+        # This is not atomic: there is no unique index that could cover the $or, so two concurrent upserts can both
+        # miss and both insert. Alerts for the same environment and resource are sent to the same worker by the
+        # dispatcher, after they are transformed, so that this does not happen within one alerta server.
+        no_obj_error = "No matching object found"
+        try:
+            response = self.db.command("findAndModify", 'alerts',
+                                       allowable_errors=[no_obj_error],
+                                       query={"environment": alert.environment, "resource": alert.resource,
+                                              '$or': [{"event": alert.event}, {"correlatedEvents": alert.event}]},
+                                       update={'$setOnInsert': body},
+                                       upsert=True,
+                                       new=False,
+                                       fields={"_id": 1})['value']
+        except pymongo.errors.InvalidDocument, e:
+            LOG.critical('Attempt to insert invalid document - %s: %s', e, body)
+            return
+        except pymongo.errors.OperationFailure, e:
+            LOG.critical('Unhandled exception - %s: %s', e, body)
+            return
+
+        if response:
+            return  # existing alert found so not inserted
+
+        self._save_history(body['_id'], history)
+
+        alert.status = body['status']
+        alert.repeat = body['repeat']
+        alert.duplicate_count = body['duplicateCount']
+        alert.last_receive_id = body['lastReceiveId']
+        alert.last_receive_time = body['lastReceiveTime']
+        alert.trend_indication = body['trendIndication']
+
+        return alert
+
+    def _duplicate_update(self, alert, existing):
+
+        update = {
+            '$set': {
+                "correlatedEvents": alert.correlate,
+                "group": alert.group,
+                "value": alert.value,
+                "service": alert.service,
+                "text": alert.text,
+                "tags": alert.tags,
+                "origin": alert.origin,
+                "repeat": True,
+                "thresholdInfo": alert.threshold_info,
+                "summary": alert.summary,
+                "timeout": alert.timeout,
+                "lastReceiveId": alert.alertid,
+                "expireTime": alert.expire_time,
+                "lastReceiveTime": alert.receive_time,
+                "rawData": alert.raw_data,
+                "moreInfo": alert.more_info,
+                "graphUrls": alert.graph_urls,
+            },
+            '$inc': {"duplicateCount": 1}
+        }
+
+        if alert.status != status_code.UNKNOWN and alert.status != existing['status']:
+            update['$set']['status'] = alert.status
+            update['$push'] = self._push_history([self._status_history(alert.status)])
+
+        return update
+
+    def _correlate_update(self, alert, existing):
+
+        previous_severity = existing['severity']
+        trend_indication = severity_code.trend(previous_severity, alert.severity)
+
+        status = alert.status
+        if status == status_code.UNKNOWN:
+            status = severity_code.status_from_severity(previous_severity, alert.severity, existing['status'])
+
+        history = [self._event_history(alert)]
+        if status != existing['status']:
+            history.append(self._status_history(status))
+
+        return {
+            '$set': {
+                "event": alert.event,
+                "correlatedEvents": alert.correlate,
+                "group": alert.group,
+                "value": alert.value,
+                "status": status,
+                "severity": alert.severity,
+                "previousSeverity": previous_severity,
+                "service": alert.service,
+                "text": alert.text,
+                "tags": alert.tags,
+                "origin": alert.origin,
+                "repeat": False,
+                "duplicateCount": 0,
+                "thresholdInfo": alert.threshold_info,
+                "summary": alert.summary,
+                "timeout": alert.timeout,
+                "lastReceiveId": alert.alertid,
+                "createTime": alert.create_time,
+                "expireTime": alert.expire_time,
+                "receiveTime": alert.receive_time,
+                "lastReceiveTime": alert.receive_time,
+                "trendIndication": trend_indication,
+                "rawData": alert.raw_data,
+                "moreInfo": alert.more_info,
+                "graphUrls": alert.graph_urls,
+            },
+            '$push': self._push_history(history)
+        }
+
+    def _find_and_modify(self, query, update):
+
+        update['$set'].update(self._next_change())
+
+        # FIXME - no native find_and_modify method in this version of pymongo
+        no_obj_error = "No matching object found"
+        response = self.db.command("findAndModify", 'alerts',
+                                   allowable_errors=[no_obj_error],
+                                   query=query,
+                                   update=update,
+                                   new=True,
+                                   fields={"history": 0})['value']
+
+        if not response:
+            return
+
+        if '$push' in update:
+            self._save_history(response['_id'], update['$push']['history']['$each'])
+
+        return Alert.from_document(response)
+
     def get_resources(self, query=None, sort=None, limit=0):
 
         query = query or dict()
         sort = sort or dict()
+        self.shapes.record('resources', query, sort)
 
         response = self.db.alerts.find(query, sort=sort).limit(limit)
         if not response:
@@ -498,10 +1002,146 @@ class Mongo(object):
 
     def delete_resource(self, resource):
 
-        response = self.db.alerts.remove({'resource': {'$regex': '^' + resource}})
+        query = {'resource': {'$regex': '^' + resource}}
+        self.shapes.record('delete', query)
+
+        return self._delete_alerts(query)
+
+    def _delete_alerts(self, query):
+
+        alertids = [response['_id'] for response in self.db.alerts.find(query, {"_id": 1})]
+        if not alertids:
+            return True
+
+        response = self.db.alerts.remove({'_id': {'$in': alertids}})
+
+        # deleted alerts are kept as tombstones so the changes feed can tell consoles to remove them
+        tombstones = list()
+        for alertid, change in zip(alertids, self._next_changes(len(alertids))):
+            change['id'] = alertid
+            tombstones.append(change)
+        self.db.tombstones.insert(tombstones)
+        self._purge_tombstones()
 
         return True if 'ok' in response else False
 
+    def _purge_tombstones(self):
+
+        expired = {'changeTime': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=CONF.tombstone_retention)}}
+
+        last = self.db.tombstones.find_one(expired, {"changeSeq": 1}, sort=[('changeSeq', pymongo.DESCENDING)])
+        if not last:
+            return
+
+        # clients that have not seen changes after the last purged tombstone must reload all alerts
+        self.db.counters.update({'_id': 'changes'}, {'$max': {'purged': last['changeSeq']}}, upsert=True)
+        self.db.tombstones.remove(expired)
+
+    def _next_change(self):
+
+        return self._next_changes(1)[0]
+
+    def _next_changes(self, count):
+        """
+        Reserve change sequence numbers. Every write to an alert sets changeSeq to a new, increasing number
+        and changeTime to the time it was reserved. Returns a list of count {changeSeq, changeTime} dicts.
+
+        Numbers are reserved from the counters collection in blocks of change_block_size to save a
+        findAndModify for every write. A block is only used for _CHANGE_BLOCK_LEASE seconds after it was
+        reserved and its changeTime is that time, so that get_changes can still assume a write with a lower
+        number than one it has seen happened within _CHANGE_LAG seconds of its changeTime. Unused numbers
+        are skipped.
+        """
+        if not count:
+            return list()
+
+        with self.change_lock:
+            now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+            block = self.change_block
+            if (not block or block[1] - block[0] + 1 < count
+                    or now - block[2] >= datetime.timedelta(seconds=_CHANGE_BLOCK_LEASE)):
+                size = max(count, CONF.change_block_size)
+
+                # FIXME - no native find_and_modify method in this version of pymongo
+                response = self.db.command("findAndModify", 'counters',
+                                           query={'_id': 'changes'},
+                                           update={'$inc': {"seq": size}, '$set': {"changeTime": now}},
+                                           upsert=True,
+                                           new=True)['value']
+                block = self.change_block = [response['seq'] - size + 1, response['seq'], now]
+
+            first = block[0]
+            block[0] += count
+
+        return [{"changeSeq": seq, "changeTime": block[2]} for seq in range(first, first + count)]
+
+    def get_changes(self, since=0, query=None, fields=None, limit=0):
+        """
+        Returns alerts changed after the change sequence number since, in change order. Changed alerts that
+        no longer match the query and deleted alerts are returned as deleted ids. If since is zero, or too
+        old to know which alerts were deleted, all alerts that match the query are returned with resync set.
+
+        The returned seq is the change sequence number to use for the next request. It only includes changes
+        older than _CHANGE_LAG seconds so a write that reserved an earlier number is not missed, which means
+        recent changes can be returned again.
+        """
+        query = query or dict()
+        self.shapes.record('changes', query)
+
+        counter = self.db.counters.find_one({'_id': 'changes'}) or dict()
+        resync = not since or since <= counter.get('purged', 0)
+
+        if resync:
+            since = 0
+            changes = list(self.db.alerts.find(query, {"changeSeq": 1, "changeTime": 1})
+                           .sort('changeSeq', pymongo.ASCENDING))
+            tombstones = list()
+            more = False
+        else:
+            changes = list(self.db.alerts.find({'changeSeq': {'$gt': since}}, {"changeSeq": 1, "changeTime": 1})
+                           .sort('changeSeq', pymongo.ASCENDING).limit(limit))
+            tombstones = list(self.db.tombstones.find({'changeSeq': {'$gt': since}})
+                              .sort('changeSeq', pymongo.ASCENDING).limit(limit))
+            changes = sorted(changes + tombstones, key=lambda c: c['changeSeq'])
+            more = limit and len(changes) > limit
+            if more:
+                changes = changes[:limit]
+
+        alertids = [c['_id'] for c in changes if 'id' not in c]
+        if query:
+            found = self.db.alerts.find({'$and': [query, {'_id': {'$in': alertids}}]}, fields=fields)
+        else:
+            found = self.db.alerts.find({'_id': {'$in': alertids}}, fields=fields)
+        documents = dict((document['_id'], document) for document in found)
+
+        alerts = list()
+        deleted = list()
+        for change in changes:
+            if 'id' in change:
+                deleted.append(change['id'])
+            elif change['_id'] in documents:
+                alerts.append(Alert.from_document(documents[change['_id']]))
+            elif not resync:
+                deleted.append(change['_id'])  # no longer matches the query
+
+        seq = since
+        safe_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=_CHANGE_LAG)
+        for change in changes:
+            if change.get('changeTime') and change['changeTime'].replace(tzinfo=None) <= safe_time:
+                seq = max(seq, change['changeSeq'])
+
+        # every change has been written if no number was reserved recently
+        if not more and counter.get('changeTime') and counter['changeTime'].replace(tzinfo=None) <= safe_time:
+            seq = max(seq, counter['seq'])
+
+        return {
+            "alerts": alerts,
+            "deleted": deleted,
+            "seq": seq,
+            "more": bool(more),
+            "resync": resync,
+        }
+
     def get_heartbeats(self):
 
         heartbeats = list()
@@ -518,7 +1158,7 @@ class Mongo(object):
 
         try:
             self.db.heartbeats.update(query, update, True)
-        except pymongo.errors.OperationFailure, e:
+        except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
             LOG.error('MongoDB error: %s', e)
 
     def get_metrics(self):
@@ -529,29 +1169,67 @@ class Mongo(object):
             metrics.append(stat)
         return metrics
 
-    def update_queue_metric(self, queue_length):
+    def update_queue_metric(self, queue_lengths):
 
-        try:
-            self.db.metrics.update(
-                {
-                    "group": "alerts",
-                    "name": "queueLength",
-                    "type": "gauge",
-                    "title": "Alert internal queue length",
-                    "description": "Number of alerts waiting on the internal queue for processing"
-                },
-                {
-                    '$set': {"value": queue_length}
-                },
-                True)
-        except pymongo.errors.OperationFailure, e:
-            LOG.error('MongoDB error: %s', e)
+        for shard, queue_length in enumerate(queue_lengths):
+            try:
+                self.db.metrics.update(
+                    {
+                        "group": "alerts",
+                        "name": "shard%dQueueLength" % shard,
+                        "type": "gauge",
+                        "title": "Alert internal queue length for shard %d" % shard,
+                        "description": "Number of alerts waiting on the internal queue of worker %d for processing" % shard
+                    },
+                    {
+                        '$set': {"value": queue_length}
+                    },
+                    True)
+            except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
+                LOG.error('MongoDB error: %s', e)
+
+    def update_cache_metric(self, stats):
+
+        for name, title, description, metric_type in [
+            ('hits', 'Alert cache hits', 'Number of alerts classified from the alert cache', 'counter'),
+            ('misses', 'Alert cache misses', 'Number of alerts classified from the database', 'counter'),
+            ('evictions', 'Alert cache evictions', 'Number of resources evicted from the alert cache', 'counter'),
+            ('size', 'Alert cache size', 'Number of resources in the alert cache', 'gauge'),
+        ]:
+            try:
+                self.db.metrics.update(
+                    {
+                        "group": "cache",
+                        "name": name,
+                        "type": metric_type,
+                        "title": title,
+                        "description": description
+                    },
+                    {
+                        '$set': {"value": stats[name]}
+                    },
+                    True)
+            except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
+                LOG.error('MongoDB error: %s', e)
 
     def update_timer_metric(self, create_time, receive_time):
 
-        # receive latency
-        delta = receive_time - create_time
-        latency = int(delta.days * 24 * 60 * 60 * 1000 + delta.seconds * 1000 + delta.microseconds / 1000)
+        self.update_timer_metrics([(create_time, receive_time)])
+
+    def update_timer_metrics(self, timings):
+
+        now = datetime.datetime.utcnow()
+        receive_latency = 0
+        process_latency = 0
+
+        for create_time, receive_time in timings:
+            # receive latency
+            delta = receive_time - create_time
+            receive_latency += int(delta.days * 24 * 60 * 60 * 1000 + delta.seconds * 1000 + delta.microseconds / 1000)
+
+            # processing latency
+            delta = now - receive_time
+            process_latency += int(delta.days * 24 * 60 * 60 * 1000 + delta.seconds * 1000 + delta.microseconds / 1000)
 
         try:
             self.db.metrics.update(
@@ -563,16 +1241,12 @@ class Mongo(object):
                     "description": "Time taken for alert to be received by the server"
                 },
                 {
-                    '$inc': {"count": 1, "totalTime": latency}
+                    '$inc': {"count": len(timings), "totalTime": receive_latency}
                 },
-                True)
-        except pymongo.errors.OperationFailure, e:
+                True, w=0)  # unacknowledged write, no round-trip
+        except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
             LOG.error('MongoDB error: %s', e)
 
-        # processing latency
-        delta = datetime.datetime.utcnow() - receive_time
-        latency = int(delta.days * 24 * 60 * 60 * 1000 + delta.seconds * 1000 + delta.microseconds / 1000)
-
         try:
             self.db.metrics.update(
                 {
@@ -583,10 +1257,10 @@ class Mongo(object):
                     "description": "Time taken to process the alert on the server"
                 },
                 {
-                    '$inc': {"count": 1, "totalTime": latency}
+                    '$inc': {"count": len(timings), "totalTime": process_latency}
                 },
-                True)
-        except pymongo.errors.OperationFailure, e:
+                True, w=0)  # unacknowledged write, no round-trip
+        except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
             LOG.error('MongoDB error: %s', e)
 
     def disconnect(self):
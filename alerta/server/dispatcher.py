@@ -0,0 +1,80 @@
+
+import zlib
+import Queue
+
+from alerta.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """
+    Distribute alerts across a fixed number of internal queues, one per worker, by hashing the
+    alert correlation key. Alerts are correlated by environment and resource (events for the same
+    resource correlate with each other) so every alert for the same environment and resource is
+    processed in order by the same worker without any locking. Alerts are dispatched once they
+    have been transformed, so that they are sharded by the key they are saved with.
+
+    >>> dispatcher = Dispatcher(4)
+    >>> dispatcher.put(alert)                # queued on dispatcher.queues[dispatcher.shard(alert)]
+    >>> worker = WorkerThread(mq, dispatcher.queues[0], statsd)
+
+    Items that are not yet parsed can be dispatched by key, eg. raw messages to worker processes
+
+    >>> dispatcher = Dispatcher(2, queue_class=multiprocessing.Queue)
+    >>> dispatcher.put((headers, body), key=Dispatcher.correlation_key(environment, resource))
+    """
+
+    def __init__(self, shards, queue_class=Queue.Queue):
+
+        self.shards = max(int(shards), 1)
+        self.queues = [queue_class() for i in range(self.shards)]
+
+        LOG.info('Dispatching alerts to %d shards', self.shards)
+
+    @staticmethod
+    def correlation_key(environment, resource):
+
+        # environment is a list, but may be a string in raw JSON or after a transform
+        if isinstance(environment, basestring):
+            environment = [environment]
+
+        return '%s/%s' % (','.join(environment or ['PROD']), resource)
+
+    @staticmethod
+    def shard_key(item):
+
+        if item.get_type() == 'Heartbeat':
+            return item.origin
+        else:
+            return Dispatcher.correlation_key(item.environment, item.resource)
+
+    @staticmethod
+    def shard_for(key, shards):
+
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        # crc32 is stable across processes and Python versions, unlike hash()
+        return (zlib.crc32(key) & 0xffffffff) % shards
+
+    def shard(self, item, key=None):
+
+        return self.shard_for(key or self.shard_key(item), self.shards)
+
+    def put(self, item, key=None):
+
+        self.queues[self.shard(item, key)].put(item)
+
+    def qsize(self):
+
+        return sum(self.qsizes())
+
+    def qsizes(self):
+
+        return [q.qsize() for q in self.queues]
+
+    def shutdown(self):
+
+        for q in self.queues:
+            q.put(None)
@@ -0,0 +1,281 @@
+
+import re
+import json
+import time
+import datetime
+import threading
+
+import pymongo
+
+from alerta.common import log as logging
+from alerta.common import config
+
+LOG = logging.getLogger(__name__)
+CONF = config.CONF
+
+_RE_TYPE = type(re.compile(''))
+
+_EQUALITY_OPS = ('$eq', '$in')
+_RANGE_OPS = ('$gt', '$gte', '$lt', '$lte')
+
+# MongoDB can't create a compound index on more than one array field
+_ARRAY_FIELDS = ('environment', 'service', 'correlatedEvents', 'tags', 'graphUrls', 'history')
+
+# indexes used by the server itself, whatever queries consoles run
+REQUIRED_INDEXES = {
+    'alerts': [
+        [('environment', 1), ('resource', 1), ('event', 1), ('severity', 1)],  # duplicate and correlation checks
+        [('status', 1), ('expireTime', 1)],                                   # alert cache warm-up and housekeeping
+        [('lastReceiveTime', -1), ('_id', -1)],                               # paging GET /alerts
+        [('changeSeq', 1)],                                                   # changes feed
+        [('shortId', 1)],                                                     # lookups by short id
+        [('lastReceiveId', 1)],                                               # lookups by id of last duplicate
+    ],
+    'tombstones': [
+        [('changeSeq', 1)],
+        [('changeTime', 1)],
+    ],
+    'history': [
+        [('alertId', 1), ('historyTime', -1), ('_id', -1)],                  # paging alert history
+    ],
+}
+
+
+def _anchored(pattern, flags=0):
+
+    return pattern.startswith('^') and '|' not in pattern and not flags & re.IGNORECASE
+
+
+def _classify(condition):
+    """
+    Returns 'equality', 'range' or 'filter' for how an index can be used for a condition on a field.
+    """
+    if isinstance(condition, _RE_TYPE):
+        return 'range' if _anchored(condition.pattern, condition.flags) else 'filter'
+
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        if any(op in condition for op in _EQUALITY_OPS):
+            return 'equality'
+        if any(op in condition for op in _RANGE_OPS):
+            return 'range'
+        regex = condition.get('$regex')
+        if isinstance(regex, _RE_TYPE) and _anchored(regex.pattern, regex.flags):
+            return 'range'
+        if isinstance(regex, basestring) and _anchored(regex, re.I if 'i' in condition.get('$options', '') else 0):
+            return 'range'
+        return 'filter'
+
+    return 'equality'
+
+
+def _shapes(query):
+
+    shapes = [(frozenset(), frozenset(), frozenset())]
+    for key, condition in query.iteritems():
+        if key == '$and':
+            for q in condition:
+                shapes = [tuple(a | b for a, b in zip(shape, other)) for shape in shapes for other in _shapes(q)]
+        elif key == '$or':
+            alternatives = [other for q in condition for other in _shapes(q)]
+            shapes = [tuple(a | b for a, b in zip(shape, other)) for shape in shapes for other in alternatives]
+        elif key.startswith('$'):
+            continue
+        else:
+            kind = ('equality', 'range', 'filter').index(_classify(condition))
+            shapes = [tuple(s | frozenset([key]) if i == kind else s for i, s in enumerate(shape)) for shape in shapes]
+
+    return shapes
+
+
+def query_shapes(query, sort=None):
+    """
+    The shape of a query is the fields it tests for equality, the fields it tests for a range of values,
+    the fields an index can't be used for, and the sort order. A query with $or has a shape for each
+    clause, because MongoDB plans each one separately.
+
+    >>> query_shapes({'status': 'open', 'resource': {'$regex': '^web'}}, [('lastReceiveTime', -1)])
+    [{'equality': ['status'], 'range': ['resource'], 'filter': [], 'sort': [['lastReceiveTime', -1]]}]
+    """
+    sort = [[field, direction] for field, direction in (sort or list())]
+
+    shapes = list()
+    for equality, ranges, filters in _shapes(query or dict()):
+        shape = {
+            'equality': sorted(equality),
+            'range': sorted(ranges - equality),
+            'filter': sorted(filters - equality - ranges),
+            'sort': sort,
+        }
+        if shape not in shapes:
+            shapes.append(shape)
+
+    return shapes
+
+
+def shape_key(shape):
+
+    return json.dumps([shape['equality'], shape['range'], shape['filter'], shape['sort']])
+
+
+class QueryShapes(object):
+    """
+    Counts the shapes of queries and adds the counts to the queryShapes collection every interval
+    seconds, so that the index advisor can see the queries that are actually run.
+    """
+
+    def __init__(self, collection, interval):
+
+        self.collection = collection
+        self.interval = interval
+
+        self.counts = dict()  # key -> [shape, count, sources]
+        self.last_write = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, source, query, sort=None):
+
+        if not self.interval:
+            return
+
+        shapes = query_shapes(query, sort)
+        with self.lock:
+            for shape in shapes:
+                key = shape_key(shape)
+                if key not in self.counts:
+                    self.counts[key] = [shape, 0, set()]
+                self.counts[key][1] += 1
+                self.counts[key][2].add(source)
+            if time.time() - self.last_write < self.interval:
+                return
+            counts, self.counts = self.counts, dict()
+            self.last_write = time.time()
+
+        self.write(counts)
+
+    def write(self, counts):
+
+        now = datetime.datetime.utcnow()
+        for key, (shape, count, sources) in counts.iteritems():
+            try:
+                self.collection.update(
+                    {'_id': key},
+                    {
+                        '$set': dict(shape, lastSeen=now),
+                        '$inc': {'count': count},
+                        '$addToSet': {'sources': {'$each': sorted(sources)}}
+                    },
+                    True, w=0)  # unacknowledged write, no round-trip
+            except (pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure), e:
+                LOG.error('MongoDB error: %s', e)
+                return
+
+
+def _is_array(field):
+
+    return field.split('.')[0] in _ARRAY_FIELDS
+
+
+def _serves(keys, shape):
+    """
+    True if an index can be used for the equality fields and sort order of a query shape, or for a
+    range if the query has neither. Only one array field can be in an index.
+    """
+    equality = set(shape['equality'])
+    scalars = set(field for field in equality if not _is_array(field))
+    count = len(scalars) + int(len(scalars) < len(equality))
+
+    fields = [field for field, direction in keys[:count]]
+    if not scalars.issubset(fields) or not equality.issuperset(fields) or len(set(fields)) < count:
+        return False
+    rest = keys[count:]
+
+    sort = [tuple(s) for s in shape['sort'] if s[0] not in equality]
+    if sort:
+        reverse = [(field, -direction) for field, direction in sort]
+        return rest[:len(sort)] in (sort, reverse)
+
+    if equality:
+        return True
+    return bool(rest) and rest[0][0] in shape['range']
+
+
+def index_for(shape):
+    """
+    Compound index for a query shape: equality fields, then sort fields, then a range field. Returns
+    None if no index can be used for the shape.
+    """
+    keys = list()
+    array = False
+    ranged = False
+
+    candidates = [(field, 1) for field in shape['equality']] + [tuple(s) for s in shape['sort']] + \
+                 [(field, 1) for field in shape['range']]
+    for field, direction in candidates:
+        if field in [k for k, d in keys]:
+            continue
+        if _is_array(field):
+            if array:
+                continue
+            array = True
+        if field in shape['range']:
+            if ranged:
+                continue  # only the first range field narrows the index scan
+            ranged = True
+        keys.append((field, direction))
+
+    return keys or None
+
+
+def index_name(keys):
+
+    return '_'.join('%s_%s' % (field, direction) for field, direction in keys)
+
+
+def recommend_indexes(existing, shapes, required=None):
+    """
+    Compares the existing indexes on the alerts collection with the recorded query shapes. Returns
+    the indexes to create for shapes that no index can be used for, redundant indexes that are a
+    prefix of another index, unused indexes that no shape or required index needs, and shapes that
+    no index can be used for (eg. case-insensitive regexes or $ne).
+    """
+    required = required or REQUIRED_INDEXES['alerts']
+
+    # older servers return index directions as floats
+    existing = dict((name, [(field, int(direction) if isinstance(direction, float) else direction)
+                            for field, direction in keys]) for name, keys in existing.iteritems())
+    indexes = existing.values()
+
+    create = [keys for keys in required if keys not in indexes]
+    required = required + [[('_id', 1)]]
+    unindexable = list()
+    used = list()
+
+    for shape in sorted(shapes, key=lambda s: s.get('count', 0), reverse=True):
+        serving = [keys for keys in indexes + create if _serves(keys, shape)]
+        if serving:
+            used.extend(serving)
+            continue
+        keys = index_for(shape)
+        if keys:
+            create.append(keys)
+        else:
+            unindexable.append(shape)
+
+    # an index that is a prefix of another can be dropped, unless the server relies on it
+    candidates = indexes + create
+    drop = list()
+    for name, keys in sorted(existing.iteritems()):
+        if keys in required:
+            continue
+        if any(len(other) > len(keys) and other[:len(keys)] == keys for other in candidates):
+            drop.append(name)
+
+    unused = [name for name, keys in sorted(existing.iteritems())
+              if name not in drop and keys not in required and keys not in used]
+
+    return {
+        'create': create,
+        'drop': drop,
+        'unused': unused,
+        'unindexable': unindexable,
+    }
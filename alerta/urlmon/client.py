@@ -0,0 +1,252 @@
+
+import ssl
+import time
+import socket
+import base64
+import httplib
+import urlparse
+import threading
+
+from collections import namedtuple
+
+from alerta.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+_MAX_REDIRECTS = 5
+_CHUNK_SIZE = 65536
+
+Response = namedtuple('Response', 'status reason headers body truncated timings')
+
+
+def _connect(conn):
+    """
+    Connect like httplib, recording how long the DNS lookup and TCP connect took.
+    """
+    start = time.time()
+    addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    conn.timings['dns'] = time.time() - start
+
+    start = time.time()
+    error = socket.error('getaddrinfo returns an empty list')
+    for family, socktype, proto, _, address in addresses:
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(conn.timeout)
+        try:
+            sock.connect(address)
+        except socket.error, e:
+            error = e
+            sock.close()
+            continue
+        break
+    else:
+        raise error
+    conn.sock = sock
+    conn.timings['connect'] = time.time() - start
+
+    if conn._tunnel_host:
+        conn._tunnel()
+
+
+class TimedHTTPConnection(httplib.HTTPConnection):
+
+    timings = None
+    last_used = 0
+
+    def connect(self):
+
+        _connect(self)
+
+
+class TimedHTTPSConnection(httplib.HTTPSConnection):
+
+    timings = None
+    last_used = 0
+
+    def connect(self):
+
+        _connect(self)
+
+        start = time.time()
+        if hasattr(self, '_context'):
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host)
+        else:
+            self.sock = ssl.wrap_socket(self.sock, self.key_file, self.cert_file)
+        self.timings['tls'] = time.time() - start
+
+
+class HttpClient(object):
+    """
+    HTTP client for URL checks, shared by every worker thread. Connections are kept alive and reused
+    for the next check of the same host, at most max_per_host requests to a host are made at once and
+    idle connections are closed after keepalive seconds. Redirects are followed, like urllib2.
+
+    Response timings are in seconds: 'dns', 'connect' and 'tls' are zero if a kept-alive connection
+    was reused, 'firstByte' is from sending the request to reading the response headers and 'total'
+    is for the whole request including redirects.
+
+    >>> client = HttpClient(timeout=15, max_per_host=4, keepalive=30)
+    >>> response = client.request('http://www.example.com/', headers={'User-agent': 'alert-urlmon'})
+    >>> response.status, response.timings['firstByte']
+    """
+
+    def __init__(self, timeout, max_per_host=4, keepalive=30):
+
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.keepalive = keepalive
+
+        self.idle = dict()    # pool key -> idle connections
+        self.slots = dict()   # pool key -> semaphore of max_per_host
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.reused = 0
+
+    def _acquire(self, key):
+
+        with self.lock:
+            slot = self.slots.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+        slot.acquire()
+
+        with self.lock:
+            idle = self.idle.get(key, list())
+            while idle:
+                conn = idle.pop()
+                if time.time() - conn.last_used < self.keepalive:
+                    self.reused += 1
+                    return conn, True
+                conn.close()
+
+        scheme, host, port, tunnel = key
+        if scheme == 'https':
+            conn = TimedHTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = TimedHTTPConnection(host, port, timeout=self.timeout)
+        if tunnel:
+            conn.set_tunnel(*tunnel)
+        return conn, False
+
+    def _release(self, key, conn, reuse):
+
+        if reuse:
+            conn.last_used = time.time()
+            with self.lock:
+                self.idle.setdefault(key, list()).append(conn)
+        else:
+            conn.close()
+        self.slots[key].release()
+
+    def _route(self, url, proxy):
+        """
+        Returns the pool key and request path for a URL, through a proxy if there is one for its
+        scheme. HTTPS requests are tunnelled through the proxy with CONNECT.
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('unknown url type: %s' % url)
+        if not parts.hostname:
+            raise ValueError('no host given: %s' % url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        proxy_url = (proxy or dict()).get(parts.scheme)
+        if not proxy_url:
+            return (parts.scheme, parts.hostname, port, None), path
+
+        proxy = urlparse.urlsplit(proxy_url if '://' in proxy_url else 'http://' + proxy_url)
+        if parts.scheme == 'https':
+            return ('https', proxy.hostname, proxy.port or 80, (parts.hostname, port)), path
+        return ('http', proxy.hostname, proxy.port or 80, None), url
+
+    @staticmethod
+    def _read(response, max_size):
+        """
+        Read the response body in chunks, up to max_size bytes if there is a limit. Returns the body
+        and True if the rest of it was not read.
+        """
+        if not max_size:
+            return response.read(), False
+
+        chunks = list()
+        size = 0
+        while size < max_size:
+            chunk = response.read(min(_CHUNK_SIZE, max_size - size))
+            if not chunk:
+                return ''.join(chunks), False
+            chunks.append(chunk)
+            size += len(chunk)
+        return ''.join(chunks), not response.isclosed()
+
+    def _send(self, method, url, body, headers, proxy, max_size):
+
+        key, path = self._route(url, proxy)
+
+        for attempt in (1, 2):
+            conn, reused = self._acquire(key)
+            conn.timings = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+            try:
+                start = time.time()
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                first_byte = time.time() - start - sum(conn.timings.values())
+                data, truncated = self._read(response, max_size)
+            except (httplib.HTTPException, socket.error):
+                self._release(key, conn, False)
+                if reused and attempt == 1:
+                    continue  # kept-alive connection was closed by the server, retry on a new one
+                raise
+            except:
+                self._release(key, conn, False)  # eg. ssl.CertificateError, a ValueError
+                raise
+            self._release(key, conn, not response.will_close and not truncated)
+
+            timings = dict(conn.timings, firstByte=first_byte)
+            return response, data, truncated, timings
+
+    def request(self, url, body=None, headers=None, proxy=None, auth=None, max_size=None):
+        """
+        GET url, or POST body if there is one. Proxy is a dict of scheme to proxy URL, like
+        urllib2.ProxyHandler, and auth a (username, password) tuple for basic authentication.
+        At most max_size bytes of the response body are read, and the response is truncated if
+        it is longer.
+        Raises ValueError for invalid URLs, and socket.error or httplib.HTTPException if the
+        request fails.
+        """
+        headers = dict(headers or dict())
+        if auth:
+            headers['Authorization'] = 'Basic %s' % base64.b64encode('%s:%s' % auth)
+        method = 'POST' if body else 'GET'
+
+        with self.lock:
+            self.requests += 1
+        start = time.time()
+        timings = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+        for redirect in range(_MAX_REDIRECTS + 1):
+            response, data, truncated, hop = self._send(method, url, body, headers, proxy, max_size)
+            for phase in ('dns', 'connect', 'tls'):
+                timings[phase] += hop[phase]
+            timings.setdefault('firstByte', hop['firstByte'])
+
+            location = response.getheader('location')
+            if response.status not in (301, 302, 303, 307, 308) or not location or redirect == _MAX_REDIRECTS:
+                break
+            url = urlparse.urljoin(url, location)
+            if response.status in (301, 302, 303) and body:
+                method, body = 'GET', None
+                headers = dict((k, v) for k, v in headers.iteritems()
+                               if k.lower() not in ('content-type', 'content-length'))  # like urllib2
+            LOG.debug('Redirected to %s', url)
+
+        timings['total'] = time.time() - start
+        return Response(response.status, response.reason, dict(response.getheaders()), data, truncated, timings)
+
+    def get_stats(self):
+
+        with self.lock:
+            idle = sum(len(conns) for conns in self.idle.itervalues())
+        return {
+            'requests': self.requests,
+            'reused': self.reused,
+            'idle': idle,
+        }
@@ -1,14 +1,13 @@
 
 import time
-import urllib2
+import socket
+import httplib
 import json
 import threading
 import Queue
 import re
 from BaseHTTPServer import BaseHTTPRequestHandler as BHRH
 
-import yaml
-
 HTTP_RESPONSES = dict([(k, v[0]) for k, v in BHRH.responses.items()])
 
 from alerta.common import log as logging
@@ -20,6 +19,10 @@ from alerta.common import severity_code
 from alerta.common.mq import Messaging, MessageHandler
 from alerta.common.daemon import Daemon
 from alerta.common.graphite import Carbon
+from alerta.common.scheduler import Scheduler
+from alerta.common.targets import TargetFile
+from alerta.urlmon.client import HttpClient
+from alerta.urlmon.rules import Rule
 
 Version = '2.2.1'
 
@@ -50,22 +53,42 @@ HTTP_RESPONSES[510] = 'Not Extended'
 
 
 # Initialise Rules
-def init_urls():
+def parse_urls(urls):
+    """
+    Returns a dict of (resource, url) to the URL check.
+    """
+    return dict(((check['resource'], check['url']), check) for check in urls)
+
+
+def compile_check(check):
+    """
+    Returns a copy of a URL check with its status_regex and search patterns compiled and its rule
+    compiled to a Rule, so that they are parsed once when the check is loaded. A pattern or rule that
+    does not compile is logged and ignored.
+    """
+    check = dict(check)
+
+    for name in ('status_regex', 'search'):
+        if check.get(name):
+            try:
+                check[name] = re.compile(check[name], re.MULTILINE)
+            except re.error, e:
+                LOG.error('Invalid %s "%s" for %s: %s', name, check[name], check['url'], e)
+                del check[name]
 
-    urls = list()
-    LOG.info('Loading URLs...')
-    try:
-        urls = yaml.load(open(CONF.urlmon_file))
-    except Exception, e:
-        LOG.error('Failed to load URLs: %s', e)
-    LOG.info('Loaded %d URLs OK', len(urls))
+    if check.get('rule'):
+        try:
+            check['rule'] = Rule(check['rule'])
+        except ValueError, e:
+            LOG.error('Invalid rule "%s" for %s: %s', check['rule'], check['url'], e)
+            del check['rule']
 
-    return urls
+    return check
 
 
 class WorkerThread(threading.Thread):
 
-    def __init__(self, mq, queue, dedup, carbon):
+    def __init__(self, mq, queue, dedup, carbon, scheduler, client):
 
         threading.Thread.__init__(self)
         LOG.debug('Initialising %s...', self.getName())
@@ -78,25 +101,31 @@ class WorkerThread(threading.Thread):
         self.mq = mq               # message broker
         self.dedup = dedup
         self.carbon = carbon
-        
+        self.scheduler = scheduler
+        self.client = client  # shared keep-alive connections
+
     def run(self):
 
         while True:
             LOG.debug('Waiting on input queue...')
-            check, queue_time = self.queue.get()
+            item = self.queue.get()
+
+            if not item:
+                LOG.info('%s is shutting down.', self.getName())
+                break
+
+            check, queue_time = item
+            key = (check['resource'], check['url'])
 
             if time.time() - queue_time > CONF.loop_every:
                 LOG.warning('URL request for %s to %s expired after %d seconds.', check['resource'], check['url'],
                             int(time.time() - queue_time))
+                self.scheduler.done(key, expired=True)
                 self.queue.task_done()
                 continue
 
-            if not check:
-                LOG.info('%s is shutting down.', self.getName())
-                break
-
             status_regex = check.get('status_regex', None)
-            search_string = check.get('search', None)
+            search = check.get('search', None)
             rule = check.get('rule', None)
             warn_thold = check.get('warning', CONF.urlmon_slow_warning)
             crit_thold = check.get('critical', CONF.urlmon_slow_critical)
@@ -112,55 +141,35 @@ class WorkerThread(threading.Thread):
 
             username = check.get('username', None)
             password = check.get('password', None)
-            realm = check.get('realm', None)
-            uri = check.get('uri', None)
-
-            proxy = check.get('proxy', False)
-            if proxy:
-                proxy_handler = urllib2.ProxyHandler(proxy)
-
-            if username and password:
-                auth_handler = urllib2.HTTPBasicAuthHandler()
-                auth_handler.add_password(realm=realm,
-                                          uri=uri,
-                                          user=username,
-                                          passwd=password)
-                if proxy:
-                    opener = urllib2.build_opener(auth_handler, proxy_handler)
-                else:
-                    opener = urllib2.build_opener(auth_handler)
-            else:
-                if proxy:
-                    opener = urllib2.build_opener(proxy_handler)
-                else:
-                    opener = urllib2.build_opener()
-            urllib2.install_opener(opener)
+            auth = (username, password) if username and password else None
 
             if 'User-agent' not in headers:
-                headers['User-agent'] = 'alert-urlmon/%s Python-urllib/%s' % (Version, urllib2.__version__)
+                headers['User-agent'] = 'alert-urlmon/%s Python-httplib' % Version
 
+            timings = None
             try:
-                if post:
-                    req = urllib2.Request(check['url'], json.dumps(post), headers=headers)
-                else:
-                    req = urllib2.Request(check['url'], headers=headers)
-                response = urllib2.urlopen(req, None, CONF.urlmon_max_timeout)
+                response = self.client.request(check['url'], json.dumps(post) if post else None, headers=headers,
+                                               proxy=check.get('proxy', None), auth=auth,
+                                               max_size=CONF.urlmon_max_body)
             except ValueError, e:
                 LOG.error('Request failed: %s', e)
+                self.scheduler.done(key)
+                self.queue.task_done()
                 continue
-            except urllib2.URLError, e:
-                if hasattr(e, 'reason'):
-                    reason = str(e.reason)
-                    status = None
-                elif hasattr(e, 'code'):
-                    reason = None
-                    status = e.code
+            except (socket.error, httplib.HTTPException), e:
+                reason = str(e) or e.__class__.__name__
+                status = None
             except Exception, e:
                 LOG.warning('Unexpected error: %s', e)
+                self.scheduler.done(key)
+                self.queue.task_done()
                 continue
             else:
-                status = response.getcode()
-                body = response.read()
+                status = response.status
+                body = response.body
+                timings = response.timings
+                if response.truncated:
+                    LOG.warning('Response from %s truncated at %d bytes', check['url'], CONF.urlmon_max_body)
 
             rtt = int((time.time() - start) * 1000)  # round-trip time
 
@@ -176,16 +185,16 @@ class WorkerThread(threading.Thread):
                 text = 'Error during connection or data transfer (timeout=%d).' % CONF.urlmon_max_timeout
 
             elif status_regex:
-                if re.search(status_regex, str(status)):
+                if status_regex.search(str(status)):
                     event = 'HttpResponseRegexOK'
                     severity = severity_code.NORMAL
                     value = '%s (%d)' % (description, status)
-                    text = 'HTTP server responded with status code %d that matched "%s" in %dms' % (status, status_regex, rtt)
+                    text = 'HTTP server responded with status code %d that matched "%s" in %dms' % (status, status_regex.pattern, rtt)
                 else:
                     event = 'HttpResponseRegexError'
                     severity = severity_code.MAJOR
                     value = '%s (%d)' % (description, status)
-                    text = 'HTTP server responded with status code %d that failed to match "%s"' % (status, status_regex)
+                    text = 'HTTP server responded with status code %d that failed to match "%s"' % (status, status_regex.pattern)
 
             elif 100 <= status <= 199:
                 event = 'HttpInformational'
@@ -234,36 +243,34 @@ class WorkerThread(threading.Thread):
                     severity = severity_code.WARNING
                     value = '%dms' % rtt
                     text = 'Website available but exceeding warning RT thresholds of %dms' % warn_thold
-                if search_string and body:
-                    LOG.debug('Searching for %s', search_string)
-                    found = False
-                    for line in body.split('\n'):
-                        m = re.search(search_string, line)
-                        if m:
-                            found = True
-                            LOG.debug("Regex: Found %s in %s", search_string, line)
-                            break
+                if search and body:
+                    LOG.debug('Searching for %s', search.pattern)
+                    rule_start = time.time()
+                    found = search.search(body)
+                    self.carbon.metric_send('alert.urlmon.%s.ruleTime' % check['resource'],
+                                            '%.3f' % ((time.time() - rule_start) * 1000))  # ms
                     if not found:
                         event = 'HttpContentError'
                         severity = severity_code.MINOR
                         value = 'Search failed'
-                        text = 'Website available but pattern "%s" not found' % search_string
+                        text = 'Website available but pattern "%s" not found' % search.pattern
                 elif rule and body:
                     LOG.debug('Evaluating rule %s', rule)
-                    if 'Content-type' in headers and headers['Content-type'] == 'application/json':
-                        body = json.loads(body)
+                    rule_start = time.time()
                     try:
-                        eval(rule)  # assumes request body in variable called 'body'
-                    except (SyntaxError, NameError, ZeroDivisionError), e:
-                        LOG.error('Could not evaluate rule %s: %s', rule, e)
+                        if 'Content-type' in headers and headers['Content-type'] == 'application/json':
+                            body = json.loads(body)
+                        passed = rule(body)
                     except Exception, e:
                         LOG.error('Could not evaluate rule %s: %s', rule, e)
                     else:
-                        if not eval(rule):
+                        if not passed:
                             event = 'HttpContentError'
                             severity = severity_code.MINOR
                             value = 'Rule failed'
                             text = 'Website available but rule evaluation failed (%s)' % rule
+                    self.carbon.metric_send('alert.urlmon.%s.ruleTime' % check['resource'],
+                                            '%.3f' % ((time.time() - rule_start) * 1000))  # ms
 
             LOG.debug("URL: %s, Status: %s (%s), Round-Trip Time: %dms -> %s",
                       check['url'], description, status, rtt, event)
@@ -276,6 +283,10 @@ class WorkerThread(threading.Thread):
 
             self.carbon.metric_send('alert.urlmon.%s.availability' % check['resource'], '%.1f' % avail)  # %
             self.carbon.metric_send('alert.urlmon.%s.responseTime' % check['resource'], '%d' % rtt)  # ms
+            if timings:
+                for phase in ('dns', 'connect', 'tls', 'firstByte', 'total'):
+                    self.carbon.metric_send('alert.urlmon.%s.%sTime' % (check['resource'], phase),
+                                            '%d' % (timings[phase] * 1000))  # ms
 
             resource = check['resource']
             correlate = _HTTP_ALERTS
@@ -309,6 +320,7 @@ class WorkerThread(threading.Thread):
             elif self.dedup.is_send(urlmonAlert):
                 self.mq.send(urlmonAlert)
 
+            self.scheduler.done(key)
             self.queue.task_done()
             LOG.info('%s check complete.', self.getName())
 
@@ -332,6 +344,11 @@ class UrlmonDaemon(Daemon):
         'urlmon_max_timeout': 15,  # seconds
         'urlmon_slow_warning': 2000,   # ms
         'urlmon_slow_critical': 5000,  # ms
+        'urlmon_max_per_host': 4,      # concurrent requests to a host
+        'urlmon_keepalive': 30,        # seconds idle connections are kept open
+        'urlmon_max_body': 1048576,    # bytes of response body read for search and rule checks
+        'schedule_jitter': 10,         # percent of loop_every
+        'reload_every': 10,            # seconds between checks for changes to urlmon_file, 0 to never reload
     }
 
     def __init__(self, prog, **kwargs):
@@ -355,13 +372,17 @@ class UrlmonDaemon(Daemon):
 
         self.carbon = Carbon()  # graphite metrics
 
-        # Initialiase alert rules
-        urls = init_urls()
+        self.client = HttpClient(CONF.urlmon_max_timeout, CONF.urlmon_max_per_host, CONF.urlmon_keepalive)
+
+        # Initialiase alert rules, spread across loop_every or the interval of each check
+        self.scheduler = Scheduler(CONF.loop_every, jitter=CONF.schedule_jitter / 100.0)
+        self.urls = TargetFile(CONF.urlmon_file, parse_urls)
+        self.reload_urls()
 
         # Start worker threads
         LOG.debug('Starting %s worker threads...', CONF.server_threads)
         for i in range(CONF.server_threads):
-            w = WorkerThread(self.mq, self.queue, self.dedup, self.carbon)
+            w = WorkerThread(self.mq, self.queue, self.dedup, self.carbon, self.scheduler, self.client)
             try:
                 w.start()
             except Exception, e:
@@ -369,18 +390,32 @@ class UrlmonDaemon(Daemon):
                 continue
             LOG.info('Started worker thread: %s', w.getName())
 
+        next_heartbeat = 0
+        next_reload = time.time() + CONF.reload_every if CONF.reload_every else float('inf')
         while not self.shuttingdown:
             try:
-                for url in urls:
-                    self.queue.put((url, time.time()))
+                if time.time() >= next_reload:
+                    if self.urls.changed():
+                        self.reload_urls()
+                    next_reload = time.time() + CONF.reload_every if CONF.reload_every else float('inf')
+
+                for key, check in self.scheduler.due():
+                    self.queue.put((check, time.time()))
 
-                LOG.debug('Send heartbeat...')
-                heartbeat = Heartbeat(version=Version)
-                self.mq.send(heartbeat)
+                if time.time() >= next_heartbeat:
+                    LOG.debug('Send heartbeat...')
+                    heartbeat = Heartbeat(version=Version)
+                    self.mq.send(heartbeat)
+                    next_heartbeat = time.time() + CONF.loop_every
 
-                time.sleep(CONF.loop_every)
-                LOG.info('URL check queue length is %d', self.queue.qsize())
-                self.carbon.metric_send('alert.urlmon.queueLength', self.queue.qsize())
+                    LOG.info('URL check queue length is %d', self.queue.qsize())
+                    self.carbon.metric_send('alert.urlmon.queueLength', self.queue.qsize())
+                    for name, value in self.scheduler.get_stats().iteritems():
+                        self.carbon.metric_send('alert.urlmon.scheduler.%s' % name, value)
+                    for name, value in self.client.get_stats().iteritems():
+                        self.carbon.metric_send('alert.urlmon.http.%s' % name, value)
+
+                time.sleep(max(min(self.scheduler.next_due(), next_heartbeat, next_reload) - time.time(), 0))
 
             except (KeyboardInterrupt, SystemExit):
                 self.shuttingdown = True
@@ -395,6 +430,23 @@ class UrlmonDaemon(Daemon):
         LOG.info('Disconnecting from message broker...')
         self.mq.disconnect()
 
+    def reload_urls(self):
+        """
+        Apply changes to the URL targets file to the scheduler. Checks in progress carry on and
+        modified checks keep their place in the schedule.
+        """
+        added, removed, modified = self.urls.reload()
+
+        for key in removed:
+            self.scheduler.remove(key)
+        for key, check in added.items() + modified.items():
+            self.scheduler.add(key, compile_check(check), period=check.get('interval'),
+                               priority=check.get('priority', 0))
+
+        if self.urls.last_reload:
+            for name, value in self.urls.last_reload.iteritems():
+                self.carbon.metric_send('alert.urlmon.targets.%s' % name, value)
+
 
 
 
@@ -0,0 +1,141 @@
+
+import re
+import ast
+import operator
+
+_COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+_FUNCTIONS = {
+    'len': len,
+    'int': int,
+    'float': float,
+    'str': str,
+    'bool': bool,
+}
+
+_CONSTANTS = {
+    'True': True,
+    'False': False,
+    'None': None,
+}
+
+
+def _compile(node):
+    """
+    Compile an expression node into a function of the response body.
+    """
+    if isinstance(node, ast.BoolOp):
+        values = [_compile(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            return lambda body: all(value(body) for value in values)
+        return lambda body: any(value(body) for value in values)
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub)):
+        operand = _compile(node.operand)
+        if isinstance(node.op, ast.Not):
+            return lambda body: not operand(body)
+        return lambda body: -operand(body)
+
+    if isinstance(node, ast.Compare):
+        left = _compile(node.left)
+        comparisons = [(_COMPARISONS[type(op)], _compile(right)) for op, right in zip(node.ops, node.comparators)]
+
+        def compare(body):
+            a = left(body)
+            for op, right in comparisons:
+                b = right(body)
+                if not op(a, b):
+                    return False
+                a = b
+            return True
+        return compare
+
+    if isinstance(node, ast.Name):
+        if node.id == 'body':
+            return lambda body: body
+        if node.id in _CONSTANTS:
+            value = _CONSTANTS[node.id]
+            return lambda body: value
+        raise ValueError('unknown name %s' % node.id)
+
+    if isinstance(node, (ast.Num, ast.Str)):
+        value = node.n if isinstance(node, ast.Num) else node.s
+        return lambda body: value
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        elements = [_compile(element) for element in node.elts]
+        return lambda body: [element(body) for element in elements]
+
+    if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Index):
+        value = _compile(node.value)
+        index = _compile(node.slice.value)
+        return lambda body: value(body)[index(body)]
+
+    if isinstance(node, ast.Call) and not (node.keywords or node.starargs or node.kwargs):
+        func = node.func
+        args = [_compile(arg) for arg in node.args]
+
+        if isinstance(func, ast.Name) and func.id in _FUNCTIONS:
+            function = _FUNCTIONS[func.id]
+            return lambda body: function(*[arg(body) for arg in args])
+
+        # re.search(pattern, string) and re.match(pattern, string), with the pattern compiled once
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 're' \
+                and func.attr in ('search', 'match') and len(node.args) == 2:
+            if not isinstance(node.args[0], ast.Str):
+                raise ValueError('rules can only use literal regex patterns')
+            method = getattr(re.compile(node.args[0].s), func.attr)
+            string = args[1]
+            return lambda body: method(string(body)) is not None
+
+        # dict.get(key) and dict.get(key, default)
+        if isinstance(func, ast.Attribute) and func.attr == 'get' and 1 <= len(node.args) <= 2:
+            value = _compile(func.value)
+            return lambda body: value(body).get(*[arg(body) for arg in args])
+
+    raise ValueError('%s is not allowed in rules' % node.__class__.__name__)
+
+
+class Rule(object):
+    """
+    A content rule for URL checks, compiled once from a Python expression on the response body,
+    like "body['status'] == 'ok'". Only comparisons, boolean operators, subscripts, literals, the
+    functions len, int, float, str and bool, dict get() and re.search() and re.match() with a
+    literal pattern are allowed, so a rule can't run arbitrary code. Raises ValueError for any
+    other expression.
+
+    >>> rule = Rule("body['status'] == 'ok' and len(body['items']) > 0")
+    >>> rule({'status': 'ok', 'items': [1]})
+    True
+    """
+
+    def __init__(self, rule):
+
+        self.rule = rule
+        try:
+            self.evaluate = _compile(ast.parse(rule.strip(), mode='eval').body)
+        except SyntaxError, e:
+            raise ValueError('invalid syntax: %s' % e)
+
+    def __call__(self, body):
+
+        return bool(self.evaluate(body))
+
+    def __repr__(self):
+
+        return 'Rule(%r)' % self.rule
+
+    def __str__(self):
+
+        return self.rule
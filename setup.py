@@ -37,6 +37,8 @@ setuptools.setup(
         'bin/alerta',
         'bin/alerta-api',
         'bin/alerta-dashboard',
+        'bin/alerta-history',
+        'bin/alerta-indexes',
     ],
     keywords='alert monitoring system',
     classifiers=[
@@ -139,5 +139,21 @@ class TestAlert(unittest.TestCase):
         self.assertEquals(alert.graph_urls, self.GRAPH_URLS)
         self.assertEquals(alert.history, self.HISTORY)
 
+    def test_alert_from_document(self):
+        """
+        Ensure an alert is created from a stored document as is
+        """
+        alert = Alert(self.RESOURCE, self.EVENT, value=42, severity=self.SEVERITY, status=self.STATUS)
+        alert.receive_now()
+        document = alert.get_body()
+        document['_id'] = document.pop('id')
+
+        stored = Alert.from_document(document)
+
+        self.assertEquals(stored.get_body(), alert.get_body())
+        self.assertEquals(stored.value, '42.00')
+        self.assertFalse(hasattr(stored, 'history'))
+        self.assertRaises(AttributeError, setattr, stored, 'foo', 'bar')
+
 if __name__ == '__main__':
     unittest.main()
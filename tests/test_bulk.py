@@ -0,0 +1,194 @@
+
+import os
+import sys
+import imp
+import unittest
+
+from StringIO import StringIO
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+# alerta.api.v2 connects to MongoDB and the broker when it is imported, so load its utils on their own
+utils = imp.load_source('alerta_api_v2_utils', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            os.pardir, 'alerta', 'api', 'v2', 'utils.py'))
+
+
+def parse(data, chunk_size=65536):
+
+    return list(utils.parse_bulk(StringIO(data), chunk_size))
+
+
+class TestParseBulk(unittest.TestCase):
+    """
+    Ensures bulk alerts are parsed one at a time from any size of chunk.
+    """
+
+    def test_array(self):
+
+        data = '[{"resource": "router1", "value": 12345}, "ok", 3.25, true, null, [1, 2]]'
+        expected = [{'resource': 'router1', 'value': 12345}, 'ok', 3.25, True, None, [1, 2]]
+
+        for chunk_size in range(1, len(data) + 1):
+            self.assertEqual(parse(data, chunk_size), expected, 'chunk size %d' % chunk_size)
+
+    def test_numbers_split_across_chunks(self):
+
+        self.assertEqual(parse('[12345, 67890]', 3), [12345, 67890])
+        self.assertEqual(parse('[-1.5e10 ,2]', 2), [-1.5e10, 2])
+
+    def test_strings_split_across_chunks(self):
+
+        self.assertEqual(parse('["router\\"1", "\\u00e9t\\u00e9"]', 4), ['router"1', u'\xe9t\xe9'])
+
+    def test_empty(self):
+
+        self.assertEqual(parse(''), [])
+        self.assertEqual(parse('  \n'), [])
+        self.assertEqual(parse('[]'), [])
+        self.assertEqual(parse(' [ ] ', 1), [])
+
+    def test_malformed_array(self):
+
+        for data in ['[1 2]', '[,1]', '[1,,2]', '[1,]', '[1', '[1,', '[{"resource": "router1"}', '[tru]', '[1}']:
+            items = parse(data, 2)
+            self.assertTrue(isinstance(items[-1], ValueError), '%r parsed as %r' % (data, items))
+            self.assertTrue(all(not isinstance(item, ValueError) for item in items[:-1]))
+
+        self.assertEqual(parse('[1, 2 3]')[:2], [1, 2])
+        self.assertTrue(isinstance(parse('[1 2]')[-1], utils.BulkError))
+
+    def test_malformed_item_stops(self):
+
+        class Stream(StringIO):
+            reads = 0
+
+            def read(self, size):
+                Stream.reads += 1
+                return StringIO.read(self, size)
+
+        stream = Stream('[{"resource": "router1"}, {"resource" "router2"}, ' + ' ' * 1000 + '{"resource": "router3"}]')
+        items = list(utils.parse_bulk(stream, 10))
+
+        self.assertEqual(items[0], {'resource': 'router1'})
+        self.assertEqual(len(items), 2)
+        self.assertTrue(isinstance(items[1], utils.BulkError))
+        self.assertTrue(Stream.reads < 10)
+
+    def test_item_too_long(self):
+
+        self.assertEqual(parse('[{"text": "%s"}]' % ('x' * 1000), 10), [{'text': 'x' * 1000}])
+
+        items = list(utils.parse_bulk(StringIO('[1, "%s"]' % ('x' * 1000)), 10, max_item_size=100))
+        self.assertEqual(items[0], 1)
+        self.assertEqual(str(items[1]), 'JSON array item is longer than 100 characters')
+
+    def test_extra_data(self):
+
+        self.assertEqual(parse('[1, 2] \n', 1), [1, 2])
+        for data in ['[1, 2] 3', '[1, 2]]', '[1, 2]' + ' ' * 100 + 'x']:
+            items = parse(data, 4)
+            self.assertEqual(items[:2], [1, 2])
+            self.assertEqual(str(items[2]), 'Extra data after JSON array')
+
+    def test_ndjson(self):
+
+        data = '{"resource": "router1"}\n\n{"resource": "router2"}\r\n12345\n{"resource": "router3"}'
+
+        for chunk_size in (1, 5, 1000):
+            self.assertEqual(parse(data, chunk_size), [{'resource': 'router1'}, {'resource': 'router2'}, 12345,
+                                                       {'resource': 'router3'}])
+
+    def test_ndjson_bad_lines(self):
+
+        items = parse('{"resource": "router1"}\n{"resource": \n[1, 2]\n{bad}', 4)
+
+        self.assertEqual(len(items), 4)
+        self.assertEqual(items[0], {'resource': 'router1'})
+        self.assertTrue(isinstance(items[1], ValueError))
+        self.assertEqual(items[2], [1, 2])
+        self.assertTrue(isinstance(items[3], ValueError))
+
+
+class TestCreateBulk(unittest.TestCase):
+    """
+    Ensures a bulk request reports an error for each alert that fails without failing the others.
+    """
+
+    def setUp(self):
+
+        self.batches = list()
+
+    def send_batch(self, alerts):
+
+        self.batches.append(alerts)
+        return len(alerts)
+
+    def test_partial_failure(self):
+
+        data = '\n'.join([
+            '{"resource": "router1", "event": "Node_Down"}',
+            '{"resource": "router2", "event": "Node_Down", "createTime": 1234567890}',
+            '{"resource": "router3", "event": "Node_Down", "severity": 5}',
+            '{"resource": "router4", "event": "Node_Down", "createTime": "yesterday"}',
+            '["router5"]',
+            '{"resource": "router6",',
+            '{"resource": "router7", "event": "Node_Down", "severity": "major"}',
+        ])
+
+        results, error = utils.create_bulk(StringIO(data), self.send_batch, 100, 2)
+
+        self.assertEqual(error, None)
+        self.assertEqual([result['index'] for result in results], range(7))
+        self.assertEqual([result['status'] for result in results], ['ok', 'error', 'error', 'error', 'error',
+                                                                    'error', 'ok'])
+        self.assertEqual(results[1]['message'], 'createTime must be a date time string')
+        self.assertEqual(results[2]['message'], 'severity must be a string')
+        self.assertEqual(results[4]['message'], 'Alert must be a JSON object')
+        self.assertTrue('id' not in results[1])
+
+        sent = [alert.get_id() for batch in self.batches for alert in batch]
+        self.assertEqual(sent, [results[0]['id'], results[6]['id']])
+
+    def test_broker_failure(self):
+
+        def send_batch(alerts):
+            self.batches.append(alerts)
+            return 0 if len(self.batches) == 2 else len(alerts)  # second batch not sent
+
+        data = '[%s]' % ', '.join(['{"resource": "router%d", "event": "Node_Down"}' % n for n in range(5)])
+
+        results, error = utils.create_bulk(StringIO(data), send_batch, 100, 2)
+
+        self.assertEqual(error, None)
+        self.assertEqual([len(batch) for batch in self.batches], [2, 2, 1])
+        self.assertEqual([result['status'] for result in results], ['ok', 'ok', 'error', 'error', 'ok'])
+        self.assertEqual(results[2]['message'], 'could not send alert to broker')
+        self.assertTrue('id' not in results[2])
+
+    def test_malformed_array(self):
+
+        data = '[{"resource": "router1", "event": "Node_Down"}, {"resource": "router2"] x'
+
+        try:
+            utils.create_bulk(StringIO(data), self.send_batch, 100, 2)
+        except utils.BulkError, e:
+            self.assertEqual([result['status'] for result in e.results], ['ok'])
+            self.assertEqual(len(self.batches), 1)
+        else:
+            self.fail('malformed array not rejected')
+
+    def test_too_many_alerts(self):
+
+        data = '[%s]' % ', '.join(['{"resource": "router%d", "event": "Node_Down"}' % n for n in range(5)])
+
+        results, error = utils.create_bulk(StringIO(data), self.send_batch, 3, 2)
+
+        self.assertEqual(error, 'too many alerts, max is 3')
+        self.assertEqual(len(results), 3)
+        self.assertEqual(sum(len(batch) for batch in self.batches), 3)
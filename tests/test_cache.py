@@ -0,0 +1,105 @@
+
+import os
+import sys
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.common.alert import Alert
+from alerta.server.cache import AlertCache
+
+
+class TestAlertCache(unittest.TestCase):
+    """
+    Ensures alert state is cached per environment and resource.
+    """
+
+    def setUp(self):
+
+        self.cache = AlertCache(2)
+        self.down = Alert('router55', 'Node_Down', correlate=['Node_Down', 'Node_Up'], severity='major')
+        self.up = Alert('router55', 'Node_Up', correlate=['Node_Down', 'Node_Up'], severity='normal')
+
+    def test_new_alert_hit(self):
+        """
+        Ensure a loaded resource with no matching alert is a cache hit for a new alert
+        """
+        self.assertEquals(self.cache.get(self.down), (False, None))
+
+        self.cache.load(self.down, list())
+        self.assertEquals(self.cache.get(self.down), (True, None))
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_write_through(self):
+        """
+        Ensure saved alerts are found by correlated events and partial resources only hit on a match
+        """
+        self.cache.update(self.down)
+
+        hit, existing = self.cache.get(self.up)
+        self.assertTrue(hit)
+        self.assertEquals(existing['_id'], self.down.alertid)
+        self.assertEquals(existing['severity'], 'major')
+
+        self.assertEquals(self.cache.get(Alert('router55', 'Link_Down')), (False, None))
+
+        self.cache.invalidate(self.down)
+        self.assertEquals(self.cache.get(self.up), (False, None))
+
+    def test_lru_eviction(self):
+        """
+        Ensure least recently used resources are evicted first
+        """
+        for resource in ['host1', 'host2']:
+            self.cache.load(Alert(resource, 'event'), list())
+        self.cache.get(Alert('host1', 'event'))
+        self.cache.load(Alert('host3', 'event'), list())
+
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(self.cache.evictions, 1)
+        self.assertFalse(self.cache.get(Alert('host2', 'event'))[0])
+        self.assertTrue(self.cache.get(Alert('host1', 'event'))[0])
+
+    def test_get_resource(self):
+        """
+        Ensure a batch is classified from the cache only if every alert for the resource is a hit
+        """
+        self.cache.update(self.down)
+        self.assertEquals(self.cache.get_resource(['PROD'], 'router55', [self.up, Alert('router55', 'Link_Down')]),
+                          None)
+
+        self.cache.load(self.down, [self.cache._entry(self.down)])
+        entries = self.cache.get_resource(['PROD'], 'router55', [self.up, self.down, Alert('router55', 'Link_Down')])
+        self.assertEquals([entry['_id'] for entry in entries], [self.down.alertid])
+        self.assertEquals(self.cache.get_resource(['PROD'], 'router55', [Alert('router55', 'Link_Down')]), [])
+        self.assertEquals(self.cache.get_resource(['DEV'], 'router55', [self.up]), None)
+
+    def test_warm_up_without_status_index(self):
+        """
+        Ensure open alerts are loaded without relying on an index that may have been dropped
+        """
+        class Collection(object):
+            def find(self, query, fields):
+                return [dict(_id=str(i), environment='PROD', resource='host%d' % i, event='event',
+                             severity='major', status='open') for i in range(3)]
+
+        class Database(object):
+            db = type('db', (object,), {'alerts': Collection()})
+
+            def get_indexes(self):
+                return {'_id_': [('_id', 1)]}
+
+        self.cache.warm_up(Database(), owns=lambda environment, resource: resource != 'host1')
+
+        self.assertEquals(len(self.cache), 2)
+        self.assertTrue(self.cache.get(Alert('host0', 'event', environment='PROD'))[0])
+        self.assertFalse(self.cache.get(Alert('host1', 'event', environment='PROD'))[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+
+import os
+import sys
+import ssl
+import socket
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.urlmon import client
+from alerta.urlmon.client import HttpClient
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Keeps connections alive unless the path is /stale, which closes the connection without telling
+    the client. /redirect/<status> redirects to /echo, and /redirect/<status>/loop to itself.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+
+        pass
+
+    def respond(self, status, body='', headers=None):
+
+        self.send_response(status)
+        for name, value in (headers or dict()).iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.command, self.path, dict(self.headers), body))
+
+        if self.path.startswith('/redirect/'):
+            location = '/echo' if self.path.count('/') == 2 else self.path
+            self.respond(int(self.path.split('/')[2]), headers={'Location': location})
+        elif self.path == '/stale':
+            self.respond(200, 'stale')
+            self.close_connection = 1
+        elif self.path.startswith('/size/'):
+            self.respond(200, 'x' * int(self.path.split('/')[2]))
+        else:
+            self.respond(200, '%s %s' % (self.command, self.path))
+
+    do_GET = do_POST = handle_request
+
+    def do_CONNECT(self):
+
+        self.server.requests.append((self.command, self.path, dict(self.headers), ''))
+        self.respond(200)
+        self.close_connection = 1  # not a real tunnel, so the TLS handshake fails
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.requests = list()
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+
+class TestHttpClient(unittest.TestCase):
+    """
+    Ensures URL checks reuse connections, follow redirects and go through proxies like urllib2.
+    """
+
+    def setUp(self):
+
+        self.server = Server()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.client = HttpClient(timeout=5)
+
+    def tearDown(self):
+
+        for conns in self.client.idle.itervalues():
+            for conn in conns:
+                conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keepalive(self):
+
+        for i in range(3):
+            self.assertEqual(self.client.request(self.url + '/echo').body, 'GET /echo')
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.client.get_stats(), {'requests': 3, 'reused': 2, 'idle': 1})
+
+    def test_retry_stale_connection(self):
+
+        self.assertEqual(self.client.request(self.url + '/stale').body, 'stale')
+        self.assertEqual(self.client.get_stats()['idle'], 1)
+
+        response = self.client.request(self.url + '/echo')
+        self.assertEqual(response.body, 'GET /echo')
+        self.assertEqual(self.client.get_stats()['reused'], 1)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_redirect_post_to_get(self):
+
+        headers = {'Content-Type': 'application/json', 'X-Check': 'urlmon'}
+        for status in (301, 302, 303):
+            response = self.client.request(self.url + '/redirect/%d' % status, body='{}', headers=headers)
+            self.assertEqual(response.body, 'GET /echo')
+
+            method, path, headers_sent, body = self.server.requests[-1]
+            self.assertEqual(body, '')
+            self.assertTrue('content-type' not in headers_sent)
+            self.assertEqual(headers_sent['x-check'], 'urlmon')
+
+        response = self.client.request(self.url + '/redirect/307', body='{}', headers=headers)
+        self.assertEqual(response.body, 'POST /echo')
+        self.assertEqual(self.server.requests[-1][3], '{}')
+        self.assertEqual(self.server.requests[-1][2]['content-type'], 'application/json')
+
+    def test_too_many_redirects(self):
+
+        response = self.client.request(self.url + '/redirect/302/loop')
+
+        self.assertEqual(response.status, 302)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_proxy(self):
+
+        response = self.client.request('http://www.example.com/status?x=1', proxy={'http': self.url})
+
+        self.assertEqual(response.body, 'GET http://www.example.com/status?x=1')
+        self.assertEqual(self.server.requests[-1][2]['host'], 'www.example.com')
+
+    def test_proxy_connect(self):
+
+        proxy = {'https': self.url.replace('http://', '')}  # proxies without a scheme are http
+        self.assertRaises(socket.error, self.client.request, 'https://www.example.com/status', proxy=proxy)
+
+        method, path, headers, body = self.server.requests[-1]
+        self.assertEqual((method, path), ('CONNECT', 'www.example.com:443'))
+        self.assertEqual(self.client.get_stats()['idle'], 0)
+
+    def test_truncated(self):
+
+        response = self.client.request(self.url + '/size/100', max_size=10)
+        self.assertEqual(response.body, 'x' * 10)
+        self.assertTrue(response.truncated)
+        self.assertEqual(self.client.get_stats()['idle'], 0)  # rest of the response is still to be read
+
+        response = self.client.request(self.url + '/size/100', max_size=100)
+        self.assertEqual(response.body, 'x' * 100)
+        self.assertFalse(response.truncated)
+
+        response = self.client.request(self.url + '/size/200000', max_size=150000)
+        self.assertEqual(len(response.body), 150000)
+        self.assertTrue(response.truncated)
+
+        response = self.client.request(self.url + '/size/200000')
+        self.assertEqual(len(response.body), 200000)
+        self.assertFalse(response.truncated)
+
+    def test_connect_error_releases_slot(self):
+        """
+        Ensure a request that fails with an error other than a socket or HTTP error doesn't keep its host slot
+        """
+        def connect(conn):
+            raise ssl.CertificateError("hostname '127.0.0.1' doesn't match 'www.example.com'")
+
+        self.client = HttpClient(timeout=5, max_per_host=1)
+        saved, client.TimedHTTPConnection.connect = client.TimedHTTPConnection.connect, connect
+        try:
+            self.assertRaises(ValueError, self.client.request, self.url + '/echo')
+        finally:
+            client.TimedHTTPConnection.connect = saved
+
+        slot = self.client.slots[('http', '127.0.0.1', self.server.server_address[1], None)]
+        self.assertTrue(slot.acquire(False))
+        slot.release()
+        self.assertEqual(self.client.request(self.url + '/echo').body, 'GET /echo')
+
+    def test_invalid_url(self):
+
+        self.assertRaises(ValueError, self.client.request, 'ftp://www.example.com/')
+        self.assertRaises(ValueError, self.client.request, 'http:///status')
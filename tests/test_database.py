@@ -0,0 +1,472 @@
+
+import os
+import sys
+import imp
+import datetime
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.server import database
+from alerta.server.database import Mongo, NEW_ALERT, DUPLICATE_ALERT, CORRELATED_ALERT
+from alerta.server.cache import AlertCache
+from alerta.server.indexes import query_shapes
+from alerta.common.alert import Alert
+from alerta.common import config, severity_code, status_code
+
+CONF = config.CONF
+
+# alerta.api.v2 connects to MongoDB and the broker when it is imported, so load its utils on their own
+utils = imp.load_source('alerta_api_v2_utils', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            os.pardir, 'alerta', 'api', 'v2', 'utils.py'))
+utils.queries = utils.ParsedQueries()  # query_cache_size is an API option
+
+ALERTID = 'e4f5a6b7-1234-4c2d-9e8f-0a1b2c3d4e5f'
+
+
+class TestIdQuery(unittest.TestCase):
+    """
+    Ensures alerts are looked up by full id, short id or id prefix with an index.
+    """
+
+    def test_full_id(self):
+
+        self.assertEqual(Mongo._id_query(ALERTID), {'$or': [{'_id': ALERTID}, {'lastReceiveId': ALERTID}]})
+        self.assertEqual(Mongo._id_query(ALERTID, last_receive_id=False), {'_id': ALERTID})
+
+    def test_short_id(self):
+        """
+        Ensure alerts without a shortId are found by an _id range
+        """
+        query = Mongo._id_query(ALERTID[:8], last_receive_id=False)
+
+        self.assertEqual(query['$or'], [{'shortId': 'e4f5a6b7'}, {'_id': {'$gte': 'e4f5a6b7', '$lt': 'e4f5a6b8'}}])
+
+        query = Mongo._id_query(ALERTID[:8])
+        self.assertEqual(len(query['$or']), 3)
+        self.assertEqual(query['$or'][2], {'lastReceiveId': {'$gte': 'e4f5a6b7', '$lt': 'e4f5a6b8'}})
+
+    def test_short_id_is_not_a_pattern(self):
+
+        query = Mongo._id_query('e4f5.6b*', last_receive_id=False)
+
+        self.assertEqual(query['$or'][1], {'_id': {'$gte': 'e4f5.6b*', '$lt': 'e4f5.6b+'}})
+
+    def test_prefix(self):
+
+        self.assertEqual(Mongo._id_query('e4f5a6', last_receive_id=False), {'_id': {'$gte': 'e4f5a6', '$lt': 'e4f5a7'}})
+        self.assertEqual(Mongo._id_query('e4f5a6b7-12', last_receive_id=False)['_id']['$lt'], 'e4f5a6b7-13')
+
+    def test_uses_index(self):
+        """
+        Ensure every clause can use an index
+        """
+        for alertid in [ALERTID, ALERTID[:8], ALERTID[:4]]:
+            for shape in query_shapes(Mongo._id_query(alertid)):
+                self.assertEqual(shape['filter'], [])
+
+
+class FakeDatabase(object):
+
+    def __init__(self):
+
+        self.seq = 0
+        self.commands = 0
+
+    def command(self, name, collection, query=None, update=None, upsert=False, new=False):
+
+        self.commands += 1
+        self.seq += update['$inc']['seq']
+        return {'value': {'_id': query['_id'], 'seq': self.seq, 'changeTime': update['$set']['changeTime']}}
+
+
+class TestChangeBlocks(unittest.TestCase):
+    """
+    Ensures change sequence numbers are reserved in blocks that are only used for a short time.
+    """
+
+    def setUp(self):
+
+        CONF.change_block_size = 10
+
+        self.db = Mongo.__new__(Mongo)
+        self.db.db = FakeDatabase()
+        self.db.change_block = None
+        self.db.change_lock = database.threading.Lock()
+
+    def tearDown(self):
+
+        CONF.change_block_size = Mongo.mongo_opts['change_block_size']
+
+    def test_block(self):
+
+        seqs = [self.db._next_change()['changeSeq'] for i in range(5)]
+        seqs += [change['changeSeq'] for change in self.db._next_changes(5)]
+
+        self.assertEqual(seqs, range(1, 11))
+        self.assertEqual(self.db.db.commands, 1)
+
+        self.assertEqual([change['changeSeq'] for change in self.db._next_changes(25)], range(11, 36))
+        self.assertEqual(self.db._next_change()['changeSeq'], 36)
+        self.assertEqual(self.db.db.commands, 3)
+
+    def test_lease(self):
+        """
+        Ensure an old block is not used, so numbers are not written long after their changeTime
+        """
+        self.assertEqual(self.db._next_change()['changeSeq'], 1)
+        self.db.change_block[2] -= datetime.timedelta(seconds=database._CHANGE_BLOCK_LEASE)
+
+        change = self.db._next_change()
+        self.assertEqual(change['changeSeq'], 11)
+        self.assertTrue(datetime.datetime.utcnow() - change['changeTime'].replace(tzinfo=None) <
+                        datetime.timedelta(seconds=database._CHANGE_BLOCK_LEASE))
+
+
+class TestChanges(unittest.TestCase):
+    """
+    Ensures the changes feed returns changed alerts and deleted alerts.
+    """
+
+    def setUp(self):
+
+        config.parse_args(sys.argv)
+
+        # changes are safe to return straight away, so blocks of change numbers must not be reused
+        self.lag = database._CHANGE_LAG, database._CHANGE_BLOCK_LEASE
+        database._CHANGE_LAG = database._CHANGE_BLOCK_LEASE = 0
+
+        self.RESOURCE = 'changehost789'
+        self.db = Mongo()
+        self.db.delete_resource(self.RESOURCE)
+
+    def tearDown(self):
+
+        database._CHANGE_LAG, database._CHANGE_BLOCK_LEASE = self.lag
+
+    def save_alert(self, event):
+
+        alert = Alert(self.RESOURCE, event, receive_time=datetime.datetime.utcnow())
+        self.db.save_alert(alert)
+        return alert.alertid
+
+    def test_changes(self):
+
+        query = {'resource': self.RESOURCE}
+        alertids = [self.save_alert(event) for event in ['ChangeEvent1', 'ChangeEvent2', 'ChangeEvent3']]
+
+        changes = self.db.get_changes(since=0, query=query)
+        self.assertTrue(changes['resync'])
+        self.assertItemsEqual([alert.alertid for alert in changes['alerts']], alertids)
+        self.assertEqual(changes['deleted'], [])
+
+        self.db.update_status(alertid=alertids[0], status='ack')
+        self.db.delete_alert(alertids[1])
+
+        since = changes['seq']
+        changes = self.db.get_changes(since=since, query=query)
+        self.assertFalse(changes['resync'])
+        self.assertEqual([(alert.alertid, alert.status) for alert in changes['alerts']], [(alertids[0], 'ack')])
+        self.assertTrue(alertids[1] in changes['deleted'])
+        self.assertTrue(changes['seq'] > since)
+
+        # changed alerts that no longer match the query are deleted from the client's copy
+        changes = self.db.get_changes(since=since, query=dict(query, status='open'))
+        self.assertEqual(changes['alerts'], [])
+        self.assertTrue(alertids[0] in changes['deleted'])
+
+        self.assertEqual(self.db.get_changes(since=changes['seq'], query=query)['alerts'], [])
+
+    def test_tombstones(self):
+
+        alertid = self.save_alert('ChangeEvent1')
+        since = self.db.get_changes(since=0, query={'resource': self.RESOURCE})['seq']
+        self.db.delete_alert(alertid)
+
+        tombstone = self.db.db.tombstones.find_one({'id': alertid})
+        self.assertTrue(tombstone['changeSeq'] > since)
+
+        # clients older than the purged tombstones must reload all alerts
+        self.db.db.tombstones.update({'id': alertid}, {'$set': {'changeTime': datetime.datetime(2013, 5, 1)}})
+        self.db._purge_tombstones()
+        self.assertEqual(self.db.db.tombstones.find_one({'id': alertid}), None)
+
+        changes = self.db.get_changes(since=since, query={'resource': self.RESOURCE})
+        self.assertTrue(changes['resync'])
+        self.assertEqual(changes['deleted'], [])
+
+
+class TestIngest(unittest.TestCase):
+    """
+    Ensures incoming alerts are classified and saved with one guarded write, and re-classified if the
+    alert changed since it was read.
+    """
+
+    def setUp(self):
+
+        config.parse_args(sys.argv)
+
+        self.RESOURCE = 'ingesthost246'
+        self.db = Mongo()
+        self.db.delete_resource(self.RESOURCE)
+
+    def alert(self, event, severity='major', correlate=None, **kwargs):
+
+        alert = Alert(self.RESOURCE, event, correlate=correlate or ['Node_Down', 'Node_Up'], severity=severity,
+                      environment=['PROD'], **kwargs)
+        alert.receive_now()
+        return alert
+
+    def document(self, alertid):
+
+        return self.db.db.alerts.find_one({'_id': alertid})
+
+    def test_new_duplicate_correlated(self):
+
+        action, alert = self.db.ingest_alert(self.alert('Node_Down'))
+        self.assertEqual(action, NEW_ALERT)
+        alertid = alert.alertid
+        self.assertEqual(alert.status, 'open')
+        self.assertEqual(self.document(alertid)['duplicateCount'], 0)
+
+        action, alert = self.db.ingest_alert(self.alert('Node_Down', text='still down'))
+        self.assertEqual(action, DUPLICATE_ALERT)
+        self.assertEqual((alert.alertid, alert.duplicate_count, alert.repeat), (alertid, 1, True))
+        self.assertEqual(alert.text, 'still down')
+
+        action, alert = self.db.ingest_alert(self.alert('Node_Up', severity='normal'))
+        self.assertEqual(action, CORRELATED_ALERT)
+        self.assertEqual((alert.alertid, alert.event, alert.status), (alertid, 'Node_Up', 'closed'))
+        self.assertEqual((alert.duplicate_count, alert.previous_severity), (0, 'major'))
+
+        self.assertEqual(self.db.db.alerts.find({'resource': self.RESOURCE}).count(), 1)
+
+    def test_history(self):
+
+        alertid = self.db.ingest_alert(self.alert('Node_Down'))[1].alertid
+        self.db.ingest_alert(self.alert('Node_Down', status='ack'))  # duplicate with a status change
+        self.db.ingest_alert(self.alert('Node_Up', severity='normal'))
+
+        history = [(entry.get('event'), entry.get('status')) for entry in self.document(alertid)['history']]
+        self.assertEqual(history, [('Node_Down', None), (None, 'open'), (None, 'ack'), ('Node_Up', None),
+                                   (None, 'closed')])
+        self.assertEqual(self.db.db.history.find({'alertId': alertid}).count(), 5)
+
+    def test_stale_cache(self):
+        """
+        Ensure an alert classified from a stale cache entry fails the guard and is re-classified
+        """
+        cache = AlertCache(10)
+        alertid = self.db.ingest_alert(self.alert('Node_Down'), cache)[1].alertid
+
+        self.db.db.alerts.update({'_id': alertid}, {'$set': {'status': 'ack'}})
+        action, alert = self.db.ingest_alert(self.alert('Node_Down'), cache)
+
+        self.assertEqual(action, DUPLICATE_ALERT)
+        self.assertEqual((alert.alertid, alert.status, alert.duplicate_count), (alertid, 'ack', 1))
+        self.assertEqual(cache.get(self.alert('Node_Down'))[1]['status'], 'ack')
+
+    def test_event_changed(self):
+        """
+        Ensure a duplicate is not counted on an alert correlated to another event since it was read
+        """
+        cache = AlertCache(10)
+        alertid = self.db.ingest_alert(self.alert('Node_Down'), cache)[1].alertid
+
+        # same severity and status, but no longer a Node_Down alert
+        self.db.db.alerts.update({'_id': alertid}, {'$set': {'event': 'Node_Restart', 'correlatedEvents': None}})
+        action, alert = self.db.ingest_alert(self.alert('Node_Down'), cache)
+
+        self.assertEqual(action, NEW_ALERT)
+        self.assertNotEqual(alert.alertid, alertid)
+        self.assertEqual(self.document(alertid)['duplicateCount'], 0)
+
+    def test_attempts_exhausted(self):
+
+        self.db.ingest_alert(self.alert('Node_Down'))
+        self.db._find_and_modify = lambda query, update: None  # always modified by another writer
+
+        self.assertEqual(self.db.ingest_alert(self.alert('Node_Down')), (None, None))
+        self.assertEqual(self.db.ingest_alert(self.alert('Node_Up')), (None, None))
+
+    def test_batch(self):
+        """
+        Ensure new, duplicate and correlated alerts in one batch are classified in arrival order
+        """
+        alertid = self.db.ingest_alert(self.alert('Node_Down'))[1].alertid
+
+        other = self.alert('Disk_Full', severity='minor', correlate=['Disk_Full'])
+        alerts = [self.alert('Node_Down'), other, self.alert('Node_Up', severity='normal'),
+                  self.alert('Disk_Full', severity='minor', correlate=['Disk_Full']), self.alert('Node_Down')]
+        results = self.db.ingest_alerts(alerts)
+
+        self.assertEqual([action for action, alert in results],
+                         [DUPLICATE_ALERT, NEW_ALERT, CORRELATED_ALERT, DUPLICATE_ALERT, CORRELATED_ALERT])
+        self.assertEqual([alert.alertid for action, alert in results],
+                         [alertid, other.alertid, alertid, other.alertid, alertid])
+
+        document = self.document(alertid)
+        self.assertEqual((document['event'], document['severity'], document['duplicateCount']), ('Node_Down', 'major', 0))
+        self.assertEqual(document['lastReceiveId'], alerts[4].alertid)
+        self.assertEqual(self.document(other.alertid)['duplicateCount'], 1)
+        self.assertEqual(self.db.db.alerts.find({'resource': self.RESOURCE}).count(), 2)
+
+        events = [entry['event'] for entry in self.db.get_history(alertid) if 'event' in entry]
+        self.assertEqual(events, ['Node_Down', 'Node_Up', 'Node_Down'])
+
+    def test_batch_same_alert(self):
+        """
+        Ensure alerts for the same new alert in one batch are saved as one alert and its duplicates
+        """
+        alerts = [self.alert('Node_Down') for i in range(3)]
+        results = self.db.ingest_alerts(alerts, AlertCache(10))
+
+        self.assertEqual([action for action, alert in results], [NEW_ALERT, DUPLICATE_ALERT, DUPLICATE_ALERT])
+        self.assertEqual(set(alert.alertid for action, alert in results), set([alerts[0].alertid]))
+        self.assertEqual(self.document(alerts[0].alertid)['duplicateCount'], 2)
+        self.assertEqual(self.db.db.alerts.find({'resource': self.RESOURCE}).count(), 1)
+
+    def test_batch_history_limit(self):
+        """
+        Ensure a new alert that flaps within one batch keeps only history_limit entries, and full history
+        """
+        saved = CONF.history_limit
+        CONF.history_limit = -4
+        try:
+            alerts = [self.alert('Node_Down') if i % 2 == 0 else self.alert('Node_Up', severity='normal')
+                      for i in range(6)]
+            results = self.db.ingest_alerts(alerts)
+        finally:
+            CONF.history_limit = saved
+
+        alertid = results[0][1].alertid
+        history = [(entry.get('event'), entry.get('status')) for entry in self.document(alertid)['history']]
+        self.assertEqual(history, [('Node_Down', None), (None, 'open'), ('Node_Up', None), (None, 'closed')])
+        self.assertEqual(self.db.db.history.find({'alertId': alertid}).count(), 12)
+
+    def test_batch_partial_failure(self):
+        """
+        Ensure an alert that can't be written doesn't stop the rest of the batch
+        """
+        existing = self.db.ingest_alert(self.alert('Node_Down'))[1]
+
+        # an alert id that is already used by another alert can never be inserted
+        reused = self.alert('Disk_Full', severity='minor', correlate=['Disk_Full'], alertid=existing.alertid)
+        alerts = [self.alert('Node_Down'), reused, self.alert('CPU_High', correlate=['CPU_High'])]
+        results = self.db.ingest_alerts(alerts)
+
+        self.assertEqual([action for action, alert in results], [DUPLICATE_ALERT, None, NEW_ALERT])
+        self.assertEqual(results[1], (None, None))
+        self.assertEqual(self.document(existing.alertid)['duplicateCount'], 1)
+        self.assertEqual(self.db.db.alerts.find({'resource': self.RESOURCE, 'event': 'Disk_Full'}).count(), 0)
+
+    def test_batch_inserted_by_another_writer(self):
+        """
+        Ensure a new alert inserted by another writer after the batch was classified is saved as a duplicate
+        """
+        def insert_first(count):
+            del self.db._next_changes
+            self.db.ingest_alert(self.alert('Node_Down'))
+            return self.db._next_changes(count)
+
+        self.db._next_changes = insert_first  # called after the batch is classified
+        results = self.db.ingest_alerts([self.alert('Node_Down')])
+
+        self.assertEqual(results[0][0], DUPLICATE_ALERT)
+        self.assertEqual(self.db.db.alerts.find({'resource': self.RESOURCE}).count(), 1)
+
+    def test_batch_status_changed_by_another_writer(self):
+        """
+        Ensure an alert acked after the batch was classified keeps its status and is counted once
+        """
+        cache = AlertCache(10)
+        alertid = self.db.ingest_alert(self.alert('Node_Down'), cache)[1].alertid
+
+        def ack_first(count):
+            del self.db._next_changes
+            self.db.db.alerts.update({'_id': alertid}, {'$set': {'status': 'ack'}})
+            return self.db._next_changes(count)
+
+        self.db._next_changes = ack_first  # called after the batch is classified
+        results = self.db.ingest_alerts([self.alert('Node_Down'), self.alert('Disk_Full', correlate=['Disk_Full'])],
+                                        cache)
+
+        self.assertEqual([action for action, alert in results], [DUPLICATE_ALERT, NEW_ALERT])
+        self.assertEqual((results[0][1].status, results[0][1].duplicate_count), ('ack', 1))
+        self.assertEqual((self.document(alertid)['status'], self.document(alertid)['duplicateCount']), ('ack', 1))
+        self.assertEqual(cache.get(self.alert('Node_Down'))[1]['status'], 'ack')
+
+
+class Request(object):
+
+    def __init__(self, *args):
+
+        self.args = utils.MultiDict(args)
+
+
+class TestCounts(unittest.TestCase):
+    """
+    Ensures alert counts are aggregated by severity and status and shared by requests for the same query.
+    """
+
+    def setUp(self):
+
+        config.parse_args(sys.argv)
+
+        self.RESOURCE = 'countshost135'
+        self.db = Mongo()
+        self.db.delete_resource(self.RESOURCE)
+
+        for i, (severity, status) in enumerate([('critical', 'open'), ('major', 'open'), ('major', 'ack'),
+                                                ('minor', 'closed'), ('major', 'open')]):
+            self.save(i, severity, status)
+
+    def save(self, i, severity, status):
+
+        now = datetime.datetime.utcnow()
+        self.db.save_alert(Alert(self.RESOURCE, 'Event%d' % i, severity=severity, status=status,
+                                 receive_time=now, last_receive_time=now))
+
+    def test_counts(self):
+        """
+        Ensure aggregated counts match a count per severity and status
+        """
+        query = {'resource': self.RESOURCE}
+        found, severity_count, status_count = self.db.get_counts(query)
+
+        self.assertEqual(found, self.db.get_count(query))
+        for severity in severity_code.ALL:
+            self.assertEqual(severity_count[severity], self.db.get_count(dict(query, severity=severity)), severity)
+        for status in status_code.ALL:
+            self.assertEqual(status_count[status], self.db.get_count(dict(query, status=status)), status)
+        self.assertEqual((found, severity_count['major'], status_count['open']), (5, 3, 3))
+
+        self.assertEqual(self.db.get_counts({'resource': self.RESOURCE, 'severity': 'warning'})[0], 0)
+
+    def test_shared(self):
+        """
+        Ensure requests for the same query share one aggregation
+        """
+        counts = utils.QueryCache(60)
+        calls = list()
+
+        def get_counts(query):
+            calls.append(query)
+            return self.db.get_counts(query)
+
+        request = Request(('resource', self.RESOURCE), ('from-date', '2013-05-01T12:00:00.000Z'))
+        results = list()
+        for i in range(2):
+            query, sort, limit, query_time = utils.parse_fields(request)
+            results.append(counts.get(query, get_counts, key=utils.without_request_time(query, query_time)))
+            self.save(5 + i, 'minor', 'open')
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0], 5)
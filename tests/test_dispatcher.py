@@ -0,0 +1,284 @@
+
+import os
+import sys
+import Queue
+import unittest
+
+from pymongo.errors import ConnectionFailure
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.common import config
+from alerta.common.alert import Alert
+from alerta.common.heartbeat import Heartbeat
+from alerta.server import daemon
+from alerta.server.database import NEW_ALERT, DUPLICATE_ALERT
+from alerta.server.dispatcher import Dispatcher
+from alerta.server.daemon import ServerMessage, ProcessDispatchMessage, BatchWorkerThread
+
+CONF = config.CONF
+
+
+class FakeMessaging(object):
+
+    def received(self, headers, body):
+        return headers['message-id']
+
+    def client_ack(self):
+        return True
+
+    def ack(self, message_id):
+        pass
+
+
+class FakeDatabase(object):
+    """
+    Saves every alert as new, except alerts for the same event in one batch which are duplicates.
+    """
+    def __init__(self):
+
+        self.batches = list()
+        self.heartbeats = list()
+        self.fail = False
+
+    def ingest_alerts(self, alerts, cache=None):
+
+        if self.fail:
+            raise ConnectionFailure('could not connect to MongoDB')
+        self.batches.append(alerts)
+
+        results = list()
+        seen = dict()
+        for alert in alerts:
+            if alert.event in seen:
+                seen[alert.event].last_receive_time = alert.receive_time
+                results.append((DUPLICATE_ALERT, seen[alert.event]))
+            else:
+                seen[alert.event] = alert
+                results.append((NEW_ALERT, alert))
+        return results
+
+    def update_hb(self, heartbeat):
+
+        self.heartbeats.append(heartbeat)
+
+    def update_timer_metrics(self, timings):
+
+        pass
+
+
+class FakeBroker(object):
+
+    def __init__(self):
+
+        self.sent = list()
+        self.acked = list()
+        self.metrics = list()
+
+    def send(self, alert, destinations):
+
+        self.sent.append(alert)
+
+    def ack(self, message_id):
+
+        self.acked.append(message_id)
+
+    def metric_send(self, name, value):
+
+        self.metrics.append(name)
+
+
+class TestDispatcher(unittest.TestCase):
+    """
+    Ensures alerts are sharded by correlation key.
+    """
+
+    def setUp(self):
+
+        self.dispatcher = Dispatcher(8)
+
+    def test_correlated_alerts_same_shard(self):
+        """
+        Ensure alerts for the same environment and resource are queued for the same worker
+        """
+        down = Alert('router55', 'Node_Down', correlate=['Node_Down', 'Node_Up'], environment=['PROD'])
+        up = Alert(u'router55', u'Node_Up', correlate=['Node_Down', 'Node_Up'], environment=[u'PROD'])
+
+        self.assertEquals(self.dispatcher.shard(down), self.dispatcher.shard(up))
+
+        self.dispatcher.put(down)
+        self.dispatcher.put(up)
+
+        queue = self.dispatcher.queues[self.dispatcher.shard(down)]
+        self.assertEquals(queue.get(), down)
+        self.assertEquals(queue.get(), up)
+        self.assertEquals(self.dispatcher.qsize(), 0)
+
+    def test_alerts_spread_across_shards(self):
+        """
+        Ensure different resources are spread across workers
+        """
+        for i in range(100):
+            self.dispatcher.put(Alert('host%d' % i, 'event'))
+
+        self.assertEquals(self.dispatcher.qsize(), 100)
+        self.assertTrue(all(self.dispatcher.qsizes()))
+
+    def test_shutdown(self):
+        """
+        Ensure every worker receives a shutdown sentinel
+        """
+        self.dispatcher.shutdown()
+
+        self.assertEquals(self.dispatcher.qsizes(), [1] * 8)
+
+    def test_redispatch_unacked_messages(self):
+        """
+        Ensure messages a crashed process had not acked are queued again once, in order
+        """
+        handler = ProcessDispatchMessage(FakeMessaging(), self.dispatcher, None)
+        headers = {'type': 'Alert', 'correlation-id': '1234'}
+        body = '{"environment": ["PROD"], "resource": "router55"}'
+        for i in range(4):
+            handler.on_message(dict(headers, **{'message-id': str(i)}), body)
+
+        index = self.dispatcher.shard_for(Dispatcher.correlation_key(['PROD'], 'router55'), 8)
+        queue = self.dispatcher.queues[index]
+        queue.get()
+        queue.get()
+        handler.acked('0')  # process crashed after taking two messages and acking one
+
+        self.assertEquals(handler.redispatch(index), 3)
+        self.assertEquals([queue.get()[2] for i in range(queue.qsize())], ['1', '2', '3'])
+        self.assertEquals(self.dispatcher.qsize(), 0)
+
+    def test_string_environment(self):
+        """
+        Ensure an environment that is a string is sharded like a list with one environment
+        """
+        self.assertEquals(Dispatcher.correlation_key('PROD', 'router55'), Dispatcher.correlation_key(['PROD'], 'router55'))
+        self.assertEquals(Dispatcher.correlation_key(None, 'router55'), 'PROD/router55')
+
+    def test_transform_before_dispatch(self):
+        """
+        Ensure alerts are sharded by the resource and environment a transform sets
+        """
+        def transform_alert(alert):
+            alert.resource = 'router55'
+
+        handler = ServerMessage(FakeMessaging(), self.dispatcher, FakeBroker(), ack=lambda message_id: None)
+        saved, Alert.transform_alert = Alert.transform_alert, transform_alert
+        try:
+            for i in range(8):
+                handler.dispatch({'type': 'Alert', 'correlation-id': str(i)},
+                                 '{"resource": "host%d", "event": "Node_Down"}' % i, str(i))
+        finally:
+            Alert.transform_alert = saved
+
+        queue = self.dispatcher.queues[self.dispatcher.shard_for(Dispatcher.correlation_key(['PROD'], 'router55'), 8)]
+        self.assertEquals([queue.get()[1] for i in range(queue.qsize())], [str(i) for i in range(8)])
+        self.assertEquals(self.dispatcher.qsize(), 0)
+
+    def test_moved_alert(self):
+        """
+        Ensure an alert moved by a process is dispatched again, without headers, and redispatched by its new process
+        """
+        handler = ProcessDispatchMessage(FakeMessaging(), self.dispatcher, None)
+        handler.on_message({'type': 'Alert', 'correlation-id': '1234', 'message-id': '0'},
+                           '{"environment": ["PROD"], "resource": "router55"}')
+        index = self.dispatcher.shard_for(Dispatcher.correlation_key(['PROD'], 'router55'), 8)
+        self.dispatcher.queues[index].get()
+
+        resource = [r for r in ['router%d' % i for i in range(100)]
+                    if self.dispatcher.shard_for(Dispatcher.correlation_key(['PROD'], r), 8) != index][0]
+        alert = Alert(resource, 'Node_Down')
+        handler.moved('0', alert)
+
+        moved = self.dispatcher.shard(alert)
+        self.assertEquals(self.dispatcher.queues[moved].get(), (None, alert, '0'))
+        self.assertEquals(handler.redispatch(index), 0)
+        self.assertEquals(handler.redispatch(moved), 1)
+        self.assertEquals(self.dispatcher.queues[moved].get(), (None, alert, '0'))
+
+        handler.acked('0')
+        self.assertEquals(handler.redispatch(moved), 0)
+
+
+
+class TestBatchWorker(unittest.TestCase):
+    """
+    Ensures the batch worker saves alerts in batches and acks every message once it is processed.
+    """
+
+    def setUp(self):
+
+        self.saved = dict((k, CONF.get(k)) for k in ('ingest_batch_size', 'ingest_batch_wait', 'loop_every',
+                                                     'forward_duplicate', 'outbound_queue', 'outbound_topic'))
+        CONF.update(ingest_batch_size=3, ingest_batch_wait=10, loop_every=1, forward_duplicate=False,
+                    outbound_queue='/queue/logger', outbound_topic='/topic/notify')
+
+        self.mongo = daemon.Mongo
+        daemon.Mongo = FakeDatabase
+
+        self.queue = Queue.Queue()
+        self.broker = FakeBroker()
+        self.spool = list()
+        self.worker = BatchWorkerThread(self.broker, self.queue, self.broker, spool=None)
+
+    def tearDown(self):
+
+        daemon.Mongo = self.mongo
+        CONF.update(self.saved)
+
+    @staticmethod
+    def alert(resource):
+
+        alert = Alert(resource, 'Node_Down')
+        alert.receive_now()
+        return alert
+
+    def put(self, *items):
+
+        for item in items:
+            self.queue.put(item)
+        self.queue.put(None)
+
+    def test_batches(self):
+
+        alerts = [self.alert('router%d' % (i % 2)) for i in range(4)]
+        self.put((alerts[0], '0'), (Heartbeat(), '1'), (alerts[1], '2'), (alerts[2], '3'), (alerts[3], '4'))
+
+        self.worker.run()
+
+        self.assertEqual(self.worker.db.batches, [alerts[:2], alerts[2:]])
+        self.assertEqual(len(self.worker.db.heartbeats), 1)
+        self.assertEqual(sorted(self.broker.acked), ['0', '1', '2', '3', '4'])
+        self.assertEqual(self.broker.sent, [alerts[0], alerts[2]])  # duplicates are not forwarded
+        self.assertEqual(self.queue.unfinished_tasks, 0)
+
+    def test_database_unavailable(self):
+
+        class Spool(list):
+            def put(self, record):
+                self.append(record)
+
+        self.worker.spool = Spool()
+        self.worker.db.fail = True
+        alerts = [self.alert('router55'), self.alert('router56')]
+        self.put((alerts[0], '0'), (alerts[1], '1'))
+
+        self.worker.run()
+
+        self.assertEqual([record['id'] for record in self.worker.spool], [alert.alertid for alert in alerts])
+        self.assertEqual(self.broker.acked, ['0', '1'])
+        self.assertEqual(self.broker.sent, [])
+        self.assertEqual(self.queue.unfinished_tasks, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+
+import os
+import sys
+import imp
+import shutil
+import logging
+import datetime
+import tempfile
+import unittest
+
+import pytz
+
+from StringIO import StringIO
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.server.database import Mongo
+from alerta.common.alert import Alert
+from alerta.common import config
+
+CONF = config.CONF
+
+
+class TestHistoryDocuments(unittest.TestCase):
+    """
+    Ensures history entries are trimmed on alerts and keyed by time in the history collection.
+    """
+
+    def tearDown(self):
+
+        CONF.history_limit = config.DEFAULTS['history_limit']
+
+    def test_push_history(self):
+
+        CONF.history_limit = -10
+        self.assertEqual(Mongo._push_history([{'status': 'ack'}]),
+                         {'history': {'$each': [{'status': 'ack'}], '$slice': -10}})
+
+        CONF.history_limit = 5  # positive limits still keep the latest entries
+        self.assertEqual(Mongo._push_history(list())['history']['$slice'], -5)
+
+    def test_history_document(self):
+
+        entry = {'status': 'ack', 'updateTime': datetime.datetime(2013, 5, 1, 13, 0, 0, tzinfo=pytz.timezone('Europe/London'))}
+        document = Mongo._history_document('e4f5a6b7', entry)
+
+        self.assertEqual(document['alertId'], 'e4f5a6b7')
+        self.assertEqual(document['status'], 'ack')
+        self.assertEqual(document['historyTime'], entry['updateTime'].astimezone(pytz.utc).replace(tzinfo=None))
+        self.assertTrue('alertId' not in entry)
+
+        entry = {'event': 'Node_Down', 'receiveTime': datetime.datetime(2013, 5, 1, 12, 0, 0)}
+        self.assertEqual(Mongo._history_document('e4f5a6b7', entry)['historyTime'], entry['receiveTime'])
+
+
+class TestHistory(unittest.TestCase):
+    """
+    Ensures full alert history is paged from the history collection and migrated from alerts.
+    """
+
+    def setUp(self):
+
+        config.parse_args(sys.argv)
+
+        self.RESOURCE = 'historyhost321'
+        self.db = Mongo()
+        self.db.delete_resource(self.RESOURCE)
+
+        self.alert = Alert(self.RESOURCE, 'HistoryEvent', receive_time=datetime.datetime.utcnow())
+        self.db.save_alert(self.alert)
+        self.db.db.history.remove({'alertId': self.alert.alertid})
+
+    def tearDown(self):
+
+        CONF.history_limit = config.DEFAULTS['history_limit']
+
+    def embed_history(self, count):
+
+        history = [{'status': 'status%d' % i, 'text': 'entry %d' % i,
+                    'updateTime': datetime.datetime(2013, 5, 1, 12, i, 0)} for i in range(count)]
+        self.db.db.alerts.update({'_id': self.alert.alertid}, {'$set': {'history': history}})
+        return history
+
+    def test_get_history(self):
+
+        for i in range(5):
+            self.db.update_status(alertid=self.alert.alertid, status='status%d' % i)
+
+        history = self.db.get_history(self.alert.alertid, limit=3)
+        self.assertEqual([entry['status'] for entry in history], ['status4', 'status3', 'status2'])
+
+        # paged by time and _id, so entries written in the same millisecond are not skipped
+        before = (history[-1]['historyTime'], str(history[-1]['_id']))
+        history = self.db.get_history(self.alert.alertid[:8], before=before, limit=3)
+        self.assertEqual([entry['status'] for entry in history], ['status1', 'status0'])
+
+        self.assertEqual(self.db.get_history('zzzzzzzz'), None)
+
+    def test_migrate_history(self):
+
+        CONF.history_limit = -2
+        self.embed_history(5)
+
+        alerts, entries = self.db.migrate_history(batch_size=2)
+        self.assertTrue(alerts >= 1)
+        self.assertTrue(entries >= 5)
+
+        history = self.db.get_history(self.alert.alertid)
+        self.assertEqual([entry['status'] for entry in history], ['status4', 'status3', 'status2', 'status1', 'status0'])
+        embedded = self.db.db.alerts.find_one({'_id': self.alert.alertid})['history']
+        self.assertEqual([entry['status'] for entry in embedded], ['status3', 'status4'])
+
+        # entries already copied are not copied again
+        self.db.migrate_history()
+        self.assertEqual(self.db.db.history.find({'alertId': self.alert.alertid}).count(), 5)
+
+
+class TestHistoryMigration(unittest.TestCase):
+    """
+    Ensures alerta-history --migrate moves embedded history to the history collection.
+    """
+
+    def setUp(self):
+
+        self.log_dir = tempfile.mkdtemp()
+        self.excepthook = sys.excepthook
+        self.argv = sys.argv
+        self.stdout = sys.stdout
+
+        config.parse_args(sys.argv)
+
+        self.RESOURCE = 'historyhost654'
+        self.db = Mongo()
+        self.db.delete_resource(self.RESOURCE)
+
+        self.alert = Alert(self.RESOURCE, 'HistoryEvent', receive_time=datetime.datetime.utcnow())
+        self.db.save_alert(self.alert)
+        self.db.db.history.remove({'alertId': self.alert.alertid})
+
+    def tearDown(self):
+
+        sys.excepthook = self.excepthook
+        sys.argv = self.argv
+        sys.stdout = self.stdout
+
+        log = logging.getLogger('alerta')
+        for handler in log.handlers[:]:
+            handler.close()
+            log.removeHandler(handler)
+        shutil.rmtree(self.log_dir)
+
+    def test_migrate(self):
+
+        history = [{'status': 'status%d' % i, 'updateTime': datetime.datetime(2013, 5, 1, 12, i, 0)} for i in range(3)]
+        self.db.db.alerts.update({'_id': self.alert.alertid}, {'$set': {'history': history}})
+
+        alerta_history = imp.load_source('alerta_history', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                        os.pardir, 'bin', 'alerta-history'))
+        sys.argv = ['alerta-history', '--migrate', '--batch-size', '2', '--log-dir', self.log_dir]
+        sys.stdout = StringIO()
+        alerta_history.main()
+        output = sys.stdout.getvalue()
+        sys.stdout = self.stdout
+
+        self.assertTrue(output.startswith('Migrated '), output)
+        self.assertEqual(self.db.db.history.find({'alertId': self.alert.alertid}).count(), 3)
+        self.assertEqual(len(self.db.db.alerts.find_one({'_id': self.alert.alertid})['history']),
+                         min(3, abs(CONF.history_limit)))
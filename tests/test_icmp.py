@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import errno
+import socket
+import struct
+import functools
+import unittest
+import Queue
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.pinger.icmp import IcmpPinger, checksum, PING_OK, PING_FAILED, PING_ERROR
+
+
+class TestIcmp(unittest.TestCase):
+    """
+    Ensures echo requests are valid and ping results are summarised like the ping command.
+    """
+
+    def test_checksum(self):
+        """
+        Ensure a packet including its checksum sums to zero
+        """
+        pinger = IcmpPinger.__new__(IcmpPinger)
+        pinger.ident = 0x1234
+        packet = pinger._packet(7)
+
+        self.assertEqual(struct.unpack('!BBHHH', packet[:8])[3:], (0x1234, 7))
+        self.assertEqual(len(packet), 64)
+        self.assertEqual(checksum(packet), 0)
+        self.assertEqual(checksum('\x08\x00\x00\x00\x00\x01\x00\x01'), 0xf7fd)
+
+    def test_result(self):
+        """
+        Ensure loss and round trip times are computed from the replies
+        """
+        self.assertEqual(IcmpPinger._result({'sent': 5, 'rtts': [1.0, 2.0, 3.0, 4.0, 5.0]}, 5)[:3],
+                         (PING_OK, (3.0, 5.0), '0'))
+        self.assertEqual(IcmpPinger._result({'sent': 5, 'rtts': [1.0]}, 5)[:3], (PING_FAILED, (1.0, 1.0), '80'))
+        self.assertEqual(IcmpPinger._result({'sent': 2, 'rtts': []}, 2)[:3], (PING_FAILED, (0, 0), '100'))
+        self.assertEqual(IcmpPinger._result({'sent': 0, 'rtts': [], 'error': 'unknown host'}, 2)[:3],
+                         (PING_ERROR, (0, 0), 'n/a'))
+
+    def test_seq_wraps_around_outstanding(self):
+        """
+        Ensure a sequence number still waiting for a reply is not reused when they wrap around
+        """
+        pinger = IcmpPinger.__new__(IcmpPinger)
+        pinger.seq = 0xFFFE
+        pinger.outstanding = {0xFFFF: None, 0: None, 2: None}
+
+        self.assertEqual(pinger._next_seq(), 1)
+        self.assertEqual(pinger._next_seq(), 3)
+
+    def test_callback_error(self):
+        """
+        Ensure an exception in a callback is logged and not raised from poll()
+        """
+        def callback(result):
+            raise KeyError('resource')
+
+        pinger = self.pinger()
+        pinger._finish({'callback': callback, 'count': 2, 'sent': 2, 'rtts': []})
+        pinger.poll(0)
+
+    def test_replies_timed_before_callbacks(self):
+        """
+        Ensure a slow callback doesn't add to the round trip time of the replies read with it
+        """
+        rtts = dict()
+
+        def callback(host, result):
+            rtts[host] = result[1][0]
+            time.sleep(0.1)
+
+        pinger = self.pinger()
+        for seq, host in [(1, '10.0.0.1'), (2, '10.0.0.2')]:
+            target = {'address': host, 'callback': functools.partial(callback, host), 'count': 1, 'wait': 5,
+                      'sent': 1, 'failed': 0, 'outstanding': 1, 'rtts': list()}
+            pinger.outstanding[seq] = (target, time.time())
+            pinger.sock.replies.append((struct.pack('!BBHHH', 0, 0, 0, pinger.ident, seq), (host, 0)))
+
+        pinger.poll(0)
+
+        self.assertEqual(sorted(rtts), ['10.0.0.1', '10.0.0.2'])
+        self.assertTrue(max(rtts.values()) < 100, rtts)
+        self.assertEqual(pinger.outstanding, dict())
+
+    def test_resolved_by_resolver(self):
+        """
+        Ensure hosts are resolved outside of poll() and unknown hosts are called back with an error
+        """
+        results = list()
+        pinger = self.pinger()
+        pinger.submit('unknown.example', results.append, count=1)
+
+        host, target = pinger.resolving.get_nowait()
+        self.assertEqual(host, 'unknown.example')
+        pinger.resolved.put((host, None, target))
+        pinger.poll(0)
+
+        self.assertEqual(results[0][0], PING_ERROR)
+        self.assertEqual(results[0][3], 'ping: unknown host')
+        self.assertEqual(pinger.addresses[host][0], None)
+
+    @staticmethod
+    def pinger():
+        """
+        A pinger with a socket that returns the replies it is given, and no resolver threads
+        """
+        class Socket(object):
+
+            def __init__(self):
+                self.replies = list()
+                self.readable, writable = os.pipe()
+                os.write(writable, '.')  # always readable
+
+            def fileno(self):
+                return self.readable
+
+            def recvfrom(self, size):
+                if not self.replies:
+                    raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+                return self.replies.pop(0)
+
+        pinger = IcmpPinger.__new__(IcmpPinger)
+        pinger.sock = Socket()
+        pinger.raw = False
+        pinger.ident = 0x1234
+        pinger.seq = 0
+        pinger.addresses = dict()
+        pinger.schedule = list()
+        pinger.outstanding = dict()
+        pinger.finished = list()
+        pinger.resolving = Queue.Queue()
+        pinger.resolved = Queue.Queue()
+        return pinger
@@ -0,0 +1,95 @@
+import os
+import re
+import sys
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.server.indexes import query_shapes, index_for, recommend_indexes, REQUIRED_INDEXES
+
+
+class TestIndexAdvisor(unittest.TestCase):
+    """
+    Ensures query shapes are recorded and indexes recommended for them.
+    """
+
+    def setUp(self):
+
+        self.existing = dict(('%d' % i, keys) for i, keys in enumerate(REQUIRED_INDEXES['alerts']))
+        self.existing['_id_'] = [('_id', 1)]
+
+    def test_query_shape(self):
+        """
+        Ensure fields are classified by how an index can be used for them
+        """
+        query = {'status': 'open', 'severity': {'$in': ['major', 'minor']}, 'resource': {'$regex': re.compile('^web')},
+                 'event': {'$regex': re.compile('^node', re.IGNORECASE)}, 'lastReceiveTime': {'$gt': 0}}
+        shape, = query_shapes(query, [('lastReceiveTime', -1)])
+
+        self.assertEquals(shape['equality'], ['severity', 'status'])
+        self.assertEquals(shape['range'], ['lastReceiveTime', 'resource'])
+        self.assertEquals(shape['filter'], ['event'])
+        self.assertEquals(shape['sort'], [['lastReceiveTime', -1]])
+
+    def test_or_shapes(self):
+        """
+        Ensure each clause of an $or is a separate shape
+        """
+        query = {'status': 'open', '$or': [{'_id': {'$regex': '^abc'}}, {'lastReceiveId': {'$regex': '^abc'}}]}
+        shapes = query_shapes(query)
+
+        self.assertEquals([(s['equality'], s['range']) for s in shapes],
+                          [(['status'], ['_id']), (['status'], ['lastReceiveId'])])
+
+    def test_index_for(self):
+        """
+        Ensure indexes have equality, sort then range fields and only one array field
+        """
+        shape, = query_shapes({'environment': 'PROD', 'service': 'Web', 'status': 'open',
+                               'resource': {'$regex': '^web'}}, [('lastReceiveTime', -1)])
+
+        self.assertEquals(index_for(shape), [('environment', 1), ('status', 1), ('lastReceiveTime', -1),
+                                             ('resource', 1)])
+        self.assertEquals(index_for(query_shapes({'text': {'$ne': 'x'}})[0]), None)
+
+    def test_recommend(self):
+        """
+        Ensure an index is recommended once for a shape and redundant indexes are dropped
+        """
+        self.existing['status_1_service_1'] = [('status', 1), ('service', 1)]
+        self.existing['tags_1'] = [('tags', 1)]
+        shapes = query_shapes({'status': 'open', 'service': 'Web', 'group': 'Web'}) + \
+            query_shapes({'group': 'Web', 'status': 'open', 'service': {'$in': ['Web']}}) + \
+            query_shapes({'_id': {'$regex': '^abc'}})
+
+        advice = recommend_indexes(self.existing, shapes)
+
+        self.assertEquals(advice['create'], [[('group', 1), ('service', 1), ('status', 1)]])
+        self.assertEquals(advice['drop'], [])
+        self.assertEquals(advice['unused'], ['status_1_service_1', 'tags_1'])
+
+        self.existing['status_1_service_1_group_1'] = [('status', 1), ('service', 1), ('group', 1)]
+        advice = recommend_indexes(self.existing, shapes)
+
+        self.assertEquals(advice['create'], [])
+        self.assertEquals(advice['drop'], ['status_1_service_1'])
+
+    def test_required(self):
+        """
+        Ensure missing required indexes are created and never dropped
+        """
+        del self.existing['1']
+
+        advice = recommend_indexes(self.existing, [])
+
+        self.assertEquals(advice['create'], [[('status', 1), ('expireTime', 1)]])
+        self.assertEquals(advice['drop'], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+
+import os
+import sys
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.common import mq
+from alerta.common.config import CONF
+from alerta.common.mq import Messaging
+
+
+class FakeConnection(object):
+    """
+    Records the subscriptions and acks sent to the broker.
+    """
+    connections = list()
+
+    def __init__(self, *args, **kwargs):
+
+        self.subscriptions = list()
+        self.acks = list()
+        FakeConnection.connections.append(self)
+
+    def set_listener(self, name, listener):
+
+        pass
+
+    def start(self):
+
+        pass
+
+    def connect(self, wait=False):
+
+        pass
+
+    def subscribe(self, destination, ack, headers):
+
+        self.subscriptions.append((destination, ack, headers))
+
+    def ack(self, id):
+
+        self.acks.append(id)
+
+
+class TestSubscription(unittest.TestCase):
+    """
+    Ensures inbound messages are prefetch-limited and tracked until they are acked.
+    """
+
+    def setUp(self):
+
+        self.connection = mq.stomp.connect.StompConnection10
+        mq.stomp.connect.StompConnection10 = FakeConnection
+        FakeConnection.connections = list()
+
+        self.setup = mq.logging.setup
+        mq.logging.setup = lambda name: None  # don't log to /var/log/alerta
+
+        self.mq = Messaging(publish=False)
+        self.saved = CONF.inbound_prefetch
+        CONF.inbound_prefetch = 10
+        self.mq.connect()
+
+    def tearDown(self):
+
+        mq.stomp.connect.StompConnection10 = self.connection
+        mq.logging.setup = self.setup
+        CONF.inbound_prefetch = self.saved
+
+    def test_subscribe_auto_ack(self):
+
+        self.mq.subscribe('/queue/alerts')
+
+        self.assertEqual(self.mq.conn.subscriptions, [('/queue/alerts', 'auto', dict())])
+        self.assertEqual(self.mq.received({'message-id': '1'}, 'body'), None)
+        self.assertFalse('inFlight' in self.mq.get_stats())
+
+    def test_subscribe_client_ack(self):
+
+        self.mq.subscribe('/queue/alerts', ack='client-individual')
+
+        self.assertEqual(self.mq.conn.subscriptions, [('/queue/alerts', 'client-individual',
+                                                       {'prefetch-count': 10, 'activemq.prefetchSize': 10})])
+
+    def test_in_flight(self):
+
+        self.mq.subscribe('/queue/alerts', ack='client-individual')
+
+        self.assertEqual(self.mq.received({'message-id': '1'}, 'x' * 10), '1')
+        self.assertEqual(self.mq.received({'message-id': '2'}, 'x' * 5), '2')
+        self.assertEqual(self.mq.received({}, 'no message-id'), None)
+        stats = self.mq.get_stats()
+        self.assertEqual((stats['inFlight'], stats['inFlightBytes']), (2, 15))
+
+        self.mq.ack('1')
+        self.mq.ack('1')  # acked once
+        stats = self.mq.get_stats()
+        self.assertEqual((stats['inFlight'], stats['inFlightBytes']), (1, 5))
+        self.assertEqual(self.mq.conn.acks, ['1'])
+
+    def test_reconnect(self):
+        """
+        Ensure the subscription is restored on a new connection, and messages delivered before are not acked
+        """
+        self.mq.subscribe('/queue/alerts', ack='client-individual')
+        message_id = self.mq.received({'message-id': '1'}, 'body')
+
+        self.mq.reconnect()
+
+        self.assertEqual(len(FakeConnection.connections), 2)
+        self.assertEqual(self.mq.conn.subscriptions, [('/queue/alerts', 'client-individual',
+                                                       {'prefetch-count': 10, 'activemq.prefetchSize': 10})])
+        self.assertEqual(self.mq.get_stats()['inFlight'], 0)
+
+        self.mq.ack(message_id)  # redelivered by the broker on the new subscription
+        self.assertEqual(self.mq.conn.acks, [])
+
+if __name__ == '__main__':
+    unittest.main()
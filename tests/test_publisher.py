@@ -0,0 +1,105 @@
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.common.mq import Messaging, Publisher
+from alerta.common.spool import Spool
+
+
+class FakeConnection(object):
+
+    def __init__(self, fail):
+
+        self.fail = fail
+        self.frames = list()
+        self.listener = None
+
+    def send(self, destination, body, headers, **keyword_headers):
+
+        if body in self.fail:
+            raise socket.error(104, 'Connection reset by peer')
+        self.frames.append(body)
+        if 'receipt' in keyword_headers:
+            self.listener.on_receipt({'receipt-id': keyword_headers['receipt']}, '')
+
+
+class FakeMessaging(object):
+    """
+    Sends frames like Messaging to a fake connection.
+    """
+    send_frame = Messaging.send_frame.im_func
+    spool_frame = Messaging.spool_frame.im_func
+
+    def __init__(self, conn, spool):
+
+        self.conn = conn
+        self.spool = spool
+        self.sent = 0
+        self.dropped = 0
+
+
+class TestPublisher(unittest.TestCase):
+    """
+    Ensures the publisher thread carries on sending after a batch fails.
+    """
+
+    def setUp(self):
+
+        self.spool_dir = tempfile.mkdtemp()
+        self.conn = FakeConnection(fail=['2'])
+
+    def tearDown(self):
+
+        shutil.rmtree(self.spool_dir)
+
+    def start(self, mq):
+
+        publisher = Publisher(mq, 10, 2, 10)
+        self.conn.listener = publisher.listener
+        for i in range(5):
+            publisher.put(('/queue/test', str(i), dict()))
+        publisher.start()
+        return publisher
+
+    def test_spool_failed_batch(self):
+
+        spool = Spool('test', spool_dir=self.spool_dir)
+        publisher = self.start(FakeMessaging(self.conn, spool))
+
+        self.assertTrue(publisher.flush(5))
+        self.assertTrue(publisher.is_alive())
+        publisher.shutdown()
+
+        # rest of the failed batch is spooled, and later messages after it to keep them in order
+        replayed = list()
+        spool.replay(lambda record: replayed.append(record['body']) or True, 10)
+        spool.close()
+        self.assertEqual(self.conn.frames, ['0', '1'])
+        self.assertEqual(replayed, ['2', '3', '4'])
+        self.assertEqual(publisher.get_stats()['errors'], 1)
+
+    def test_drop_failed_batch(self):
+
+        mq = FakeMessaging(self.conn, None)
+        publisher = self.start(mq)
+
+        self.assertTrue(publisher.flush(5))
+        self.assertTrue(publisher.is_alive())
+        publisher.shutdown()
+
+        self.assertEqual(self.conn.frames, ['0', '1', '4'])
+        self.assertEqual(mq.sent, 3)
+        self.assertEqual(mq.dropped, 2)
+        self.assertEqual(publisher.get_stats()['batches'], 2)
@@ -0,0 +1,422 @@
+
+import os
+import re
+import sys
+import imp
+import base64
+import datetime
+import unittest
+
+import pytz
+
+from werkzeug.datastructures import MultiDict
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+# alerta.api.v2 connects to MongoDB and the broker when it is imported, so load its utils on their own
+utils = imp.load_source('alerta_api_v2_utils', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            os.pardir, 'alerta', 'api', 'v2', 'utils.py'))
+utils.queries = utils.ParsedQueries()  # query_cache_size is an API option
+push = imp.load_source('alerta_api_v2_push', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          os.pardir, 'alerta', 'api', 'v2', 'push.py'))
+
+
+def parse(*args):
+    """
+    Query for request arguments, as parsed by the API.
+    """
+    values = dict()
+    for k, v in args:
+        values.setdefault(k, list()).append(v)
+    query, sort, limit, from_date = utils._parse_args(sorted(values.items()))
+    return query
+
+
+class Request(object):
+
+    def __init__(self, *args):
+
+        self.args = MultiDict(args)
+
+
+class TestQueryCache(unittest.TestCase):
+    """
+    Ensures equivalent queries share cached results.
+    """
+
+    def setUp(self):
+
+        self.calls = list()
+
+    def count(self, query):
+
+        self.calls.append(query)
+        return len(self.calls)
+
+    def test_normalize_query(self):
+
+        self.assertEqual(utils.normalize_query(parse(('severity', 'major'), ('environment', 'PROD'))),
+                         utils.normalize_query({'environment': 'PROD', 'severity': 'major'}))
+        self.assertEqual(utils.normalize_query({'resource': re.compile('^router', re.I)}),
+                         utils.normalize_query({'resource': re.compile('^router', re.I)}))
+        self.assertNotEqual(utils.normalize_query({'resource': re.compile('^router', re.I)}),
+                            utils.normalize_query({'resource': re.compile('^router')}))
+        self.assertNotEqual(utils.normalize_query({'resource': re.compile('^router')}),
+                            utils.normalize_query({'resource': '^router'}))
+
+    def test_cached(self):
+
+        counts = utils.QueryCache(60)
+
+        self.assertEqual(counts.get({'severity': 'major'}, self.count), 1)
+        self.assertEqual(counts.get({'severity': 'major'}, self.count), 1)
+        self.assertEqual(counts.get({'severity': 'minor'}, self.count), 2)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_expired(self):
+
+        counts = utils.QueryCache(60)
+        counts.get({'severity': 'major'}, self.count)
+        key = counts.results.keys()[0]
+        counts.results[key] = (0, counts.results[key][1])
+
+        self.assertEqual(counts.get({'severity': 'major'}, self.count), 2)
+
+    def test_disabled(self):
+
+        counts = utils.QueryCache(0)
+        counts.get({'severity': 'major'}, self.count)
+        counts.get({'severity': 'major'}, self.count)
+
+        self.assertEqual(len(self.calls), 2)
+
+    def test_size(self):
+
+        counts = utils.QueryCache(60, size=2)
+        for severity in ['major', 'minor', 'warning']:
+            counts.get({'severity': severity}, self.count)
+
+        self.assertEqual(len(counts.results), 2)
+        self.assertEqual(counts.get({'severity': 'warning'}, self.count), 4)  # not cached when full
+
+    def test_from_date(self):
+        """
+        Ensure the request time is not part of the cache key for from-date queries
+        """
+        counts = utils.QueryCache(60)
+        request = Request(('from-date', '2013-05-01T12:00:00.000Z'), ('severity', 'major'))
+
+        for i in range(2):
+            query, sort, limit, query_time = utils.parse_fields(request)
+            self.assertTrue('$lte' in query['lastReceiveTime'])
+            self.assertEqual(counts.get(query, self.count, key=utils.without_request_time(query, query_time)), 1)
+            self.assertTrue('$lte' in self.calls[0]['lastReceiveTime'])
+
+        query = {'lastReceiveTime': {'$lte': datetime.datetime(2013, 5, 1, tzinfo=pytz.utc)}}
+        self.assertEqual(utils.without_request_time(query, datetime.datetime.utcnow()), query)
+
+
+class TestPrefixQuery(unittest.TestCase):
+    """
+    Ensures the index range for a regex includes every value the regex matches.
+    """
+
+    VALUES = ['router', 'Router55', 'ROUTER', 'rOuTeR', 'routes', 'route', 'Routers', 'switch', 'r', 'RoU',
+              'rou_ter', 'ROU_TER', 'rou.ter', 'ab', 'a.b', 'a*b', 'b', u'rout\xe9', u'ROUT\xc9', u'\xe9t\xe9', '']
+
+    def check(self, pattern, flags=0):
+
+        condition = utils.prefix_query(pattern, flags)
+        regex = re.compile(pattern, flags)
+        for value in self.VALUES:
+            if regex.search(value) and '$gte' in condition:
+                self.assertTrue(condition['$gte'] <= value < condition['$lt'],
+                                '%r matches %r but is not in %r' % (pattern, value, condition))
+        return condition
+
+    def test_prefix(self):
+
+        condition = self.check('^route')
+        self.assertEqual((condition['$gte'], condition['$lt']), ('route', 'routf'))
+        self.assertEqual(condition['$regex'].pattern, '^route')
+
+    def test_mixed_case(self):
+
+        condition = self.check('^RoUte', re.IGNORECASE)
+        self.assertEqual((condition['$gte'], condition['$lt']), ('ROUTE', 'routf'))
+        self.assertTrue(condition['$regex'].flags & re.IGNORECASE)
+
+        condition = self.check('^RoUte')
+        self.assertEqual((condition['$gte'], condition['$lt']), ('RoUte', 'RoUtf'))
+
+        condition = self.check('^rou_t', re.IGNORECASE)  # _ is between upper and lower case letters
+        self.assertEqual((condition['$gte'], condition['$lt']), ('ROU_T', 'rou_u'))
+
+    def test_special_characters(self):
+
+        self.assertEqual(self.check('^rou.ter', re.IGNORECASE)['$gte'], 'ROU')
+        self.assertEqual(self.check(r'^rou\.ter')['$gte'], 'rou')
+        self.assertEqual(self.check('^routers?')['$gte'], 'router')
+        self.assertEqual(self.check('^routers*', re.IGNORECASE)['$gte'], 'ROUTER')
+        self.assertEqual(self.check('^routers{0,1}')['$gte'], 'router')
+        self.assertEqual(self.check('^routers+')['$gte'], 'routers')
+        self.assertEqual(self.check('^a[.*]b')['$gte'], 'a')
+
+        for pattern in ['^.router', '^(router)', '^[rR]outer', '^router|^switch', '^', 'router', '^a?',
+                        r'^\d']:
+            self.assertEqual(self.check(pattern).keys(), ['$regex'], pattern)
+
+        self.assertRaises(re.error, utils.prefix_query, '^router(')
+
+    def test_non_ascii(self):
+
+        for pattern in [u'^rout\xe9', u'^\xe9t\xe9', '^rout\xc3\xa9', u'^caf\u2603', u'^rout\x7f']:
+            self.assertEqual(self.check(pattern, re.IGNORECASE).keys(), ['$regex'], repr(pattern))
+
+        condition = self.check(u'^rout', re.IGNORECASE | re.UNICODE)
+        self.assertEqual((condition['$gte'], condition['$lt']), (u'ROUT', u'rouu'))
+
+
+class TestParsedQueries(unittest.TestCase):
+    """
+    Ensures parsed queries are cached by request arguments.
+    """
+
+    def setUp(self):
+
+        self.queries = utils.queries = utils.ParsedQueries(size=2)
+
+    def tearDown(self):
+
+        utils.queries = utils.ParsedQueries()
+
+    def test_cached(self):
+
+        query = utils.parse_fields(Request(('severity', 'major'), ('environment', 'PROD')))[0]
+
+        self.assertTrue(utils.parse_fields(Request(('environment', 'PROD'), ('severity', 'major')))[0] is query)
+        self.assertTrue(utils.parse_fields(Request(('environment', 'PROD'), ('severity', 'major'),
+                                                   ('callback', 'f'), ('_', '1367409600')))[0] is query)
+        self.assertEqual(self.queries.get_stats(), {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_lru(self):
+
+        for severity in ['major', 'minor', 'major', 'warning']:
+            utils.parse_fields(Request(('severity', severity)))
+
+        self.assertEqual(self.queries.get_stats(), {'hits': 1, 'misses': 3, 'size': 2})
+        self.assertEqual([args for args in self.queries.parsed], [(('severity', ('major',)),),
+                                                                  (('severity', ('warning',)),)])
+
+    def test_sort_is_copied(self):
+
+        request = Request(('severity', 'major'))
+        utils.parse_fields(request)[1].append(('_id', -1))
+
+        self.assertEqual(utils.parse_fields(request)[1], [('lastReceiveTime', -1)])
+
+    def test_mixed_case_and_non_ascii(self):
+
+        query = utils.parse_fields(Request(('resource', u'~^Rout\xe9'), ('Environment', 'PROD')))[0]
+
+        self.assertEqual(query.keys(), ['resource'])  # unknown attributes are ignored
+        self.assertEqual(query['resource'].keys(), ['$regex'])
+        self.assertTrue(query['resource']['$regex'].match(u'ROUT\xe9r55'))
+
+        query = utils.parse_fields(Request(('resource', u'~^Rout\xe9')))[0]
+        self.assertEqual(self.queries.get_stats()['hits'], 1)
+        self.assertRaises(re.error, utils.parse_fields, Request(('resource', '~^rout(')))
+        self.assertEqual(self.queries.get_stats()['size'], 1)  # errors are not cached
+
+
+class TestMatchQuery(unittest.TestCase):
+    """
+    Ensures pushed alerts are matched against console queries the way MongoDB would.
+    """
+
+    def setUp(self):
+
+        self.alert = {
+            '_id': 'e4f5a6b7-1234-4c2d-9e8f-0a1b2c3d4e5f',
+            'lastReceiveId': '0a1b2c3d-5678-4e9f-8a7b-6c5d4e3f2a1b',
+            'resource': 'Router55',
+            'event': 'Node_Down',
+            'environment': 'PROD',
+            'severity': 'major',
+            'service': ['Network', 'Core'],
+            'tags': {'location': 'london'},
+            'repeat': False,
+            'lastReceiveTime': datetime.datetime(2013, 5, 1, 12, 0, 0),
+        }
+
+    def match(self, *args):
+
+        query = parse(*args)
+        utils.check_query(query)
+        return utils.match_query(query, self.alert)
+
+    def test_equals(self):
+
+        self.assertTrue(self.match(('environment', 'PROD')))
+        self.assertFalse(self.match(('environment', 'DEV')))
+        self.assertTrue(self.match(('service', 'Core')))
+        self.assertTrue(self.match(('tags.location', 'london')))
+        self.assertFalse(self.match(('tags.location', 'paris')))
+        self.assertTrue(self.match(('repeat', 'false')))
+        self.assertFalse(self.match(('repeat', 'true')))
+
+    def test_in(self):
+
+        self.assertTrue(self.match(('severity', 'critical'), ('severity', 'major')))
+        self.assertFalse(self.match(('severity', 'critical'), ('severity', 'minor')))
+        self.assertTrue(self.match(('service', 'Web'), ('service', 'Network')))
+
+    def test_negation(self):
+
+        self.assertTrue(self.match(('severity!', 'normal')))
+        self.assertFalse(self.match(('severity!', 'major')))
+        self.assertFalse(self.match(('severity!', 'normal'), ('severity!', 'major')))
+        self.assertFalse(self.match(('service!', 'Core')))
+        self.assertTrue(self.match(('group!', 'Misc')))  # missing field
+        self.assertFalse(self.match(('resource!', '~^router')))
+        self.assertTrue(self.match(('resource!', '~^switch'), ('resource!', '~^firewall')))
+
+    def test_regex(self):
+
+        self.assertTrue(self.match(('event', '~down')))
+        self.assertTrue(self.match(('event', '~_Up'), ('event', '~_Down')))
+        self.assertFalse(self.match(('event', '~^Down')))
+        self.assertTrue(self.match(('service', '~^core$')))
+
+    def test_prefix_range(self):
+
+        query = parse(('resource', '~^router'))
+        self.assertEqual(query['resource']['$gte'], 'ROUTER')
+        self.assertEqual(query['resource']['$lt'], 'routes')
+        self.assertTrue(utils.match_query(query, self.alert))
+        self.assertFalse(self.match(('resource', '~^routers')))
+
+        query = parse(('id', 'e4f5'))
+        self.assertEqual(query['$or'][0]['_id']['$gte'], 'e4f5')
+        self.assertTrue(utils.match_query(query, self.alert))
+        self.assertTrue(self.match(('id', '0a1b')))
+        self.assertFalse(self.match(('id', 'e4f6')))
+        self.assertFalse(self.match(('id', '.*')))
+        self.assertFalse(self.match(('id', '[e0]')))
+
+    def test_dates(self):
+
+        query = {'lastReceiveTime': {'$gt': datetime.datetime(2013, 5, 1, 11, 0, 0, tzinfo=pytz.utc)}}
+        self.assertTrue(utils.match_query(query, self.alert))
+        query = {'lastReceiveTime': {'$gt': datetime.datetime(2013, 5, 1, 13, 0, 0, tzinfo=pytz.utc)}}
+        self.assertFalse(utils.match_query(query, self.alert))
+        self.assertFalse(utils.match_query({'lastReceiveTime': {'$gt': 'yesterday'}}, self.alert))
+
+    def test_query(self):
+
+        self.assertTrue(self.match(('q', '{"$or": [{"severity": "critical"}, {"resource": "Router55"}]}')))
+        self.assertFalse(self.match(('q', '{"severity": {"$nin": ["major", "minor"]}}')))
+        self.assertTrue(self.match(('q', '{"severity": {"$exists": true}, "group": {"$exists": false}}')))
+
+    def test_unsupported_operators(self):
+
+        for q in ['{"$where": "this.severity == \'major\'"}', '{"service": {"$elemMatch": {"$eq": "Core"}}}',
+                  '{"$and": [{"severity": {"$not": {"$size": 1}}}]}']:
+            query = parse(('q', q))
+            self.assertRaises(ValueError, utils.check_query, query)
+            self.assertRaises(ValueError, utils.match_query, query, self.alert)
+
+        utils.check_query(parse(('resource!', '~^router'), ('severity', 'major'), ('severity', 'minor'),
+                                ('q', '{"$nor": [{"repeat": true}]}')))
+
+
+class TestCursor(unittest.TestCase):
+    """
+    Ensures cursors page through alerts in lastReceiveTime and _id order and reject bad tokens.
+    """
+
+    def setUp(self):
+
+        self.time = datetime.datetime(2013, 5, 1, 12, 0, 0, 123000, tzinfo=pytz.utc)
+
+    def test_round_trip(self):
+
+        token = utils.encode_cursor(self.time, 'e4f5a6b7-1234-4c2d-9e8f-0a1b2c3d4e5f')
+
+        self.assertEqual(utils.decode_cursor(token), (self.time, 'e4f5a6b7-1234-4c2d-9e8f-0a1b2c3d4e5f'))
+        self.assertEqual(utils.decode_cursor(unicode(token)), utils.decode_cursor(token))
+
+        # times are only kept to the millisecond, like MongoDB dates
+        token = utils.encode_cursor(self.time.replace(microsecond=123456), 'e4f5')
+        self.assertEqual(utils.decode_cursor(token)[0], self.time)
+
+    def test_tied_times(self):
+        """
+        Ensure alerts received at the same time as the cursor are paged by _id
+        """
+        alerts = [{'_id': alertid, 'lastReceiveTime': self.time, 'severity': 'major'} for alertid in ['a', 'b', 'c']]
+        alerts.append({'_id': 'z', 'lastReceiveTime': self.time - datetime.timedelta(milliseconds=1),
+                       'severity': 'major'})
+        alerts.append({'_id': 'a', 'lastReceiveTime': self.time + datetime.timedelta(milliseconds=1),
+                       'severity': 'major'})
+
+        query = utils.after_cursor(dict(), utils.encode_cursor(self.time, 'b'))
+        self.assertEqual([alert['_id'] for alert in alerts if utils.match_query(query, alert)], ['a', 'z'])
+
+        query = utils.after_cursor({'severity': 'minor'}, utils.encode_cursor(self.time, 'b'))
+        self.assertEqual(query['$and'][0], {'severity': 'minor'})
+        self.assertFalse(any(utils.match_query(query, alert) for alert in alerts))
+
+    def test_malformed(self):
+
+        for token in ['garbage', '!!!', u'\xe9t\xe9', '', base64.urlsafe_b64encode('{"a": 1}'),
+                      base64.urlsafe_b64encode('not json'), base64.urlsafe_b64encode('12345'),
+                      base64.urlsafe_b64encode('"2013-05-01T12:00:00.000Z"'),
+                      base64.urlsafe_b64encode('["2013-05-01T12:00:00.000Z"]'),
+                      base64.urlsafe_b64encode('["2013-05-01T12:00:00.000Z", "a", "b"]'),
+                      base64.urlsafe_b64encode('["2013-05-01T12:00:00.000Z", {"$gt": ""}]'),
+                      base64.urlsafe_b64encode('[1367409600, "a"]'),
+                      base64.urlsafe_b64encode('["yesterday", "a"]')]:
+            self.assertRaises(ValueError, utils.decode_cursor, token)
+            self.assertRaises(ValueError, utils.after_cursor, dict(), token)
+
+
+class TestAlertFeed(unittest.TestCase):
+    """
+    Ensures push clients are sent the alerts after the last one they have seen from the shared buffer.
+    """
+
+    @staticmethod
+    def receive(feed, *resources):
+
+        for resource in resources:
+            feed.on_message(dict(), '{"resource": "%s", "event": "Node_Down"}' % resource)
+
+    @staticmethod
+    def resources(events):
+
+        return [document['resource'] for seq, document, data in events]
+
+    def test_wait(self):
+
+        feed = push.AlertFeed(2, 10)
+        self.assertEqual(feed.wait(0, 0), ([], 0, False))
+
+        self.receive(feed, 'router1')
+        events, last, overrun = feed.wait(0, 0)
+        self.assertEqual((self.resources(events), last, overrun), (['router1'], 1, False))
+
+        self.receive(feed, 'router2', 'router3')
+        events, last, overrun = feed.wait(0, 0)
+        self.assertEqual((self.resources(events), last, overrun), (['router2', 'router3'], 3, True))
+        self.assertEqual(feed.wait(3, 0), ([], 3, False))
+
+    def test_buffer_size(self):
+
+        self.assertRaises(ValueError, push.AlertFeed, 0, 10)
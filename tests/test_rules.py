@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.urlmon.rules import Rule
+
+
+class TestRules(unittest.TestCase):
+    """
+    Ensures URL check rules are evaluated without eval and unsafe rules are rejected.
+    """
+
+    def setUp(self):
+
+        self.body = {'status': 'ok', 'items': [1, 2, 3], 'version': '2.1.0', 'count': 10}
+
+    def test_rules(self):
+        """
+        Ensure rules on a JSON body are evaluated like Python expressions
+        """
+        self.assertTrue(Rule("body['status'] == 'ok'")(self.body))
+        self.assertFalse(Rule("body['status'] != 'ok'")(self.body))
+        self.assertTrue(Rule("len(body['items']) > 2 and body['items'][0] == 1")(self.body))
+        self.assertTrue(Rule("0 < body['count'] <= 10")(self.body))
+        self.assertFalse(Rule("1 < body['count'] < 5")(self.body))
+        self.assertTrue(Rule("body.get('missing') is None or not body['count']")(self.body))
+        self.assertTrue(Rule("body.get('missing', 'x') in ['x', 'y']")(self.body))
+        self.assertTrue(Rule("re.match('2\\.\\d+', body['version'])")(self.body))
+        self.assertTrue(Rule("re.search('^Welcome', body)")('Welcome to the site'))
+        self.assertFalse(Rule("re.search('^Welcome', body)")('Hello\nWelcome to the site'))  # no flags, like re.search
+        self.assertRaises(KeyError, Rule("body['missing'] == 1"), self.body)
+
+    def test_unsafe_rules(self):
+        """
+        Ensure rules that could run arbitrary code are rejected when they are compiled
+        """
+        for rule in ["__import__('os').system('true')", "open('/etc/passwd').read()",
+                     "body.__class__", "[x for x in body]", "lambda: 1", "body['items'] * 100000000",
+                     "re.search(body['status'], body)", "body['status'] ==", "body.keys()"]:
+            self.assertRaises(ValueError, Rule, rule)
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.common.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    """
+    Ensures checks are spread across their period and overdue checks are counted.
+    """
+
+    def setUp(self):
+
+        self.scheduler = Scheduler(30)
+        for i in range(300):
+            self.scheduler.add('host%d' % i, i)
+
+    def test_spread(self):
+        """
+        Ensure checks are spread across the period and each runs once a period
+        """
+        now = time.time()
+        first = len(self.scheduler.due(now + 10))
+        self.assertTrue(50 < first < 150)
+        self.assertEqual(first + len(self.scheduler.due(now + 30)), 300)
+
+        for key in self.scheduler.keys():
+            self.scheduler.done(key)
+        self.assertEqual(len(self.scheduler.due(now + 30)), 0)
+        self.assertEqual(len(self.scheduler.due(now + 60)), 300)
+
+    def test_priority(self):
+        """
+        Ensure checks due at the same time run highest priority first
+        """
+        self.scheduler.add('host0', 0, priority=1)
+        self.scheduler.add('host299', 299, priority=2)
+        checks = self.scheduler.due(time.time() + 30)
+        self.assertEqual([key for key, item in checks[:2]], ['host299', 'host0'])
+
+    def test_overdue(self):
+        """
+        Ensure checks still running are coalesced and missed runs are skipped
+        """
+        now = time.time()
+        self.scheduler.due(now + 30)
+        self.scheduler.remove('host0')
+        self.assertEqual(len(self.scheduler.due(now + 60)), 0)
+        self.assertEqual(self.scheduler.get_stats()['coalesced'], 299)
+
+        for key in self.scheduler.keys():
+            self.scheduler.done(key)
+        self.assertEqual(len(self.scheduler.due(now + 150)), 299)
+        stats = self.scheduler.get_stats()
+        self.assertEqual(stats['skipped'], 299 * 2)
+        self.assertTrue(stats['maxLag'] >= 60)
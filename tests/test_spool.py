@@ -0,0 +1,193 @@
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from pymongo.errors import ConnectionFailure, OperationFailure
+
+from alerta.common import config
+from alerta.common.spool import Spool
+from alerta.server import daemon
+from alerta.server.database import NEW_ALERT
+
+CONF = config.CONF
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Ensures spooled records are replayed in order and only once.
+    """
+
+    def setUp(self):
+
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool = Spool('test', spool_dir=self.spool_dir)
+
+    def tearDown(self):
+
+        self.spool.close()
+        shutil.rmtree(self.spool_dir)
+
+    def test_replay_in_order(self):
+        """
+        Ensure records are replayed in the order they were spooled.
+        """
+        for i in range(5):
+            self.spool.put({"id": i})
+
+        replayed = list()
+        self.assertEquals(self.spool.replay(lambda r: replayed.append(r['id']) or True, 3), 3)
+        self.assertEquals(self.spool.replay(lambda r: replayed.append(r['id']) or True, 3), 2)
+        self.assertEquals(replayed, [0, 1, 2, 3, 4])
+        self.assertEquals(len(self.spool), 0)
+
+    def test_replay_stops_until_delivered(self):
+        """
+        Ensure a record that is not delivered is replayed again.
+        """
+        self.spool.put({"id": 0})
+        self.spool.put({"id": 1})
+
+        self.assertEquals(self.spool.replay(lambda r: r['id'] == 0, 10), 1)
+        self.assertEquals(len(self.spool), 1)
+        self.assertEquals(self.spool.replay(lambda r: True, 10), 1)
+        self.assertEquals(len(self.spool), 0)
+
+    def test_replay_after_restart(self):
+        """
+        Ensure replayed records are not replayed again when the spool is reopened.
+        """
+        for i in range(4):
+            self.spool.put({"id": i})
+        self.spool.replay(lambda r: True, 2)
+        self.spool.close()
+
+        self.spool = Spool('test', spool_dir=self.spool_dir)
+        replayed = list()
+        self.spool.replay(lambda r: replayed.append(r['id']) or True, 10)
+        self.assertEquals(replayed, [2, 3])
+
+    def test_spool_per_process(self):
+        """
+        Ensure server processes each spool to their own directory.
+        """
+        def spool_path(paths):
+            spool = Spool('test', spool_dir=self.spool_dir)
+            paths.put(spool.path)
+            spool.close()
+
+        paths = multiprocessing.Queue()
+        for i in range(2):
+            process = multiprocessing.Process(target=spool_path, args=(paths, ), name='ServerProcess-%d' % i)
+            process.start()
+            process.join()
+
+        process_paths = [paths.get(), paths.get()]
+        self.assertTrue(process_paths[0].endswith('-ServerProcess-0-test'), process_paths[0])
+        self.assertTrue(process_paths[1].endswith('-ServerProcess-1-test'), process_paths[1])
+        self.assertFalse(self.spool.path in process_paths)
+
+
+class FakeDatabase(object):
+    """
+    Saves every alert as new, except alerts for resource dbfail and dbdown that can't be saved.
+    """
+    def __init__(self):
+
+        self.saved = list()
+
+    def ingest_alert(self, alert, cache=None):
+
+        if alert.resource == 'dbdown':
+            raise ConnectionFailure('could not connect to MongoDB')
+        if alert.resource == 'dbfail':
+            raise OperationFailure('E11000 duplicate key error')
+        self.saved.append(alert.resource)
+        alert.receive_now()
+        return NEW_ALERT, alert
+
+    def update_timer_metric(self, create_time, receive_time):
+
+        pass
+
+
+class FakeBroker(object):
+
+    def __init__(self):
+
+        self.sent = list()
+        self.metrics = list()
+
+    def send(self, alert, destinations):
+
+        self.sent.append(alert.resource)
+
+    def metric_send(self, name, value):
+
+        self.metrics.append(name)
+
+
+class TestReplay(unittest.TestCase):
+    """
+    Ensures spooled alerts are replayed until MongoDB is unavailable, and alerts that can't be saved are dropped.
+    """
+
+    def setUp(self):
+
+        self.saved = dict((k, CONF.get(k)) for k in ('outbound_queue', 'outbound_topic'))
+        CONF.update(outbound_queue='/queue/logger', outbound_topic='/topic/notify')
+
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool = Spool('db', spool_dir=self.spool_dir)
+        self.db = FakeDatabase()
+        self.broker = FakeBroker()
+
+    def tearDown(self):
+
+        self.spool.close()
+        shutil.rmtree(self.spool_dir)
+        CONF.update(self.saved)
+
+    def replay(self, record):
+
+        return daemon.replay(self.db, self.broker, self.broker, None, record)
+
+    def test_replay_drops_bad_alerts(self):
+        """
+        Ensure an alert that can't be parsed or saved doesn't stop the alerts spooled after it.
+        """
+        for record in [{"resource": "router55"}, {"resource": "dbfail", "event": "Node_Down"},
+                       {"resource": "router56", "event": "Node_Down"}]:
+            self.spool.put(record)
+
+        self.assertEquals(self.spool.replay(self.replay, 10), 3)
+        self.assertEquals(len(self.spool), 0)
+        self.assertEquals(self.db.saved, ['router56'])
+        self.assertEquals(self.broker.sent, ['router56'])
+        self.assertTrue('alerta.alerts.rejected' in self.broker.metrics)
+        self.assertTrue('alerta.alerts.error' in self.broker.metrics)
+
+    def test_replay_stops_while_database_down(self):
+        """
+        Ensure replay stops at an alert that can't be saved because MongoDB is unavailable.
+        """
+        for resource in ['router55', 'dbdown', 'router56']:
+            self.spool.put({"resource": resource, "event": "Node_Down"})
+
+        self.assertEquals(self.spool.replay(self.replay, 10), 1)
+        self.assertEquals(len(self.spool), 2)
+        self.assertEquals(self.db.saved, ['router55'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.common.targets import TargetFile
+
+
+def parse(urls):
+    return dict((check['resource'], check) for check in urls)
+
+
+class TestTargets(unittest.TestCase):
+    """
+    Ensures changes to target files are found and diffed.
+    """
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'alert-urlmon.targets')
+        self.targets = TargetFile(self.path, parse)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+
+        with open(self.path, 'w') as f:
+            f.write(data)
+        os.utime(self.path, (0, os.stat(self.path).st_mtime + 1))  # files written in the same tick
+
+    def test_reload(self):
+        """
+        Ensure added, removed and modified targets are returned when the file changes
+        """
+        self.assertFalse(self.targets.changed())
+
+        self.write("- {resource: web1, url: 'http://web1/'}\n- {resource: web2, url: 'http://web2/'}\n")
+        self.assertTrue(self.targets.changed())
+        added, removed, modified = self.targets.reload()
+        self.assertEqual(sorted(added), ['web1', 'web2'])
+        self.assertFalse(self.targets.changed())
+
+        self.write("- {resource: web1, url: 'http://web1/', search: OK}\n- {resource: web3, url: 'http://web3/'}\n")
+        added, removed, modified = self.targets.reload()
+        self.assertEqual((added.keys(), removed.keys(), modified.keys()), (['web3'], ['web2'], ['web1']))
+        self.assertEqual(self.targets.last_reload['total'], 2)
+
+    def test_invalid(self):
+        """
+        Ensure targets are kept if the file can't be parsed
+        """
+        self.write("- {resource: web1, url: 'http://web1/'}\n")
+        self.targets.reload()
+
+        self.write("- {resource: web1, url: 'http://web1/'\n")
+        self.assertEqual(self.targets.reload(), ({}, {}, {}))
+        self.assertEqual(self.targets.targets.keys(), ['web1'])
+        self.assertFalse(self.targets.changed())
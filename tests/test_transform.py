@@ -0,0 +1,163 @@
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+# If ../alerta/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'alerta', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from alerta.common.alert import Alert
+from alerta.common.config import CONF, prog
+from alerta.common.transform import Transformer
+
+RULES = """
+- match: {resource: router55}
+  event: Node_Down
+- match: {event: Node_Down, environment: [PROD]}
+  severity: major
+- match: {resource: router56}
+  suppress: true
+- trapoid: ^\.1\.3\.6\.1\.4\.1\.2021\.
+  parser: TestParser
+- priority: local0.*
+  group: Syslog
+"""
+
+PARSER = """
+text = 'parsed %s' % resource
+get_type = 'not an attribute'
+if re.match('router', resource) and fnmatch.fnmatch(resource, 'router5?'):
+    group = yaml.safe_load('Router')
+"""
+
+
+class TestTransformer(unittest.TestCase):
+    """
+    Ensures transform rules are compiled, indexed and applied in order.
+    """
+
+    def setUp(self):
+
+        self.parser_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.parser_dir, 'test.yaml')
+        with open(self.path, 'w') as f:
+            f.write(RULES)
+        with open(os.path.join(self.parser_dir, 'TestParser.py'), 'w') as f:
+            f.write(PARSER)
+
+        self.transformer = Transformer(self.path, self.parser_dir)
+        self.assertTrue(self.transformer.load())
+
+    def tearDown(self):
+
+        shutil.rmtree(self.parser_dir)
+
+    def test_match_rules_in_order(self):
+        """
+        Ensure a rule can match on the result of an earlier rule
+        """
+        alert = Alert('router55', 'Link_Down')
+        matched = [rule.position for rule, pattern in self.transformer.matches(alert)]
+        self.assertEquals(matched, [0])
+
+        alert.event = 'Node_Down'
+        self.assertEquals(self.transformer.ruleset.candidates(alert), [0, 1])
+
+    def test_trapoid_and_priority(self):
+        """
+        Ensure trapoid and priority rules only match snmp traps and syslog alerts
+        """
+        trap = Alert('host1', 'trap', event_type='snmptrapAlert')
+        rules = [rule.position for rule, pattern in self.transformer.matches(trap, trapoid='.1.3.6.1.4.1.2021.251.1')]
+        self.assertEquals(rules, [3])
+        code = self.transformer.parser('TestParser')
+        self.assertTrue(code is self.transformer.parser('TestParser'))
+
+        syslog = Alert('host1', 'syslog', event_type='syslogAlert')
+        rules = [rule.position for rule, pattern in self.transformer.matches(syslog, facility='local0', level='err')]
+        self.assertEquals(rules, [4])
+        self.assertEquals(list(self.transformer.matches(syslog, facility='local1', level='err')), [])
+
+    def test_reload_on_change(self):
+        """
+        Ensure rules are reloaded only when the file changes
+        """
+        ruleset = self.transformer.ruleset
+        self.assertTrue(self.transformer.load())
+        self.assertTrue(self.transformer.ruleset is ruleset)
+
+        with open(self.path, 'w') as f:
+            f.write('- match: {resource: router57}\n  suppress: true\n')
+        os.utime(self.path, (0, 0))
+        self.assertTrue(self.transformer.load())
+        self.assertEquals(len(self.transformer.ruleset), 1)
+
+    def test_parser_context(self):
+        """
+        Ensure only alert attributes are set from a parser, not names that are Alert methods
+        """
+        saved = dict((k, CONF[k]) for k in ('yaml_config', 'parser_dir'))
+        CONF.update(yaml_config=self.path, parser_dir=self.parser_dir)
+        try:
+            alert = Alert('router57', 'Link_Down', event_type='snmptrapAlert')
+            self.assertFalse(alert.transform_alert(trapoid='.1.3.6.1.4.1.2021.251.1'))
+        finally:
+            CONF.update(saved)
+
+        self.assertEquals(alert.text, 'parsed router57')
+        self.assertEquals(alert.group, 'Router')  # parsers can use the modules alert imports
+        self.assertEquals(alert.get_type(), 'snmptrapAlert')
+
+    def test_rule_stats(self):
+        """
+        Ensure rule evaluations and matches are counted per rule
+        """
+        for resource in ['router55', 'router56', 'router57']:
+            alert = Alert(resource, 'Link_Down')
+            for rule, pattern in self.transformer.matches(alert):
+                if rule.conf.get('suppress'):
+                    rule.stats.suppressed()
+
+        stats = dict((rule['name'], rule) for rule in self.transformer.stats())
+        self.assertEquals((stats['rule000']['evaluations'], stats['rule000']['matches']), (1, 1))
+        self.assertEquals((stats['rule002']['matches'], stats['rule002']['suppressions']), (1, 1))
+        self.assertEquals(stats['rule001']['evaluations'], 0)
+        self.assertTrue(stats['rule000']['p99Time'] >= 0)
+
+    def test_report_interval(self):
+        """
+        Ensure rule stats are reported at most once every transform_stats_every seconds
+        """
+        class Sender(object):
+            def __init__(self):
+                self.metrics = list()
+
+            def metric_send(self, *args):
+                self.metrics.append(args)
+
+        saved = dict((k, CONF[k]) for k in ('transform_profile', 'transform_stats_dir', 'transform_stats_every'))
+        CONF.update(transform_profile=True, transform_stats_dir=self.parser_dir, transform_stats_every=60)
+        try:
+            self.transformer.statsd = Sender()
+            self.transformer.report()
+            sent = len(self.transformer.statsd.metrics)
+            self.assertTrue(sent > 0)
+            self.assertTrue(self.transformer.next_report > time.time())
+
+            os.remove(os.path.join(self.parser_dir, '%s.rules.json' % prog))
+            self.transformer.report()
+            self.assertEquals(len(self.transformer.statsd.metrics), sent)
+            self.assertFalse(os.path.exists(os.path.join(self.parser_dir, '%s.rules.json' % prog)))
+        finally:
+            CONF.update(saved)
+
+if __name__ == '__main__':
+    unittest.main()